@@ -0,0 +1,360 @@
+"""Microbenchmarks of homu's hot paths, on synthetic repositories.
+
+    python benchmarks/bench.py [--sizes 100,1000,10000] [--only NAME]
+                               [--output results.json] [--compare old.json]
+
+Every benchmark runs once per size (the number of open pull requests), and
+reports the best and median time of a few runs. With --output the results
+are written as JSON along with the commit they were taken on, and with
+--compare they are printed next to the results of an earlier run, e.g. on
+the base commit of a change.
+
+Nothing talks to GitHub: synchronization gets its pull requests from a
+stubbed GraphQL client, and the rest only needs the database.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import queue
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+from bottle import request, response
+
+from homu import main, server
+from homu.db import migrate
+from homu.github_v4 import Comment, PullRequest
+from homu.main import PullReqState, Repository
+from homu.parse_issue_comment import parse_issue_comment
+
+DEFAULT_SIZES = [100, 1000, 10000]
+REPEAT = 5
+SEED = 42
+
+REVIEWERS = ['alice', 'bob', 'carol']
+REPO_CFG = {
+    'owner': 'rust-lang',
+    'name': 'rust',
+    'reviewers': REVIEWERS,
+    'try_users': ['dave'],
+    'buildbot': {
+        'builders': ['linux', 'windows', 'macos'],
+        'try_builders': ['linux'],
+    },
+}
+CFG = {
+    'max_priority': 9001,
+    'github': {'app_client_id': ''},
+    'web': {},
+    'repo': {'rust': REPO_CFG},
+}
+
+# What people write to the bot, and what they write to each other
+COMMENTS = [
+    '@bors r+',
+    '@bors r+ rollup',
+    '@bors r=alice p=5',
+    '@bors: r+ {sha}',
+    '@bors try',
+    '@bors retry network failure on the windows builder',
+    '@bors rollup=never',
+    '@bors p=1 treeclosed=100',
+    '@bors r- we need to discuss the design first',
+    'Thanks for the PR! I left a few comments.\n\n'
+    '```rust\nfn main() {{\n    println!("@bors r+");\n}}\n```\n'
+    'Otherwise this looks good to me.',
+    'r? @alice\n\n<!-- homu-ignore:start -->\n@bors r+\n'
+    '<!-- homu-ignore:end -->',
+    '> @bors r+\n\nWhy was this approved already?',
+    'This changes the behavior of `HashMap::entry` for zero-sized types. '
+    'I ran the benchmarks and saw no regression, see the results below.\n\n'
+    + '| bench | before | after |\n|---|---|---|\n' * 20,
+]
+
+
+class StubGitHub:
+    """The few GitHub objects that syncing pull requests asks for, e.g. the
+    author of a pull request when someone unapproves it."""
+
+    class User:
+        login = 'someone'
+
+    class Issue:
+        def __init__(self, num):
+            self.number = num
+            self.user = StubGitHub.User()
+
+    class Owner:
+        def __init__(self, login):
+            self.login = login
+
+    class Repository:
+        def __init__(self, owner, name):
+            self.owner = StubGitHub.Owner(owner)
+            self.name = name
+
+        def issue(self, num):
+            return StubGitHub.Issue(num)
+
+    def repository(self, owner, name):
+        return self.Repository(owner, name)
+
+
+def sha(rng):
+    return '{:040x}'.format(rng.getrandbits(160))
+
+
+def new_db():
+    db = sqlite3.connect(':memory:', isolation_level=None).cursor()
+    migrate(db)
+    return db
+
+
+def new_repo(db):
+    return Repository(None, 'rust', db, github=StubGitHub(),
+                      repo_cfg=REPO_CFG, mergeable_que=queue.Queue())
+
+
+def new_states(size, repo, rng):
+    """Open pull requests in every stage of their life."""
+    states = {}
+    for num in range(1, size + 1):
+        state = PullReqState(num, sha(rng), '', repo)
+        state.title = 'Pull request {}'.format(num)
+        state.head_ref = 'someone:branch-{}'.format(num)
+        state.base_ref = 'master'
+        state.assignee = rng.choice(REVIEWERS)
+        state.mergeable = rng.choice([True, True, True, False, None])
+        state.priority = rng.choice([0, 0, 0, 0, 1, 5, 100])
+        state.rollup = rng.choice([0, 0, 1, -1, -2])
+
+        kind = rng.random()
+        if kind < 0.3:
+            state.approved_by = rng.choice(REVIEWERS)
+        if kind < 0.05:
+            state.status = rng.choice(['pending', 'failure', 'error'])
+            state.merge_sha = sha(rng)
+            state.init_build_res(REPO_CFG['buildbot']['builders'],
+                                 use_db=False)
+        elif 0.3 < kind < 0.35:
+            state.try_ = True
+            state.status = rng.choice(['', 'pending', 'success'])
+
+        states[num] = state
+    return states
+
+
+def comment_corpus(size, rng):
+    return [rng.choice(COMMENTS).format(sha=sha(rng)) for _ in range(size)]
+
+
+def fake_pulls(size, rng):
+    pulls = []
+    for num in range(1, size + 1):
+        head_sha = sha(rng)
+        pull = PullRequest({
+            'number': num,
+            'title': 'Pull request {}'.format(num),
+            'body': 'Fixes #{}. cc @alice'.format(num),
+            'headRefOid': head_sha,
+            'headRefName': 'branch-{}'.format(num),
+            'headRepositoryOwner': {'login': 'someone'},
+            'baseRefName': 'master',
+            'assignees': {'nodes': [{'login': rng.choice(REVIEWERS)}]},
+            'labels': {'nodes': [{'name': 'S-waiting-on-review'}]},
+            'commits': {'nodes': []},
+        })
+        for i in range(rng.randint(0, 4)):
+            pull.issue_comments.append(Comment({
+                'body': rng.choice(COMMENTS).format(sha=head_sha),
+                'createdAt': '2020-01-01T00:00:00Z',
+                'url': 'https://github.com/rust-lang/rust/pull/{}#{}'
+                       .format(num, i),
+                'author': {'login': rng.choice(REVIEWERS + ['someone']),
+                           'databaseId': 1},
+            }))
+        pulls.append(pull)
+    return pulls
+
+
+class Benchmark:
+    def __init__(self, name, setup, run):
+        self.name = name
+        # setup(size, rng) returns the arguments of run, and isn't timed
+        self.setup = setup
+        self.run = run
+
+    def measure(self, size, repeat=REPEAT):
+        times = []
+        for i in range(repeat):
+            args = self.setup(size, random.Random(SEED + i))
+            start = time.perf_counter()
+            self.run(*args)
+            times.append(time.perf_counter() - start)
+        return times
+
+
+def setup_parse(size, rng):
+    return [comment_corpus(size, rng)]
+
+
+def run_parse(comments):
+    for body in comments:
+        parse_issue_comment('alice', body, 'f' * 40, 'bors')
+
+
+def setup_sort(size, rng):
+    return [list(new_states(size, new_repo(new_db()), rng).values())]
+
+
+def run_sort(states):
+    sorted(states)
+
+
+def setup_find_state(size, rng):
+    repo = new_repo(new_db())
+    states = new_states(size, repo, rng)
+    server.g.states = {'rust': states}
+    # Builds that finished on pull requests homu no longer knows about are
+    # the worst case: every state is looked at
+    shas = [state.merge_sha for state in states.values() if state.merge_sha]
+    return [shas + [sha(rng)] * 10]
+
+
+def run_find_state(shas):
+    for merge_sha in shas:
+        try:
+            server.find_state(merge_sha)
+        except ValueError:
+            pass
+
+
+def setup_render_queue(size, rng):
+    repo = new_repo(new_db())
+    server.g.cfg = CFG
+    server.g.tpls = server.load_templates(CFG)
+    server.g.logger = logging.getLogger('bench')
+    server.g.repos = {'rust': repo}
+    server.g.states = {'rust': new_states(size, repo, rng)}
+    request.bind({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/queue/rust'})
+    response.bind()
+    return []
+
+
+def run_render_queue():
+    server.render_queue('rust', server.g.repos['rust'].version)
+
+
+def setup_replace_states(size, rng):
+    db = new_db()
+    repo = new_repo(db)
+    main.global_cfg = CFG
+    return [db, {'rust': new_states(size, repo, rng)}, {'rust': repo},
+            fake_pulls(size, rng)]
+
+
+def run_replace_states(db, states, repos, pulls):
+    main.replace_states('rust', REPO_CFG, None, pulls, StubGitHub(), states,
+                        repos, db, queue.Queue(), 'bors')
+
+
+def setup_load_states(size, rng):
+    db = new_db()
+    repo = new_repo(db)
+    for state in new_states(size, repo, rng).values():
+        state.save()
+    return [db, {'rust': repo}]
+
+
+def run_load_states(db, repos):
+    main.load_states(db, repos, {'rust': REPO_CFG}, logging.getLogger('bench'))
+
+
+BENCHMARKS = [
+    Benchmark('parse_issue_comment', setup_parse, run_parse),
+    Benchmark('sort_states', setup_sort, run_sort),
+    Benchmark('find_state', setup_find_state, run_find_state),
+    Benchmark('render_queue', setup_render_queue, run_render_queue),
+    Benchmark('replace_states', setup_replace_states, run_replace_states),
+    Benchmark('load_states', setup_load_states, run_load_states),
+]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='numbers of pull requests, comma separated')
+    parser.add_argument('--only', action='append',
+                        help='run only this benchmark (repeatable)')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run')
+    args = parser.parse_args()
+
+    # Keep the output readable
+    logging.disable(logging.INFO)
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            for result in json.load(fp)['results']:
+                previous[result['name'], result['size']] = result
+
+    results = []
+    for benchmark in BENCHMARKS:
+        if args.only and benchmark.name not in args.only:
+            continue
+
+        for size in sizes:
+            times = benchmark.measure(size, args.repeat)
+            result = {
+                'name': benchmark.name,
+                'size': size,
+                'best': min(times),
+                'median': statistics.median(times),
+                'times': times,
+            }
+            results.append(result)
+
+            line = '{:<20} {:>6} {:>10.2f}ms (median {:.2f}ms)'.format(
+                benchmark.name, size, result['best'] * 1000,
+                result['median'] * 1000)
+            before = previous.get((benchmark.name, size))
+            if before:
+                line += '  {:+.1%} vs {:.2f}ms'.format(
+                    result['best'] / before['best'] - 1,
+                    before['best'] * 1000)
+            print(line, flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'time': time.time(),
+                'results': results,
+            }, fp, indent=2)
+            fp.write('\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main_())
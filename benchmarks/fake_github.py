@@ -0,0 +1,675 @@
+"""A local stand-in for the parts of GitHub homu talks to.
+
+It serves the REST endpoints homu uses (users, repositories, pull requests,
+issues, comments, labels, statuses, commits, refs, merges and collaborators)
+and the GraphQL query used to synchronize open pull requests, keeping
+everything in memory. Changes made through it or through `FakeGitHub`
+methods are sent to homu as signed webhooks, the way GitHub would: updating
+a branch sends a `push` event, and fast-forwarding the base branch over the
+head of a pull request merges and closes it.
+
+Point homu at it with `github.api_url` and `github.graphql_url`.
+"""
+
+import hashlib
+import hmac
+import itertools
+import json
+import queue
+import threading
+import time
+from collections import Counter
+
+import requests
+import waitress
+from bottle import Bottle, HTTPResponse, request, response
+
+from homu.metrics import github_endpoint
+
+DEFAULT_WEBHOOK_WORKERS = 4
+
+# How far back to look for a commit when checking if a ref update is a
+# fast-forward, or which pull requests it merges
+MAX_ANCESTORS = 10000
+
+
+def new_sha(counter=itertools.count(1)):
+    # Unique, and shaped like a real SHA for the endpoint placeholders
+    return hashlib.sha1(str(next(counter)).encode('ascii')).hexdigest()
+
+
+def abort(status, message):
+    return HTTPResponse(json.dumps({'message': message}), status,
+                        {'Content-Type': 'application/json'})
+
+
+class Pull:
+    def __init__(self, num, title, body, head_sha, head_ref, base_ref, user):
+        self.num = num
+        self.title = title
+        self.body = body
+        self.head_sha = head_sha
+        self.head_ref = head_ref
+        self.base_ref = base_ref
+        self.user = user
+        self.assignee = None
+        self.labels = set()
+        # (user, body, created_at) of each issue comment
+        self.comments = []
+        self.state = 'open'
+        self.merged_at = None
+
+
+class Repo:
+    def __init__(self, owner, name, secret, default_branch='master'):
+        self.owner = owner
+        self.name = name
+        self.secret = secret
+        self.pulls = {}
+        self.next_num = 1
+        # Every commit created through the fake: sha -> (parents, message)
+        self.commits = {}
+        root = new_sha()
+        self.commits[root] = ([], 'Initial commit')
+        self.refs = {'heads/' + default_branch: root}
+        # sha -> statuses, most recent first
+        self.statuses = {}
+
+
+class Webhooks:
+    """Deliveries of webhooks to homu.
+
+    Events about the same pull request or ref always go to the same worker,
+    so homu sees them in order, like the outbound workers of homu itself.
+    """
+
+    def __init__(self, url, workers=DEFAULT_WEBHOOK_WORKERS):
+        self.url = url
+        self.lock = threading.Lock()
+        # (event, seconds homu took to accept it, status code)
+        self.deliveries = []
+        self.queues = [queue.Queue() for _ in range(workers)]
+        self.session = requests.Session()
+        for que in self.queues:
+            threading.Thread(target=self.run, args=[que], daemon=True).start()
+
+    def send(self, key, repo, event, payload):
+        que = self.queues[hash(key) % len(self.queues)]
+        que.put((repo, event, payload))
+
+    def pending(self):
+        return sum(que.unfinished_tasks for que in self.queues)
+
+    def run(self, que):
+        while True:
+            repo, event, payload = que.get()
+            try:
+                body = json.dumps(payload).encode('utf-8')
+                signature = hmac.new(repo.secret.encode('utf-8'), body,
+                                     'sha1').hexdigest()
+                start = time.perf_counter()
+                try:
+                    res = self.session.post(self.url, data=body, headers={
+                        'Content-Type': 'application/json',
+                        'X-Github-Event': event,
+                        'X-Hub-Signature': 'sha1=' + signature,
+                    })
+                    status = res.status_code
+                except requests.exceptions.RequestException:
+                    status = None
+                with self.lock:
+                    self.deliveries.append(
+                        (event, time.perf_counter() - start, status))
+            finally:
+                que.task_done()
+
+
+class FakeGitHub:
+    def __init__(self, bot='bors', reviewers=(), *, latency=0,
+                 host='127.0.0.1', port=0):
+        self.bot = bot
+        self.reviewers = set(reviewers)
+        # Added to every API call, to stand for the network and GitHub
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.repos = {}
+        self.webhooks = None
+        # Called with (repo, branch, merge_sha, pull) for each merge made
+        # through the API, e.g. to start CI
+        self.merge_listeners = []
+        # Called with (repo, pull) when a pull request gets merged
+        self.merged_listeners = []
+        # (method, endpoint) -> number of calls
+        self.calls = Counter()
+
+        self.app = Bottle()
+        self.app.add_hook('before_request', self.before_request)
+        self.routes()
+
+        self.server = waitress.create_server(self.app, host=host, port=port,
+                                             threads=8)
+        self.url = 'http://{}:{}'.format(host, self.server.effective_port)
+
+    def start(self, webhook_url, workers=DEFAULT_WEBHOOK_WORKERS):
+        self.webhooks = Webhooks(webhook_url, workers)
+        threading.Thread(target=self.server.run, daemon=True).start()
+
+    def stop(self):
+        self.server.close()
+
+    def before_request(self):
+        with self.lock:
+            self.calls[request.method,
+                       github_endpoint(request.urlparts.path)] += 1
+        response.content_type = 'application/json'
+        response.set_header('X-RateLimit-Remaining', '5000')
+        if self.latency:
+            time.sleep(self.latency)
+
+    # Changes, made by people and CI, that homu hears about through webhooks
+
+    def create_repo(self, owner, name, secret):
+        repo = Repo(owner, name, secret)
+        self.repos[owner, name] = repo
+        return repo
+
+    def open_pull(self, repo, user, title, body, base_ref='master', *,
+                  notify=True):
+        with self.lock:
+            num = repo.next_num
+            repo.next_num += 1
+
+            head_sha = new_sha()
+            repo.commits[head_sha] = ([repo.refs['heads/' + base_ref]],
+                                      title)
+            pull = Pull(num, title, body, head_sha,
+                        'branch-{}'.format(num), base_ref, user)
+            repo.pulls[num] = pull
+            payload = self.pull_event(repo, pull, 'opened', user)
+
+        if notify:
+            self.send(repo, pull, 'pull_request', payload)
+        return pull
+
+    def push_pull(self, repo, pull):
+        """Push a new commit on top of the pull request."""
+        with self.lock:
+            before = pull.head_sha
+            pull.head_sha = new_sha()
+            repo.commits[pull.head_sha] = ([before], 'Address review')
+            payload = self.pull_event(repo, pull, 'synchronize', pull.user)
+            payload['before'] = before
+            payload['after'] = pull.head_sha
+
+        self.send(repo, pull, 'pull_request', payload)
+
+    def comment(self, repo, pull, user, body, *, notify=True):
+        with self.lock:
+            created_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            pull.comments.append((user, body, created_at))
+            payload = {
+                'action': 'created',
+                'issue': self.issue_json(repo, pull),
+                'comment': self.comment_json(repo, pull,
+                                             len(pull.comments) - 1),
+                'repository': self.repo_json(repo),
+                'sender': self.user_json(user),
+            }
+
+        if notify:
+            self.send(repo, pull, 'issue_comment', payload)
+
+    def create_status(self, repo, sha, state, context, target_url='',
+                      description='', branch='', creator='ci'):
+        with self.lock:
+            status = {
+                'state': state,
+                'context': context,
+                'target_url': target_url,
+                'description': description,
+                'id': len(repo.statuses.get(sha, [])) + 1,
+                'creator': self.user_json(creator),
+            }
+            repo.statuses.setdefault(sha, []).insert(0, status)
+            payload = dict(
+                status,
+                sha=sha,
+                branches=[{'name': branch}] if branch else [],
+                repository=self.repo_json(repo),
+            )
+
+        self.send(repo, sha, 'status', payload)
+
+    def complete_check_run(self, repo, sha, name, conclusion, details_url=''):
+        payload = {
+            'action': 'completed',
+            'check_run': {
+                'head_sha': sha,
+                'name': name,
+                'status': 'completed',
+                'conclusion': conclusion,
+                'details_url': details_url,
+            },
+            'repository': self.repo_json(repo),
+        }
+        self.send(repo, sha, 'check_run', payload)
+
+    def send(self, repo, key, event, payload):
+        if self.webhooks is not None:
+            self.webhooks.send((repo.owner, repo.name, key), repo, event,
+                               payload)
+
+    # Git
+
+    def merged_commits(self, repo, sha, stop=None):
+        """The commits on the first-parent chain of `sha` back to `stop`, and
+        the heads merged by them. Only homu creates merge commits here, so
+        this is everything a ref update to `sha` brings in."""
+        commits = set()
+        for _ in range(MAX_ANCESTORS):
+            if sha is None or sha == stop:
+                break
+            commits.add(sha)
+            parents = repo.commits.get(sha, ([], ''))[0]
+            commits.update(parents[1:])
+            sha = parents[0] if parents else None
+        return commits
+
+    def is_ancestor(self, repo, ancestor, sha):
+        return ancestor in self.merged_commits(repo, sha)
+
+    def update_ref(self, repo, ref, sha):
+        before = repo.refs.get(ref)
+        repo.refs[ref] = sha
+        if not ref.startswith('heads/'):
+            return
+
+        branch = ref[len('heads/'):]
+        self.send(repo, ref, 'push', {
+            'ref': 'refs/' + ref,
+            'before': before or '0' * 40,
+            'after': sha,
+            'head_commit': {'id': sha, 'message': repo.commits[sha][1]},
+            'repository': self.repo_json(repo),
+        })
+
+        # The pull requests whose head is now in the branch are merged
+        merged = self.merged_commits(repo, sha, before)
+        for pull in list(repo.pulls.values()):
+            if (pull.state == 'open' and pull.base_ref == branch and
+                    pull.head_sha in merged):
+                pull.state = 'closed'
+                pull.merged_at = time.time()
+                payload = self.pull_event(repo, pull, 'closed', self.bot)
+                self.send(repo, pull, 'pull_request', payload)
+                for listener in self.merged_listeners:
+                    listener(repo, pull)
+
+    # JSON representations
+
+    def user_json(self, login):
+        return {
+            'login': login,
+            'id': sum(map(ord, login)),
+            'name': login.capitalize(),
+            'type': 'User',
+            'url': '{}/users/{}'.format(self.url, login),
+        }
+
+    def repo_json(self, repo):
+        return {
+            'id': 1,
+            'name': repo.name,
+            'full_name': '{}/{}'.format(repo.owner, repo.name),
+            'owner': self.user_json(repo.owner),
+            'url': '{}/repos/{}/{}'.format(self.url, repo.owner, repo.name),
+            'html_url': 'https://github.com/{}/{}'.format(repo.owner,
+                                                          repo.name),
+            'default_branch': 'master',
+        }
+
+    def issue_json(self, repo, pull):
+        return {
+            'number': pull.num,
+            'title': pull.title,
+            'body': pull.body,
+            'state': pull.state,
+            'user': self.user_json(pull.user),
+            'assignee': (self.user_json(pull.assignee) if pull.assignee
+                         else None),
+            'labels': [self.label_json(repo, label)
+                       for label in sorted(pull.labels)],
+            'pull_request': {
+                'url': '{}/pulls/{}'.format(self.repo_json(repo)['url'],
+                                            pull.num),
+            },
+            'url': '{}/issues/{}'.format(self.repo_json(repo)['url'],
+                                         pull.num),
+            'html_url': self.html_url(repo, pull),
+        }
+
+    def pull_json(self, repo, pull):
+        repo_json = self.repo_json(repo)
+        head_repo = dict(repo_json, owner=self.user_json(pull.user))
+        return dict(
+            self.issue_json(repo, pull),
+            url='{}/pulls/{}'.format(repo_json['url'], pull.num),
+            issue_url='{}/issues/{}'.format(repo_json['url'], pull.num),
+            head={'sha': pull.head_sha, 'ref': pull.head_ref,
+                  'label': '{}:{}'.format(pull.user, pull.head_ref),
+                  'repo': head_repo, 'user': self.user_json(pull.user)},
+            base={'sha': repo.refs['heads/' + pull.base_ref],
+                  'ref': pull.base_ref,
+                  'label': '{}:{}'.format(repo.owner, pull.base_ref),
+                  'repo': repo_json, 'user': self.user_json(repo.owner)},
+            mergeable=pull.state == 'open',
+            merged=pull.merged_at is not None,
+        )
+
+    def pull_event(self, repo, pull, action, sender):
+        return {
+            'action': action,
+            'number': pull.num,
+            'pull_request': self.pull_json(repo, pull),
+            'repository': self.repo_json(repo),
+            'sender': self.user_json(sender),
+        }
+
+    def comment_json(self, repo, pull, index):
+        user, body, created_at = pull.comments[index]
+        return {
+            'id': pull.num * 1000000 + index,
+            'body': body,
+            'user': self.user_json(user),
+            'created_at': created_at,
+            'html_url': '{}#issuecomment-{}'.format(
+                self.html_url(repo, pull), pull.num * 1000000 + index),
+        }
+
+    def label_json(self, repo, name):
+        return {
+            'name': name,
+            'color': 'ededed',
+            'url': '{}/labels/{}'.format(self.repo_json(repo)['url'], name),
+        }
+
+    def commit_json(self, repo, sha):
+        parents, message = repo.commits[sha]
+        url = '{}/commits/{}'.format(self.repo_json(repo)['url'], sha)
+        return {
+            'sha': sha,
+            'url': url,
+            'commit': {'message': message, 'url': url},
+            'parents': [{'sha': parent} for parent in parents],
+        }
+
+    def ref_json(self, repo, ref):
+        sha = repo.refs[ref]
+        return {
+            'ref': 'refs/' + ref,
+            'url': '{}/git/refs/{}'.format(self.repo_json(repo)['url'], ref),
+            'object': {'type': 'commit', 'sha': sha},
+        }
+
+    def html_url(self, repo, pull):
+        return 'https://github.com/{}/{}/pull/{}'.format(repo.owner,
+                                                         repo.name, pull.num)
+
+    # REST API
+
+    def routes(self):
+        app = self.app
+        repo_path = '/repos/<owner>/<name>'
+        app.get('/user', callback=self.get_user)
+        app.get(repo_path, callback=self.get_repo)
+        app.get(repo_path + '/pulls/<num:int>', callback=self.get_pull)
+        app.get(repo_path + '/issues/<num:int>', callback=self.get_issue)
+        app.get(repo_path + '/issues/<num:int>/comments',
+                callback=self.get_comments)
+        app.post(repo_path + '/issues/<num:int>/comments',
+                 callback=self.post_comment)
+        app.get(repo_path + '/issues/<num:int>/labels',
+                callback=self.get_labels)
+        app.post(repo_path + '/issues/<num:int>/labels',
+                 callback=self.post_labels)
+        app.delete(repo_path + '/issues/<num:int>/labels/<label>',
+                   callback=self.delete_label)
+        app.get(repo_path + '/statuses/<sha>', callback=self.get_statuses)
+        app.post(repo_path + '/statuses/<sha>', callback=self.post_status)
+        app.get(repo_path + '/commits/<sha>', callback=self.get_commit)
+        app.get(repo_path + '/git/refs/<ref:path>', callback=self.get_ref)
+        app.route(repo_path + '/git/refs/<ref:path>', 'PATCH',
+                  callback=self.patch_ref)
+        app.post(repo_path + '/git/refs', callback=self.post_ref)
+        app.post(repo_path + '/merges', callback=self.post_merge)
+        app.get(repo_path + '/collaborators/<login>',
+                callback=self.get_collaborator)
+        app.post('/graphql', callback=self.graphql)
+
+    def repo(self, owner, name):
+        try:
+            return self.repos[owner, name]
+        except KeyError:
+            raise abort(404, 'Not Found')
+
+    def pull(self, owner, name, num):
+        try:
+            return self.repo(owner, name).pulls[num]
+        except KeyError:
+            raise abort(404, 'Not Found')
+
+    def get_user(self):
+        return dict(self.user_json(self.bot), email=None)
+
+    def get_repo(self, owner, name):
+        return self.repo_json(self.repo(owner, name))
+
+    def get_pull(self, owner, name, num):
+        with self.lock:
+            return self.pull_json(self.repo(owner, name),
+                                  self.pull(owner, name, num))
+
+    def get_issue(self, owner, name, num):
+        with self.lock:
+            return self.issue_json(self.repo(owner, name),
+                                   self.pull(owner, name, num))
+
+    def get_comments(self, owner, name, num):
+        with self.lock:
+            repo = self.repo(owner, name)
+            pull = self.pull(owner, name, num)
+            return json.dumps([self.comment_json(repo, pull, index)
+                               for index in range(len(pull.comments))])
+
+    def post_comment(self, owner, name, num):
+        repo = self.repo(owner, name)
+        pull = self.pull(owner, name, num)
+        # homu hears about its own comments too, and some of them, like the
+        # one pinning the approved commit, are commands to itself
+        self.comment(repo, pull, self.bot, request.json['body'])
+        response.status = 201
+        with self.lock:
+            return self.comment_json(repo, pull, len(pull.comments) - 1)
+
+    def get_labels(self, owner, name, num):
+        with self.lock:
+            repo = self.repo(owner, name)
+            pull = self.pull(owner, name, num)
+            return json.dumps([self.label_json(repo, label)
+                               for label in sorted(pull.labels)])
+
+    def post_labels(self, owner, name, num):
+        with self.lock:
+            pull = self.pull(owner, name, num)
+            pull.labels.update(request.json['labels'])
+        return self.get_labels(owner, name, num)
+
+    def delete_label(self, owner, name, num, label):
+        with self.lock:
+            pull = self.pull(owner, name, num)
+            if label not in pull.labels:
+                raise abort(404, 'Label does not exist')
+            pull.labels.discard(label)
+        return self.get_labels(owner, name, num)
+
+    def get_statuses(self, owner, name, sha):
+        with self.lock:
+            repo = self.repo(owner, name)
+            return json.dumps(repo.statuses.get(sha, []))
+
+    def post_status(self, owner, name, sha):
+        repo = self.repo(owner, name)
+        data = request.json
+        self.create_status(repo, sha, data['state'], data.get('context', ''),
+                           data.get('target_url', ''),
+                           data.get('description', ''), creator=self.bot)
+        response.status = 201
+        with self.lock:
+            return repo.statuses[sha][0]
+
+    def get_commit(self, owner, name, sha):
+        with self.lock:
+            repo = self.repo(owner, name)
+            if sha not in repo.commits:
+                raise abort(422, 'No commit found for SHA: ' + sha)
+            return self.commit_json(repo, sha)
+
+    def get_ref(self, owner, name, ref):
+        with self.lock:
+            repo = self.repo(owner, name)
+            if ref not in repo.refs:
+                raise abort(404, 'Not Found')
+            return self.ref_json(repo, ref)
+
+    def patch_ref(self, owner, name, ref):
+        data = request.json
+        with self.lock:
+            repo = self.repo(owner, name)
+            if ref not in repo.refs:
+                raise abort(422, 'Reference does not exist')
+            if data['sha'] not in repo.commits:
+                raise abort(422, 'Object does not exist')
+            if (not data.get('force') and
+                    not self.is_ancestor(repo, repo.refs[ref], data['sha'])):
+                raise abort(422, 'Update is not a fast forward')
+            self.update_ref(repo, ref, data['sha'])
+            return self.ref_json(repo, ref)
+
+    def post_ref(self, owner, name):
+        data = request.json
+        ref = data['ref'][len('refs/'):]
+        with self.lock:
+            repo = self.repo(owner, name)
+            if ref in repo.refs:
+                raise abort(422, 'Reference already exists')
+            self.update_ref(repo, ref, data['sha'])
+            response.status = 201
+            return self.ref_json(repo, ref)
+
+    def post_merge(self, owner, name):
+        data = request.json
+        ref = 'heads/' + data['base']
+        with self.lock:
+            repo = self.repo(owner, name)
+            if ref not in repo.refs:
+                raise abort(404, 'Base does not exist')
+            base_sha = repo.refs[ref]
+            if self.is_ancestor(repo, data['head'], base_sha):
+                response.status = 204
+                return ''
+
+            sha = new_sha()
+            repo.commits[sha] = ([base_sha, data['head']],
+                                 data.get('commit_message', 'Merge'))
+            self.update_ref(repo, ref, sha)
+            pull = next((pull for pull in repo.pulls.values()
+                         if pull.head_sha == data['head']), None)
+            for listener in self.merge_listeners:
+                listener(repo, data['base'], sha, pull)
+
+            response.status = 201
+            return self.commit_json(repo, sha)
+
+    def get_collaborator(self, owner, name, login):
+        self.repo(owner, name)
+        if login in self.reviewers:
+            return HTTPResponse(status=204)
+        raise abort(404, 'Not Found')
+
+    # GraphQL API, only the queries of homu.github_v4 that synchronization
+    # needs with the pull requests of the fake: no review comments, and the
+    # issue comments past the first 100
+
+    def graphql(self):
+        query = request.json['query']
+        variables = request.json['variables']
+        with self.lock:
+            repo = self.repo(variables['owner'], variables['name'])
+            if 'pullRequests(' in query:
+                data = self.graphql_pulls(repo, variables)
+            elif 'comments(first: 100, after: $after)' in query:
+                pull = self.pull(repo.owner, repo.name, variables['number'])
+                data = {'pullRequest': {'comments': self.graphql_comments(
+                    repo, pull, int(variables['after']))}}
+            else:
+                data = {'pullRequest': {'reviews': self.graphql_empty()}}
+        return {'data': {'repository': data}}
+
+    def graphql_empty(self):
+        return {'pageInfo': {'hasNextPage': False, 'endCursor': None},
+                'nodes': []}
+
+    def graphql_comments(self, repo, pull, start=0, count=100):
+        nodes = []
+        for index in range(start, min(start + count, len(pull.comments))):
+            user, body, created_at = pull.comments[index]
+            nodes.append({
+                'body': body,
+                'createdAt': created_at,
+                'author': {'login': user,
+                           'databaseId': self.user_json(user)['id']},
+                'url': self.comment_json(repo, pull, index)['html_url'],
+            })
+        end = start + len(nodes)
+        return {
+            'pageInfo': {'hasNextPage': end < len(pull.comments),
+                         'endCursor': str(end)},
+            'nodes': nodes,
+        }
+
+    def graphql_pulls(self, repo, variables):
+        pulls = [pull for pull in repo.pulls.values() if pull.state == 'open']
+        start = int(variables['after'] or 0)
+        end = start + variables['pageSize']
+
+        nodes = []
+        for pull in pulls[start:end]:
+            homu_status = next(
+                (status for status in repo.statuses.get(pull.head_sha, [])
+                 if status['context'] == 'homu'), None)
+            nodes.append({
+                'number': pull.num,
+                'title': pull.title,
+                'body': pull.body,
+                'headRefOid': pull.head_sha,
+                'headRefName': pull.head_ref,
+                'headRepositoryOwner': {'login': pull.user},
+                'baseRefName': pull.base_ref,
+                'assignees': {'nodes': [{'login': pull.assignee}]
+                              if pull.assignee else []},
+                'labels': dict(self.graphql_empty(), nodes=[
+                    {'name': label} for label in sorted(pull.labels)]),
+                'commits': {'nodes': [{'commit': {'status': {
+                    'context': homu_status and {
+                        'state': homu_status['state'].upper(),
+                    },
+                }}}]},
+                'comments': self.graphql_comments(repo, pull),
+                'reviews': self.graphql_empty(),
+            })
+
+        return {'pullRequests': {
+            'pageInfo': {'hasNextPage': end < len(pulls),
+                         'endCursor': str(end)},
+            'nodes': nodes,
+        }}
@@ -0,0 +1,470 @@
+"""Drive a real homu server with a fake GitHub and a fake CI.
+
+    python benchmarks/loadtest.py [--duration 300] [--rate 1] [--pulls 100]
+                                  [--ci-delay 10] [--output results.json]
+
+homu is started in a subprocess, configured to talk to the stand-in for
+GitHub of fake_github.py. Once it has synchronized the `--pulls` pull
+requests open beforehand (a fifth of them approved), the driver replays a
+stream of events at `--rate` per second for `--duration` seconds: pull
+requests being opened, pushed to, approved, tried and commented on. The fake
+CI reports the builds homu starts on the auto and try branches through
+signed `status` (and `check_run` with `--checks`) webhooks after
+`--ci-delay` seconds, failing some of them. The driver then waits up to
+`--drain` seconds for the approved pull requests to be merged.
+
+The report covers the webhook deliveries (how long homu took to accept
+them), the merges (throughput, and the time from approval to the merge),
+the calls homu made to the GitHub API, and what homu measured itself from
+its /metrics. homu waits a minute before creating each merge commit, and
+another after a successful build before merging it (see
+server.FAST_FORWARD_DELAY), so it can't merge more than 30 pull requests an
+hour whatever the load.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import requests
+import toml
+
+from fake_github import FakeGitHub
+from homu import comments
+from homu.tracing import PERCENTILES, percentile
+
+OWNER = 'rust-lang'
+NAME = 'loadtest'
+REPO_LABEL = 'loadtest'
+SECRET = 'loadtest-secret'
+BOT = 'bors'
+REVIEWERS = ['alice', 'bob']
+AUTHORS = ['carol', 'dave', 'erin', 'frank']
+STATUS_CONTEXT = 'ci/fake'
+CHECK_NAME = 'Fake checks'
+
+# Share of each kind of event in the stream
+EVENTS = {
+    'open': 0.25,
+    'push': 0.1,
+    'approve': 0.25,
+    'try': 0.05,
+    'comment': 0.35,
+}
+CHATTER = [
+    'Thanks! I left a few comments.',
+    'r? @alice',
+    '> @bors r+\n\nNot yet, the tests are missing.',
+    'Could you add a test for the empty case?\n\n```rust\n'
+    'assert_eq!(f(&[]), None);\n```',
+    'This changes the behavior of `HashMap::entry` for zero-sized types. '
+    'I ran the benchmarks and saw no regression.',
+]
+
+STARTUP_TIMEOUT = 120
+
+
+class FakeCI:
+    """Reports the builds homu starts on the auto and try branches."""
+
+    def __init__(self, github, *, delay, jitter, failure_rate, checks, rng):
+        self.github = github
+        self.delay = delay
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.checks = checks
+        self.rng = rng
+        self.builds = Counter()
+
+    def on_merge(self, repo, branch, sha, pull):
+        if branch not in ('auto', 'try'):
+            return
+
+        success = self.rng.random() >= self.failure_rate
+        delay = max(self.rng.gauss(self.delay, self.jitter), 0)
+        self.builds[branch, success] += 1
+        self.github.create_status(repo, sha, 'pending', STATUS_CONTEXT,
+                                  branch=branch)
+        timer = threading.Timer(delay, self.finish,
+                                [repo, branch, sha, success])
+        timer.daemon = True
+        timer.start()
+
+    def finish(self, repo, branch, sha, success):
+        url = 'https://ci.example.com/builds/{}'.format(sha[:8])
+        self.github.create_status(repo, sha,
+                                  'success' if success else 'failure',
+                                  STATUS_CONTEXT, url, branch=branch)
+        if self.checks:
+            self.github.complete_check_run(
+                repo, sha, CHECK_NAME,
+                'success' if success else 'failure', url)
+
+
+class Driver:
+    """Plays the people working on the repository."""
+
+    def __init__(self, github, repo, rng):
+        self.github = github
+        self.repo = repo
+        self.rng = rng
+        self.events = Counter()
+        # num -> when the pull request was approved, until it's merged or
+        # pushed to
+        self.approved = {}
+        # Seconds from approval to merge
+        self.latencies = []
+        github.merged_listeners.append(self.on_merged)
+
+    def on_merged(self, repo, pull):
+        approved_at = self.approved.pop(pull.num, None)
+        if approved_at is not None:
+            self.latencies.append(time.time() - approved_at)
+
+    def open_pulls(self):
+        with self.github.lock:
+            return [pull for pull in self.repo.pulls.values()
+                    if pull.state == 'open']
+
+    def open(self, notify=True):
+        num = self.repo.next_num
+        return self.github.open_pull(
+            self.repo, self.rng.choice(AUTHORS),
+            'Improve the thing #{}'.format(num),
+            'Fixes #{}.\n\ncc @{}'.format(num, self.rng.choice(REVIEWERS)),
+            notify=notify)
+
+    def approve(self, pull, notify=True):
+        reviewer = self.rng.choice(REVIEWERS)
+        self.github.comment(self.repo, pull, reviewer, '@{} r+'.format(BOT),
+                            notify=notify)
+        if not notify:
+            # The approval happened while homu was running, and it answered
+            # with the commit it pinned
+            self.github.comment(self.repo, pull, BOT, comments.Approved(
+                sha=pull.head_sha, approver=reviewer, bot=BOT, queue='',
+            ).render(), notify=False)
+        self.approved.setdefault(pull.num, time.time())
+
+    def step(self):
+        kind = self.rng.choices(list(EVENTS), list(EVENTS.values()))[0]
+        pulls = self.open_pulls()
+        if kind == 'open' or not pulls:
+            self.open()
+            self.events['open'] += 1
+            return
+
+        if kind == 'approve':
+            waiting = [pull for pull in pulls
+                       if pull.num not in self.approved]
+            if waiting:
+                self.approve(self.rng.choice(waiting))
+                self.events['approve'] += 1
+                return
+            kind = 'comment'
+
+        pull = self.rng.choice(pulls)
+        if kind == 'push':
+            # The approval is lost
+            self.approved.pop(pull.num, None)
+            self.github.push_pull(self.repo, pull)
+        elif kind == 'try':
+            self.github.comment(self.repo, pull, self.rng.choice(REVIEWERS),
+                                '@{} try'.format(BOT))
+        else:
+            self.github.comment(self.repo, pull, self.rng.choice(AUTHORS),
+                                self.rng.choice(CHATTER))
+        self.events[kind] += 1
+
+    def run(self, rate, duration):
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            self.step()
+            time.sleep(self.rng.expovariate(rate))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def homu_config(directory, github, port, checks):
+    repo_cfg = {
+        'owner': OWNER,
+        'name': NAME,
+        'reviewers': REVIEWERS,
+        'try_users': [],
+        'github': {'secret': SECRET},
+        'status': {'ci': {'context': STATUS_CONTEXT}},
+    }
+    if checks:
+        repo_cfg['checks'] = {'fake': {'name': CHECK_NAME}}
+
+    return {
+        'github': {
+            'access_token': 'loadtest',
+            'app_client_id': '',
+            'app_client_secret': '',
+            'api_url': github.url,
+            'graphql_url': github.url + '/graphql',
+        },
+        'git': {'name': 'bors', 'email': 'bors@example.com'},
+        'web': {
+            'host': '127.0.0.1',
+            'port': port,
+            'sync_on_start': True,
+            # homu expects TLS to be terminated in front of it, and redirects
+            # the requests that aren't for this URL
+            'canonical_url': 'https://127.0.0.1:{}'.format(port),
+        },
+        'repo': {REPO_LABEL: repo_cfg},
+        'db': {'file': os.path.join(directory, 'main.db')},
+    }
+
+
+def start_homu(directory, cfg):
+    path = os.path.join(directory, 'cfg.toml')
+    with open(path, 'w') as fp:
+        toml.dump(cfg, fp)
+
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [root, env.get('PYTHONPATH')]))
+    log = open(os.path.join(directory, 'homu.log'), 'w')
+    # Not `-m homu.main`, which would load a second copy of the module
+    return subprocess.Popen(
+        [sys.executable, '-c', 'from homu.main import main; main()',
+         '-c', path],
+        stdout=log, stderr=subprocess.STDOUT, cwd=directory, env=env,
+    )
+
+
+def wait_ready(process, url):
+    """Wait for homu to be ready, i.e. to have synchronized the pull
+    requests that were open when it started."""
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('homu exited with {}'.format(process.returncode))  # noqa
+        try:
+            if requests.get('{}/health/ready'.format(url)).ok:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('homu did not synchronize in time')
+
+
+def wait_drained(github, driver, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not driver.approved and not github.webhooks.pending():
+            return
+        time.sleep(1)
+
+
+def distribution(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    res = {'p{}'.format(p): percentile(values, p) for p in PERCENTILES}
+    res.update(count=len(values), max=values[-1],
+               mean=sum(values) / len(values))
+    return res
+
+
+METRIC_RE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+
+
+def scrape_metrics(url):
+    """Sums and counts of the histograms homu exports, by name and
+    labels."""
+    try:
+        res = requests.get(url + '/metrics')
+        res.raise_for_status()
+    except requests.exceptions.RequestException:
+        return {}
+
+    series = {}
+    for line in res.text.splitlines():
+        match = METRIC_RE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        for suffix in ('_sum', '_count'):
+            if name.endswith(suffix):
+                key = name[:-len(suffix)] + ('{' + labels + '}'
+                                             if labels else '')
+                series.setdefault(key, {})[suffix[1:]] = float(value)
+
+    return {
+        key: dict(value, mean=value['sum'] / value['count'])
+        for key, value in series.items()
+        if value.get('count')
+    }
+
+
+def report(args, github, ci, driver, elapsed, startup, homu_url):
+    deliveries = github.webhooks.deliveries
+    failed = sum(1 for _, _, status in deliveries if status != 200)
+    calls = sorted(github.calls.items(), key=lambda item: -item[1])
+    merges = len(driver.latencies)
+
+    return {
+        'settings': vars(args),
+        'startup_seconds': startup,
+        'events': dict(driver.events),
+        'webhooks': {
+            'delivered': len(deliveries),
+            'failed': failed,
+            'per_second': len(deliveries) / elapsed,
+            'accept_seconds': distribution([seconds for _, seconds, _
+                                            in deliveries]),
+            'by_event': dict(Counter(event for event, _, _ in deliveries)),
+        },
+        'builds': {'{} {}'.format(branch, 'success' if success else
+                                  'failure'): count
+                   for (branch, success), count in ci.builds.items()},
+        'merges': {
+            'count': merges,
+            'per_hour': merges / elapsed * 3600,
+            'approval_to_merge_seconds': distribution(driver.latencies),
+            'still_approved': len(driver.approved),
+        },
+        'api_calls': {
+            'total': sum(github.calls.values()),
+            'per_merge': (sum(github.calls.values()) / merges
+                          if merges else None),
+            'by_endpoint': {'{} {}'.format(method, endpoint): count
+                            for (method, endpoint), count in calls},
+        },
+        'homu_metrics': scrape_metrics(homu_url),
+    }
+
+
+def print_report(res):
+    webhooks = res['webhooks']
+    merges = res['merges']
+    print('Started and synchronized in {:.1f}s'.format(res['startup_seconds']))  # noqa
+    print('Events: {}'.format(', '.join(
+        '{} {}'.format(count, kind) for kind, count in res['events'].items())))
+    print('Webhooks: {} delivered ({:.1f}/s), {} failed'.format(
+        webhooks['delivered'], webhooks['per_second'], webhooks['failed']))
+    print_distribution('  accepted in', webhooks['accept_seconds'])
+    print('Builds: {}'.format(', '.join(
+        '{} {}'.format(count, kind)
+        for kind, count in sorted(res['builds'].items()))))
+    print('Merges: {} ({:.1f}/hour), {} approved left'.format(
+        merges['count'], merges['per_hour'], merges['still_approved']))
+    print_distribution('  approval to merge',
+                       merges['approval_to_merge_seconds'])
+    api = res['api_calls']
+    print('GitHub API calls: {}{}'.format(
+        api['total'],
+        ' ({:.1f} per merge)'.format(api['per_merge'])
+        if api['per_merge'] else ''))
+    for endpoint, count in api['by_endpoint'].items():
+        print('  {:>7} {}'.format(count, endpoint))
+    print('homu metrics (count, mean):')
+    for key, value in sorted(res['homu_metrics'].items()):
+        print('  {:>7} {:>9.4f}s {}'.format(int(value['count']),
+                                            value['mean'], key))
+
+
+def print_distribution(title, values):
+    if not values['count']:
+        print('{}: -'.format(title))
+        return
+    print('{}: {}, max {:.3f}s'.format(title, ', '.join(
+        'p{} {:.3f}s'.format(p, values['p{}'.format(p)])
+        for p in PERCENTILES), values['max']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--duration', type=float, default=300,
+                        help='seconds of replayed events')
+    parser.add_argument('--rate', type=float, default=1,
+                        help='events per second')
+    parser.add_argument('--pulls', type=int, default=100,
+                        help='pull requests open before homu starts')
+    parser.add_argument('--drain', type=float, default=300,
+                        help='seconds to wait for the approved pull '
+                             'requests to be merged afterwards')
+    parser.add_argument('--ci-delay', type=float, default=10,
+                        help='mean duration of the builds, in seconds')
+    parser.add_argument('--ci-jitter', type=float, default=2)
+    parser.add_argument('--ci-failure-rate', type=float, default=0.1)
+    parser.add_argument('--checks', action='store_true',
+                        help='also report builds as check runs')
+    parser.add_argument('--api-latency', type=float, default=0.05,
+                        help='seconds added to each GitHub API call')
+    parser.add_argument('--webhook-workers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    github = FakeGitHub(BOT, REVIEWERS, latency=args.api_latency)
+    repo = github.create_repo(OWNER, NAME, SECRET)
+    ci = FakeCI(github, delay=args.ci_delay, jitter=args.ci_jitter,
+                failure_rate=args.ci_failure_rate, checks=args.checks,
+                rng=rng)
+    github.merge_listeners.append(ci.on_merge)
+    driver = Driver(github, repo, rng)
+
+    for _ in range(args.pulls):
+        pull = driver.open(notify=False)
+        if rng.random() < 0.2:
+            driver.approve(pull, notify=False)
+
+    port = free_port()
+    homu_url = 'http://127.0.0.1:{}'.format(port)
+    github.start(homu_url + '/github', args.webhook_workers)
+
+    directory = tempfile.mkdtemp(prefix='homu-loadtest-')
+    print('homu runs in {}'.format(directory), flush=True)
+    process = start_homu(directory,
+                         homu_config(directory, github, port, args.checks))
+    try:
+        started = time.monotonic()
+        wait_ready(process, homu_url)
+        startup = time.monotonic() - started
+        # The latency of the approvals made before homu started counts from
+        # when it is ready
+        now = time.time()
+        for num in driver.approved:
+            driver.approved[num] = now
+
+        started = time.monotonic()
+        driver.run(args.rate, args.duration)
+        wait_drained(github, driver, args.drain)
+        elapsed = time.monotonic() - started
+
+        res = report(args, github, ci, driver, elapsed, startup,
+                     homu_url)
+    finally:
+        process.terminate()
+        process.wait()
+        github.stop()
+
+    print_report(res)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(res, fp, indent=2)
+            fp.write('\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,7 @@
 import requests
 
+from . import metrics
+
 RUST_TEAM_BASE = "https://team-api.infra.rust-lang.org/v1/"
 RETRIES = 5
 
@@ -20,6 +22,7 @@ def fetch_rust_team(repo_label, level):
     return []
 
 
+@metrics.operation('verify_level')
 def verify_level(username, user_id, repo_label, repo_cfg, state, toml_keys,
                  rust_team_level):
     authorized = False
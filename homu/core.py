@@ -0,0 +1,209 @@
+import collections
+import contextvars
+import functools
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import Future
+from threading import Condition, Thread, local
+
+DEFAULT_WORKERS = 8
+
+
+class Core:
+    """Owns the pull request state tables.
+
+    Webhooks, queue runs, scheduled callbacks and synchronizations all read
+    and mutate the same states. Rather than letting each of their threads
+    touch them whenever it likes, they are submitted to the core, which runs
+    them one at a time, in the order they were submitted. The handlers
+    themselves are regular blocking code (github3, git), so they run on a
+    bounded set of worker threads, which take turns holding the core.
+
+    Handlers give the core back while they wait on something that doesn't
+    touch the states (`sleep`, requests to GitHub, git) by running it in a
+    `released` block, and other handlers run in the meantime. So the core
+    only serializes what handlers do between two such waits: after one, the
+    states may have changed, and a handler has to check again what it read
+    before acting on it (see `PullSnapshot` in homu.main).
+
+    The workers are plain daemon threads rather than a ThreadPoolExecutor:
+    executors stop accepting work once the main thread is done, which in homu
+    happens right after starting up.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self._local = local()
+        self._cond = Condition()
+        self._pending = collections.deque()
+        # The core is held in the order of the tickets, taken by the handlers
+        # as they start and whenever they want it back
+        self._next_ticket = 0
+        self._serving = 0
+
+    def start(self):
+        for i in range(self.workers):
+            Thread(target=self._work, name='core-{}'.format(i),
+                   daemon=True).start()
+
+    def in_core(self):
+        return getattr(self._local, 'active', False)
+
+    def submit(self, fn, *args):
+        """Run `fn(*args)` on the core and return a future of its result."""
+        # The handler runs in the context of its caller, e.g. to attribute
+        # the GitHub requests it makes
+        future = Future()
+        with self._cond:
+            self._pending.append((future, fn, args,
+                                  contextvars.copy_context()))
+            self._cond.notify_all()
+        return future
+
+    def call(self, fn, *args):
+        """Run `fn(*args)` on the core and wait for its result.
+
+        Calls made from a handler that is already running on the core are
+        run directly.
+        """
+        if self.in_core():
+            return fn(*args)
+        return self.submit(fn, *args).result()
+
+    def dispatch(self, fn, *args):
+        """Run `fn(*args)` on the core without waiting for it."""
+        self.submit(fn, *args).add_done_callback(_report_error(fn))
+
+    @contextmanager
+    def released(self):
+        """Give the core to the other handlers while the block runs, and wait
+        for it back afterwards. The states may change in the meantime."""
+        if not self.in_core():
+            yield
+            return
+
+        self._release()
+        try:
+            yield
+        finally:
+            self._acquire()
+
+    def sleep(self, seconds):
+        """Wait without holding up the other handlers."""
+        with self.released():
+            time.sleep(seconds)
+
+    def clock(self):
+        """Like time.perf_counter, but stopped while the calling thread
+        waits for the core, i.e. while the other handlers run."""
+        now = getattr(self._local, 'waiting', None) or time.perf_counter()
+        return now - getattr(self._local, 'waited', 0)
+
+    def _acquire(self):
+        self._local.waiting = time.perf_counter()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while self._serving != ticket:
+                self._cond.wait()
+        self._local.waited = (getattr(self._local, 'waited', 0) +
+                              time.perf_counter() - self._local.waiting)
+        self._local.waiting = None
+        self._local.active = True
+
+    def _release(self):
+        self._local.active = False
+        with self._cond:
+            self._serving += 1
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                future, fn, args, context = self._pending.popleft()
+                # The ticket is taken along with the handler, so that
+                # handlers get the core in the order they were submitted
+                self._acquire()
+
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = context.run(fn, *args)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                self._release()
+
+
+def _report_error(fn):
+    def done(future):
+        if future.cancelled() or future.exception() is None:
+            return
+
+        exc = future.exception()
+        print('* Error in {!r}'.format(fn), file=sys.stderr)
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+    return done
+
+
+_core = None
+
+
+def start(workers=DEFAULT_WORKERS):
+    global _core
+    _core = Core(workers)
+    _core.start()
+
+
+# Without a started core, e.g. in tests and tools, everything runs directly on
+# the calling thread.
+
+def call(fn, *args):
+    if _core is None:
+        return fn(*args)
+    return _core.call(fn, *args)
+
+
+def dispatch(fn, *args):
+    if _core is None:
+        fn(*args)
+    else:
+        _core.dispatch(fn, *args)
+
+
+def sleep(seconds):
+    if _core is None:
+        time.sleep(seconds)
+    else:
+        _core.sleep(seconds)
+
+
+def clock():
+    if _core is None:
+        return time.perf_counter()
+    return _core.clock()
+
+
+@contextmanager
+def released():
+    if _core is None:
+        yield
+    else:
+        with _core.released():
+            yield
+
+
+def releasing(fn):
+    """`fn`, giving the core back while it runs."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with released():
+            return fn(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,151 @@
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from . import health
+from . import metrics
+
+db_query_lock = Lock()
+
+
+@contextmanager
+def locked():
+    start = time.perf_counter()
+    with db_query_lock:
+        metrics.db_lock_wait_seconds.observe(time.perf_counter() - start)
+        yield
+
+
+def db_query(db, *args):
+    start = time.perf_counter()
+    with locked():
+        db.execute(*args)
+    health.db_write(time.perf_counter() - start)
+
+
+def db_fetchone(db, *args):
+    with locked():
+        db.execute(*args)
+        return db.fetchone()
+
+
+def columns(db, table):
+    db.execute('PRAGMA table_info({})'.format(table))
+    return {row[1] for row in db.fetchall()}
+
+
+# Migrations are applied in order, each one exactly once. The index of the
+# last applied migration is stored in the `user_version` pragma of the
+# database. Never edit or reorder a migration that was already released:
+# append a new one instead.
+
+def create_tables(db):
+    # Databases created before versioning was introduced already have (some
+    # of) these tables, so this migration has to cope with that.
+    db.execute('''CREATE TABLE IF NOT EXISTS pull (
+        repo TEXT NOT NULL,
+        num INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        merge_sha TEXT,
+        title TEXT,
+        body TEXT,
+        head_sha TEXT,
+        head_ref TEXT,
+        base_ref TEXT,
+        assignee TEXT,
+        approved_by TEXT,
+        priority INTEGER,
+        try_ INTEGER,
+        rollup INTEGER,
+        squash INTEGER,
+        delegate TEXT,
+        UNIQUE (repo, num)
+    )''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS build_res (
+        repo TEXT NOT NULL,
+        num INTEGER NOT NULL,
+        builder TEXT NOT NULL,
+        res INTEGER,
+        url TEXT NOT NULL,
+        merge_sha TEXT NOT NULL,
+        UNIQUE (repo, num, builder)
+    )''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS mergeable (
+        repo TEXT NOT NULL,
+        num INTEGER NOT NULL,
+        mergeable INTEGER NOT NULL,
+        UNIQUE (repo, num)
+    )''')
+    db.execute('''CREATE TABLE IF NOT EXISTS repos (
+        repo TEXT NOT NULL,
+        treeclosed INTEGER NOT NULL,
+        treeclosed_src TEXT,
+        UNIQUE (repo)
+    )''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS retry_log (
+        repo TEXT NOT NULL,
+        num INTEGER NOT NULL,
+        time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        src TEXT NOT NULL,
+        msg TEXT NOT NULL
+    )''')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS retry_log_time_index ON retry_log
+        (repo, time DESC)
+    ''')
+
+    if 'treeclosed_src' not in columns(db, 'repos'):
+        db.execute('ALTER TABLE repos ADD COLUMN treeclosed_src TEXT')
+    if 'squash' not in columns(db, 'pull'):
+        db.execute('ALTER TABLE pull ADD COLUMN squash INT')
+
+
+def add_lookup_indexes(db):
+    db.execute('CREATE INDEX pull_status_index ON pull (repo, status)')
+    db.execute('CREATE INDEX pull_merge_sha_index ON pull (merge_sha)')
+    db.execute('CREATE INDEX build_res_merge_sha_index ON build_res (merge_sha)')  # noqa
+
+
+def add_test_started(db):
+    db.execute('ALTER TABLE pull ADD COLUMN test_started REAL')
+
+
+def add_retry_log_user(db):
+    db.execute('ALTER TABLE retry_log ADD COLUMN user TEXT')
+    db.execute('CREATE INDEX retry_log_num_index ON retry_log (repo, num, time DESC)')  # noqa
+    db.execute('CREATE INDEX retry_log_user_index ON retry_log (repo, user, time DESC)')  # noqa
+
+
+MIGRATIONS = [
+    create_tables,
+    add_lookup_indexes,
+    add_test_started,
+    add_retry_log_user,
+]
+
+
+def migrate(db, logger=None):
+    """Bring the database schema up to date, running only the pending
+    migrations."""
+    with db_query_lock:
+        db.execute('PRAGMA user_version')
+        version, = db.fetchone()
+
+        for version, migration in enumerate(MIGRATIONS[version:],
+                                            version + 1):
+            if logger:
+                logger.info('Migrating the database to version {} ({})'
+                            .format(version, migration.__name__))
+
+            db.execute('BEGIN')
+            try:
+                migration(db)
+                # PRAGMA doesn't support parameters
+                db.execute('PRAGMA user_version = {:d}'.format(version))
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
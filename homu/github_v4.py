@@ -0,0 +1,303 @@
+import requests
+
+from . import metrics
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+# Number of pull requests fetched per GraphQL request. Every pull request
+# carries its comments along, so keep the page small enough to stay well below
+# GitHub's node limit.
+DEFAULT_PAGE_SIZE = 50
+
+COMMENT_FIELDS = '''
+    fragment CommentFields on Comment {
+        body
+        createdAt
+        author {
+            login
+            ... on User { databaseId }
+            ... on Bot { databaseId }
+        }
+    }
+'''
+
+PULL_REQUESTS_QUERY = COMMENT_FIELDS + '''
+    query ($owner: String!, $name: String!, $after: String, $pageSize: Int!) {
+        repository(owner: $owner, name: $name) {
+            pullRequests(states: OPEN, first: $pageSize, after: $after) {
+                pageInfo { hasNextPage endCursor }
+                nodes {
+                    number
+                    title
+                    body
+                    headRefOid
+                    headRefName
+                    headRepositoryOwner { login }
+                    baseRefName
+                    assignees(first: 1) { nodes { login } }
+                    labels(first: 100) {
+                        pageInfo { hasNextPage endCursor }
+                        nodes { name }
+                    }
+                    commits(last: 1) {
+                        nodes {
+                            commit {
+                                status { context(name: "homu") { state } }
+                            }
+                        }
+                    }
+                    comments(first: 100) {
+                        pageInfo { hasNextPage endCursor }
+                        nodes { ...CommentFields url }
+                    }
+                    reviews(first: 20) {
+                        pageInfo { hasNextPage endCursor }
+                        nodes {
+                            id
+                            comments(first: 50) {
+                                pageInfo { hasNextPage endCursor }
+                                nodes {
+                                    ...CommentFields
+                                    url
+                                    originalCommit { oid }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+'''
+
+ISSUE_COMMENTS_QUERY = COMMENT_FIELDS + '''
+    query ($owner: String!, $name: String!, $number: Int!, $after: String) {
+        repository(owner: $owner, name: $name) {
+            pullRequest(number: $number) {
+                comments(first: 100, after: $after) {
+                    pageInfo { hasNextPage endCursor }
+                    nodes { ...CommentFields url }
+                }
+            }
+        }
+    }
+'''
+
+LABELS_QUERY = '''
+    query ($owner: String!, $name: String!, $number: Int!, $after: String) {
+        repository(owner: $owner, name: $name) {
+            pullRequest(number: $number) {
+                labels(first: 100, after: $after) {
+                    pageInfo { hasNextPage endCursor }
+                    nodes { name }
+                }
+            }
+        }
+    }
+'''
+
+REVIEW_COMMENTS_QUERY = COMMENT_FIELDS + '''
+    query ($owner: String!, $name: String!, $number: Int!, $after: String) {
+        repository(owner: $owner, name: $name) {
+            pullRequest(number: $number) {
+                reviews(first: 20, after: $after) {
+                    pageInfo { hasNextPage endCursor }
+                    nodes {
+                        id
+                        comments(first: 50) {
+                            pageInfo { hasNextPage endCursor }
+                            nodes {
+                                ...CommentFields
+                                url
+                                originalCommit { oid }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+'''
+
+REVIEW_MORE_COMMENTS_QUERY = COMMENT_FIELDS + '''
+    query ($id: ID!, $after: String) {
+        node(id: $id) {
+            ... on PullRequestReview {
+                comments(first: 100, after: $after) {
+                    pageInfo { hasNextPage endCursor }
+                    nodes {
+                        ...CommentFields
+                        url
+                        originalCommit { oid }
+                    }
+                }
+            }
+        }
+    }
+'''
+
+
+class GitHubV4Error(Exception):
+    pass
+
+
+class Comment:
+    def __init__(self, info):
+        author = info.get('author') or {}
+
+        self.body = info['body']
+        self.created_at = info['createdAt']
+        self.html_url = info['url']
+        self.login = author.get('login', 'ghost')
+        self.user_id = author.get('databaseId')
+        original_commit = info.get('originalCommit') or {}
+        self.original_commit_id = original_commit.get('oid')
+
+
+class PullRequest:
+    def __init__(self, info):
+        # The owner is gone with the head repository once it is deleted
+        head_owner = info.get('headRepositoryOwner') or {'login': 'ghost'}
+        assignees = info['assignees']['nodes']
+        commits = info['commits']['nodes']
+
+        self.number = info['number']
+        self.title = info['title']
+        self.body = info['body']
+        self.head_sha = info['headRefOid']
+        self.head_ref = '{}:{}'.format(head_owner['login'],
+                                       info['headRefName'])
+        self.base_ref = info['baseRefName']
+        self.assignee = assignees[0]['login'] if assignees else ''
+        # The first page of them, the others are fetched afterwards
+        self.labels = {label['name'] for label in info['labels']['nodes']}
+
+        self.status = ''
+        if commits:
+            status = commits[0]['commit']['status'] or {}
+            context = status.get('context')
+            if context:
+                self.status = context['state'].lower()
+
+        self.issue_comments = []
+        self.review_comments = []
+
+
+class GitHubV4:
+    """Minimal client for the GitHub GraphQL API.
+
+    Only the queries needed to bulk-load the open pull requests of a
+    repository during synchronization are implemented. `api_url` can point to
+    a local server standing in for GitHub.
+    """
+
+    def __init__(self, access_token, api_url=GRAPHQL_URL, *,
+                 page_size=DEFAULT_PAGE_SIZE):
+        self.api_url = api_url
+        self.page_size = page_size
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'bearer ' + access_token
+        metrics.instrument_session(self.session)
+
+    def query(self, query, variables):
+        res = self.session.post(self.api_url, json={
+            'query': query,
+            'variables': variables,
+        })
+        res.raise_for_status()
+
+        js = res.json()
+        if js.get('errors'):
+            raise GitHubV4Error('; '.join(err.get('message', '')
+                                          for err in js['errors']))
+        return js['data']
+
+    def iter_pull_requests(self, owner, name):
+        """Yield every open pull request of a repository, with comments.
+
+        Comments that did not fit in the bulk query are fetched with follow-up
+        queries for the affected pull request only.
+        """
+        after = None
+        while True:
+            data = self.query(PULL_REQUESTS_QUERY, {
+                'owner': owner,
+                'name': name,
+                'after': after,
+                'pageSize': self.page_size,
+            })
+            pulls = data['repository']['pullRequests']
+
+            for info in pulls['nodes']:
+                pull = PullRequest(info)
+                pull.labels = self._labels(owner, name, info)
+                pull.issue_comments = self._issue_comments(owner, name, info)
+                pull.review_comments = self._review_comments(owner, name, info)
+                yield pull
+
+            if not pulls['pageInfo']['hasNextPage']:
+                break
+            after = pulls['pageInfo']['endCursor']
+
+    def _labels(self, owner, name, info):
+        connection = info['labels']
+        nodes = list(connection['nodes'])
+
+        while connection['pageInfo']['hasNextPage']:
+            data = self.query(LABELS_QUERY, {
+                'owner': owner,
+                'name': name,
+                'number': info['number'],
+                'after': connection['pageInfo']['endCursor'],
+            })
+            connection = data['repository']['pullRequest']['labels']
+            nodes += connection['nodes']
+
+        return {node['name'] for node in nodes}
+
+    def _issue_comments(self, owner, name, info):
+        connection = info['comments']
+        nodes = list(connection['nodes'])
+
+        while connection['pageInfo']['hasNextPage']:
+            data = self.query(ISSUE_COMMENTS_QUERY, {
+                'owner': owner,
+                'name': name,
+                'number': info['number'],
+                'after': connection['pageInfo']['endCursor'],
+            })
+            connection = data['repository']['pullRequest']['comments']
+            nodes += connection['nodes']
+
+        return [Comment(node) for node in nodes]
+
+    def _review_comments(self, owner, name, info):
+        connection = info['reviews']
+        reviews = list(connection['nodes'])
+
+        while connection['pageInfo']['hasNextPage']:
+            data = self.query(REVIEW_COMMENTS_QUERY, {
+                'owner': owner,
+                'name': name,
+                'number': info['number'],
+                'after': connection['pageInfo']['endCursor'],
+            })
+            connection = data['repository']['pullRequest']['reviews']
+            reviews += connection['nodes']
+
+        nodes = []
+        for review in reviews:
+            connection = review['comments']
+            nodes += connection['nodes']
+
+            while connection['pageInfo']['hasNextPage']:
+                data = self.query(REVIEW_MORE_COMMENTS_QUERY, {
+                    'id': review['id'],
+                    'after': connection['pageInfo']['endCursor'],
+                })
+                connection = data['node']['comments']
+                nodes += connection['nodes']
+
+        comments = [Comment(node) for node in nodes]
+        comments.sort(key=lambda comment: comment.created_at)
+        return comments
@@ -0,0 +1,163 @@
+"""What the `/health/live` and `/health/ready` endpoints report.
+
+An instance is live as long as it answers. It is ready when it has caught
+up with GitHub: its states are loaded from the database, the
+synchronizations started with it are done, webhooks are handled soon after
+they arrive, the mergeability checks aren't far behind and writing to the
+database is quick. The thresholds are set in `[web.health]`.
+"""
+
+import collections
+import itertools
+import time
+from threading import Lock
+
+from . import tracing
+
+DEFAULT_MAX_EVENT_LAG = 60
+DEFAULT_MAX_MERGEABLE_LAG = 600
+DEFAULT_MAX_DB_WRITE = 1.0
+
+# How long the durations of the database writes are remembered
+DB_WRITE_WINDOW = 300
+
+
+class Health:
+    def __init__(self):
+        self._lock = Lock()
+        self._loaded = None
+        # repo_label -> state of its synchronizations
+        self._syncs = {}
+        # Webhooks waiting for the core: token -> when they arrived
+        self._events = collections.OrderedDict()
+        self._tokens = itertools.count()
+        # (when, seconds) of the recent database writes
+        self._db_writes = collections.deque()
+
+    def loaded(self, pull_requests, seconds):
+        with self._lock:
+            self._loaded = {'pull_requests': pull_requests,
+                            'seconds': seconds}
+
+    def sync_pending(self, repo_label):
+        """A synchronization of `repo_label` has to happen before homu is
+        ready."""
+        with self._lock:
+            self._syncs.setdefault(repo_label, {'state': 'pending',
+                                                'since': time.time(),
+                                                'synchronized': None})
+
+    def sync_started(self, repo_label):
+        self._set_sync(repo_label, 'running')
+
+    def sync_done(self, repo_label):
+        self._set_sync(repo_label, 'done', synchronized=time.time())
+
+    def sync_failed(self, repo_label):
+        self._set_sync(repo_label, 'failed')
+
+    def _set_sync(self, repo_label, state, **attrs):
+        with self._lock:
+            sync = self._syncs.setdefault(repo_label, {'synchronized': None})
+            sync.update(attrs, state=state, since=time.time())
+
+    def event_received(self):
+        with self._lock:
+            token = next(self._tokens)
+            self._events[token] = time.time()
+            return token
+
+    def event_started(self, token):
+        with self._lock:
+            self._events.pop(token, None)
+
+    def event_lag(self):
+        """How long the oldest webhook waiting for the core has waited."""
+        with self._lock:
+            if not self._events:
+                return 0
+            return time.time() - next(iter(self._events.values()))
+
+    def db_write(self, seconds):
+        now = time.time()
+        with self._lock:
+            self._db_writes.append((now, seconds))
+            while self._db_writes[0][0] < now - DB_WRITE_WINDOW:
+                self._db_writes.popleft()
+
+    def report(self, mergeable_que=None, cfg=None):
+        cfg = cfg or {}
+        now = time.time()
+        with self._lock:
+            loaded = self._loaded
+            syncs = {repo_label: dict(sync)
+                     for repo_label, sync in self._syncs.items()}
+            pending_events = len(self._events)
+            db_writes = sorted(seconds for when, seconds in self._db_writes
+                               if when >= now - DB_WRITE_WINDOW)
+        event_lag = self.event_lag()
+
+        reasons = []
+        if loaded is None:
+            reasons.append('the pull requests are being loaded')
+        for repo_label, sync in sorted(syncs.items()):
+            if sync['synchronized'] is None:
+                reasons.append('{} is not synchronized yet ({})'.format(
+                    repo_label, sync['state']))
+
+        max_event_lag = cfg.get('max_event_lag', DEFAULT_MAX_EVENT_LAG)
+        if event_lag > max_event_lag:
+            reasons.append('webhooks wait for {:.0f}s'.format(event_lag))
+
+        mergeable = {'pending': 0, 'lag': 0}
+        if mergeable_que is not None:
+            mergeable = {'pending': mergeable_que.qsize(),
+                         'lag': queue_lag(mergeable_que)}
+        max_mergeable_lag = cfg.get('max_mergeable_lag',
+                                    DEFAULT_MAX_MERGEABLE_LAG)
+        if mergeable['lag'] > max_mergeable_lag:
+            reasons.append('mergeability checks wait for {:.0f}s'.format(
+                mergeable['lag']))
+
+        db = {'count': len(db_writes)}
+        if db_writes:
+            db.update({'p{}'.format(p): tracing.percentile(db_writes, p)
+                       for p in tracing.PERCENTILES})
+            max_db_write = cfg.get('max_db_write', DEFAULT_MAX_DB_WRITE)
+            if db['p90'] > max_db_write:
+                reasons.append('database writes take {:.3f}s'.format(
+                    db['p90']))
+
+        return {
+            'ready': not reasons,
+            'reasons': reasons,
+            'loaded': loaded,
+            'synchronizations': syncs,
+            'events': {'pending': pending_events, 'lag': event_lag},
+            'mergeability': mergeable,
+            'db_writes': db,
+        }
+
+
+def queue_lag(mergeable_que):
+    """How long the oldest pull request in the mergeability queue has
+    waited."""
+    with mergeable_que.mutex:
+        if not mergeable_que.queue:
+            return 0
+        queued_at = mergeable_que.queue[0][3]
+    return time.time() - queued_at
+
+
+_health = Health()
+
+loaded = _health.loaded
+sync_pending = _health.sync_pending
+sync_started = _health.sync_started
+sync_done = _health.sync_done
+sync_failed = _health.sync_failed
+event_received = _health.event_received
+event_started = _health.event_started
+event_lag = _health.event_lag
+db_write = _health.db_write
+report = _health.report
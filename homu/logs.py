@@ -0,0 +1,195 @@
+"""Logging that stays off the request threads.
+
+Logging a record only builds its message and puts it on a queue: a
+listener thread formats and writes it, so a debug line about a webhook
+costs the handler little more than creating the record. The payloads
+attached to records (webhooks, Buildbot packets) are stripped of their URLs
+and cut down to size by the listener, and only a sample of them is kept if
+configured.
+
+Records can be written as text or as one JSON object per line. Either way
+they carry the id of the event that caused them: the GitHub delivery id of
+a webhook, or a fresh id for other requests. The id follows the event to
+the core, the scheduler and the outbound queue, like the operations of
+`metrics`.
+"""
+
+import contextvars
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+from . import metrics
+
+DEFAULT_QUEUE_SIZE = 10000
+# Characters kept of each string of a payload, and of the whole payload
+DEFAULT_MAX_STRING = 200
+DEFAULT_MAX_PAYLOAD = 4000
+# Items kept of each list of a payload
+DEFAULT_MAX_ITEMS = 20
+
+_event = contextvars.ContextVar('event', default=None)
+
+
+def set_event(event_id=None):
+    """Attribute the records logged from now on in this context to the
+    event `event_id`, or to a new one."""
+    _event.set(event_id or uuid.uuid4().hex[:16])
+
+
+def current_event():
+    return _event.get()
+
+
+class Payload:
+    """A JSON document attached to a record with `extra={'payload': ...}`,
+    only looked at when the record is written."""
+
+    __slots__ = ['data']
+
+    def __init__(self, data):
+        self.data = data
+
+
+def truncate(data, max_string=DEFAULT_MAX_STRING, max_items=DEFAULT_MAX_ITEMS):  # noqa
+    """A copy of `data` without its URLs, and with its strings and lists cut
+    short."""
+    if isinstance(data, dict):
+        return {key: truncate(value, max_string, max_items)
+                for key, value in data.items()
+                if not key.endswith('url')}
+    elif isinstance(data, list):
+        res = [truncate(value, max_string, max_items)
+               for value in data[:max_items]]
+        if len(data) > max_items:
+            res.append('... {} more'.format(len(data) - max_items))
+        return res
+    elif isinstance(data, str) and len(data) > max_string:
+        return data[:max_string] + '... {} more'.format(len(data) - max_string)
+    return data
+
+
+class Formatter(logging.Formatter):
+    def __init__(self, as_json=False, max_string=DEFAULT_MAX_STRING,
+                 max_items=DEFAULT_MAX_ITEMS, max_payload=DEFAULT_MAX_PAYLOAD):
+        super().__init__()
+        self.as_json = as_json
+        self.max_string = max_string
+        self.max_items = max_items
+        self.max_payload = max_payload
+
+    def payload(self, record):
+        """The payload of the record as JSON text, or None."""
+        payload = getattr(record, 'payload', None)
+        if not isinstance(payload, Payload):
+            return None
+
+        text = json.dumps(truncate(payload.data, self.max_string,
+                                   self.max_items), sort_keys=True)
+        if len(text) > self.max_payload:
+            text = text[:self.max_payload] + '... {} more'.format(
+                len(text) - self.max_payload)
+        return text
+
+    def format(self, record):
+        payload = self.payload(record)
+        event = getattr(record, 'event', None)
+
+        if not self.as_json:
+            text = super().format(record)
+            if payload is not None:
+                text += ': ' + payload
+            if event is not None:
+                text = '[{}] {}'.format(event, text)
+            return text
+
+        res = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if event is not None:
+            res['event'] = event
+        if payload is not None:
+            try:
+                res['payload'] = json.loads(payload)
+            except ValueError:
+                # Cut to max_payload
+                res['payload'] = payload
+        if record.exc_info:
+            res['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            res['exc_info'] = record.exc_text
+        return json.dumps(res)
+
+
+_exc_formatter = logging.Formatter()
+
+
+class Handler(QueueHandler):
+    """Puts copies of the records on the queue. Like QueueHandler, the
+    message and the traceback are built here, before the arguments change;
+    unlike it, the payload is only truncated by the listener."""
+
+    def __init__(self, que, payload_sample=1.0):
+        super().__init__(que)
+        self.payload_sample = payload_sample
+
+    def prepare(self, record):
+        msg = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = _exc_formatter.formatException(record.exc_info)
+
+        record = copy.copy(record)
+        record.message = msg
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        record.event = _event.get()
+
+        payload = getattr(record, 'payload', None)
+        if payload is not None:
+            if random.random() >= self.payload_sample:
+                record.payload = None
+            elif isinstance(payload, Payload):
+                record.payload = Payload(copy.copy(payload.data))
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_records_dropped.inc()
+
+
+def setup(logger, cfg, stream=None):
+    """Make `logger` write its records through a queue, as configured by the
+    `[logging]` section. Returns the listener."""
+    formatter = Formatter(
+        as_json=cfg.get('format', 'text') == 'json',
+        max_string=cfg.get('max_string', DEFAULT_MAX_STRING),
+        max_items=cfg.get('max_items', DEFAULT_MAX_ITEMS),
+        max_payload=cfg.get('max_payload', DEFAULT_MAX_PAYLOAD),
+    )
+    output = logging.StreamHandler(sys.stderr if stream is None else stream)
+    output.setFormatter(formatter)
+
+    que = queue.Queue(cfg.get('queue_size', DEFAULT_QUEUE_SIZE))
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(Handler(que, cfg.get('payload_sample', 1.0)))
+    # Not through the handlers of the root logger as well, which waitress
+    # sets up and which would write on the logging thread
+    logger.propagate = False
+
+    listener = QueueListener(que, output)
+    listener.start()
+    return listener
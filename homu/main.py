@@ -1,20 +1,33 @@
 import argparse
+import atexit
 import github3
 import toml
 import json
 import re
 import functools
+import itertools
 from . import comments
+from . import core
+from . import github_v4
+from . import health
+from . import logs
+from . import metrics
+from . import outbound
+from . import scheduler
+from . import shard
+from . import tracing
 from . import utils
+from .db import db_fetchone, db_query, db_query_lock, migrate
 from .parse_issue_comment import parse_issue_comment
 from .auth import verify as verify_auth
 from .utils import lazy_debug
 import logging
-from threading import Thread, Lock, Timer
+from threading import Condition, Thread, Lock
 import time
 import traceback
 import sqlite3
 import requests
+from collections import OrderedDict, deque
 from contextlib import contextmanager
 from queue import Queue
 import os
@@ -38,6 +51,13 @@ STATUS_TO_PRIORITY = {
 INTERRUPTED_BY_HOMU_FMT = 'Interrupted by Homu ({})'
 INTERRUPTED_BY_HOMU_RE = re.compile(r'Interrupted by Homu \((.+?)\)')
 DEFAULT_TEST_TIMEOUT = 3600 * 10
+BODY_CACHE_SIZE = 256
+CHANGE_LOG_SIZE = 1000
+MERGEABILITY_RETRIES = 1
+MERGEABILITY_RETRY_DELAY = 5
+RETRY_LOG_EXPIRE_INTERVAL = 3600
+SYNC_RETRY_DELAY = 2
+SYNC_RETRY_MAX_DELAY = 600
 
 VARIABLES_RE = re.compile(r'\${([a-zA-Z_]+)}')
 
@@ -82,12 +102,60 @@ def buildbot_sess(repo_cfg):
     sess.get(repo_cfg['buildbot']['url'] + '/logout', allow_redirects=False)
 
 
-db_query_lock = Lock()
+class BodyCache:
+    """Small LRU of pull request bodies.
 
+    Bodies are only needed to build merge messages, and some of them are tens
+    of kilobytes, so they are read from the database on demand instead of
+    being kept in memory for every pull request.
+    """
+
+    def __init__(self, size=BODY_CACHE_SIZE):
+        self.size = size
+        self._bodies = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, db, repo_label, num):
+        key = (repo_label, num)
+        with self._lock:
+            if key in self._bodies:
+                self._bodies.move_to_end(key)
+                return self._bodies[key]
+
+        row = db_fetchone(
+            db,
+            'SELECT body FROM pull WHERE repo = ? AND num = ?',
+            [repo_label, num],
+        )
+        body = (row[0] or '') if row else ''
+        self.put(repo_label, num, body)
+        return body
+
+    def put(self, repo_label, num, body):
+        with self._lock:
+            self._bodies[repo_label, num] = body
+            self._bodies.move_to_end((repo_label, num))
+            while len(self._bodies) > self.size:
+                self._bodies.popitem(last=False)
+
+    def discard(self, repo_label, num):
+        with self._lock:
+            self._bodies.pop((repo_label, num), None)
+
+    def usage(self):
+        with self._lock:
+            return (len(self._bodies),
+                    sum(len(body) for body in self._bodies.values()))
 
-def db_query(db, *args):
-    with db_query_lock:
-        db.execute(*args)
+
+body_cache = BodyCache()
+
+# Versions are shared by all the repositories, so that they keep increasing
+# even when a repository is replaced by a synchronization. They start from the
+# current time so that they also keep increasing across restarts.
+_versions = itertools.count(int(time.time() * 1000))
+# Notified on every change, for the live views of the queue
+queue_changed = Condition()
 
 
 class Repository:
@@ -97,11 +165,28 @@ class Repository:
     gh_test_on_fork = None
     label = None
     db = None
+    version = 0
+    changed_at = 0
+    history_start = 0
+
+    def __init__(self, gh, repo_label, db, *, github=None, repo_cfg=None,
+                 mergeable_que=None):
+        repo_cfg = repo_cfg or {}
 
-    def __init__(self, gh, repo_label, db):
         self.gh = gh
         self.repo_label = repo_label
         self.db = db
+        # Context shared by all the pull requests of this repository
+        self.github = github
+        self.owner = repo_cfg.get('owner')
+        self.name = repo_cfg.get('name')
+        self.label_events = repo_cfg.get('labels', {})
+        self.test_on_fork = repo_cfg.get('test-on-fork')
+        self.mergeable_que = mergeable_que
+        # The latest changes, as (version, pull request number)
+        self.change_log = deque(maxlen=CHANGE_LOG_SIZE)
+        # Changes are known from this version onwards
+        self.history_start = self.changed()
         db_query(
             db,
             'SELECT treeclosed, treeclosed_src FROM repos WHERE repo = ?',
@@ -115,9 +200,37 @@ class Repository:
             self.treeclosed = -1
             self.treeclosed_src = None
 
+    def changed(self, num=None):
+        """Record a change to a pull request of this repository (including its
+        removal), or to the whole repository when `num` is None. Cached views
+        of the queue are rebuilt when the version changes, and live views are
+        notified."""
+        self.version = next(_versions)
+        self.changed_at = time.time()
+        self.change_log.append((self.version, num))
+
+        with queue_changed:
+            queue_changed.notify_all()
+
+        return self.version
+
+    def changes_known_since(self, version):
+        """Whether every change after `version` can still be listed."""
+        if version < self.history_start:
+            return False
+        log = list(self.change_log)
+        if len(log) == self.change_log.maxlen and version < log[0][0]:
+            return False
+        return True
+
+    def changes_since(self, version):
+        return [change for change in list(self.change_log)
+                if change[0] > version]
+
     def update_treeclosed(self, value, src):
         self.treeclosed = value
         self.treeclosed_src = src
+        self.changed()
         db_query(
             self.db,
             'DELETE FROM repos where repo = ?',
@@ -133,42 +246,132 @@ class Repository:
                 [self.repo_label, value, src]
             )
 
+    def get_repo(self):
+        repo = self.gh
+        if not repo:
+            repo = self.gh = self.github.repository(self.owner, self.name)
+
+            assert repo.owner.login == self.owner
+            assert repo.name == self.name
+        return repo
+
+    def get_test_on_fork_repo(self):
+        if not self.test_on_fork:
+            return None
+
+        repo = self.gh_test_on_fork
+        if not repo:
+            repo = self.gh_test_on_fork = self.github.repository(
+                self.test_on_fork['owner'],
+                self.test_on_fork['name'],
+            )
+
+            assert repo.owner.login == self.test_on_fork['owner']
+            assert repo.name == self.test_on_fork['name']
+        return repo
+
     def __lt__(self, other):
         return self.gh < other.gh
 
 
 class PullReqState:
-    num = 0
-    priority = 0
-    rollup = 0
-    squash = False
-    title = ''
-    body = ''
-    head_ref = ''
-    base_ref = ''
-    assignee = ''
-    delegate = ''
-
-    def __init__(self, num, head_sha, status, db, repo_label, mergeable_que,
-                 gh, owner, name, label_events, repos, test_on_fork):
+    # There can be tens of thousands of these alive at once, so keep them
+    # compact: everything shared by the pull requests of a repository lives
+    # on the Repository, and no GitHub objects are cached here.
+    __slots__ = [
+        'repository',
+        'num',
+        'priority',
+        'rollup',
+        'squash',
+        'title',
+        '_body',
+        'head_ref',
+        'base_ref',
+        'assignee',
+        'delegate',
+        'head_sha',
+        'approved_by',
+        'status',
+        'merge_sha',
+        'build_res',
+        'try_',
+        'mergeable',
+        'timeout_timer',
+        'test_started',
+        'labels',
+        'author_login',
+        'fake_merge_sha',
+        'interrupt_token',
+        'version',
+        '__weakref__',
+    ]
+
+    def __init__(self, num, head_sha, status, repository):
         self.head_advanced('', use_db=False)
 
+        self.repository = repository
         self.num = num
         self.head_sha = head_sha
         self.status = status
-        self.db = db
-        self.repo_label = repo_label
-        self.mergeable_que = mergeable_que
-        self.gh = gh
-        self.owner = owner
-        self.name = name
-        self.repos = repos
+        self.priority = 0
+        self.rollup = 0
+        self.squash = False
+        self.title = ''
+        self._body = ''
+        self.head_ref = ''
+        self.base_ref = ''
+        self.assignee = ''
+        self.delegate = ''
         self.timeout_timer = None
         self.test_started = time.time()
-        self.label_events = label_events
-        self.test_on_fork = test_on_fork
+        self.labels = None
+        self.author_login = None
+        self.fake_merge_sha = None
+        self.interrupt_token = ''
+        self.version = 0
+
+    @property
+    def repo_label(self):
+        return self.repository.repo_label
+
+    @property
+    def owner(self):
+        return self.repository.owner
+
+    @property
+    def name(self):
+        return self.repository.name
+
+    @property
+    def db(self):
+        return self.repository.db
+
+    @property
+    def label_events(self):
+        return self.repository.label_events
+
+    @property
+    def test_on_fork(self):
+        return self.repository.test_on_fork
+
+    @property
+    def body(self):
+        # `_body` holds bodies that haven't been saved yet; saved ones are
+        # loaded from the database when needed.
+        if self._body is not None:
+            return self._body
+        return body_cache.get(self.db, self.repo_label, self.num)
+
+    @body.setter
+    def body(self, body):
+        self._body = body or ''
 
     def head_advanced(self, head_sha, *, use_db=True):
+        if use_db and self.approved_by:
+            tracing.record('unapproval', self, time.time())
+        tracing.forget(self)
+
         self.head_sha = head_sha
         self.approved_by = ''
         self.status = ''
@@ -209,19 +412,57 @@ class PullReqState:
         return self.sort_key() < other.sort_key()
 
     def get_issue(self):
-        issue = getattr(self, 'issue', None)
-        if not issue:
-            issue = self.issue = self.get_repo().issue(self.num)
-        return issue
+        return self.get_repo().issue(self.num)
 
     def add_comment(self, comment):
         if isinstance(comment, comments.Comment):
             comment = "%s\n<!-- homu: %s -->" % (
                 comment.render(), comment.jsonify(),
             )
-        self.get_issue().create_comment(comment)
+        outbound.submit(
+            (self.repo_label, self.num),
+            lambda: utils.github_create_comment(self.get_repo(), self.num,
+                                                comment),
+            description='comment on {}'.format(self),
+            # Sending it again could post it twice
+            idempotent=False,
+        )
+
+    def create_status(self, state, target_url, description, *, sha=None):
+        # Only the latest status of a commit is visible on GitHub, so older
+        # ones that haven't been sent yet are dropped.
+        sha = sha or self.head_sha
+        outbound.submit(
+            (self.repo_label, self.num),
+            lambda: utils.github_create_status(self.get_repo(), sha, state,
+                                               target_url, description,
+                                               context='homu'),
+            coalesce=(self.repo_label, sha, 'homu'),
+            description='{} status for {}'.format(state, sha),
+        )
+
+    def get_labels(self):
+        # The cache is kept up to date by the `labeled` and `unlabeled`
+        # webhook events, so GitHub only needs to be asked once.
+        if self.labels is None:
+            self.labels = {
+                label.name
+                for label in utils.github_iter_labels(self.get_repo(),
+                                                      self.num)
+            }
+        return self.labels
 
     def change_labels(self, event):
+        outbound.submit(
+            (self.repo_label, self.num),
+            lambda: self._change_labels(event),
+            description='{} labels on {}'.format(event.value, self),
+        )
+
+    @metrics.operation('labels')
+    def _change_labels(self, event):
+        # This runs on an outbound worker: the cache is read and updated on
+        # the core, which the labeled and unlabeled webhooks update as well
         event = self.label_events.get(event.value, {})
         removes = event.get('remove', [])
         adds = event.get('add', [])
@@ -229,15 +470,34 @@ class PullReqState:
         if not removes and not adds:
             return
 
-        issue = self.get_issue()
-        labels = {label.name for label in issue.iter_labels()}
-        if labels.isdisjoint(unless):
-            labels.difference_update(removes)
-            labels.update(adds)
-            issue.replace_labels(list(labels))
+        labels = set(core.call(self.get_labels))
+        if not labels.isdisjoint(unless):
+            return
+
+        to_remove = labels.intersection(removes).difference(adds)
+        to_add = set(adds) - labels
+        for label in sorted(to_remove):
+            utils.github_remove_label(self.get_repo(), self.num, label)
+        if to_add:
+            utils.github_add_labels(self.get_repo(), self.num, sorted(to_add))
+
+        if to_remove or to_add:
+            core.dispatch(self.labels_changed, to_add, to_remove)
+
+    def labels_changed(self, added=(), removed=()):
+        """Update the cached labels with a change, unless they aren't known
+        yet."""
+        if self.labels is not None:
+            self.labels = (self.labels - set(removed)) | set(added)
+
+    def changed(self):
+        self.version = self.repository.changed(self.num)
 
     def set_status(self, status):
         self.status = status
+        self.changed()
+        if status == '' and (self.approved_by or self.try_):
+            tracing.mark(self, 'queued')
         if self.timeout_timer:
             self.timeout_timer.cancel()
             self.timeout_timer = None
@@ -273,7 +533,8 @@ class PullReqState:
             )
         else:
             if que:
-                self.mergeable_que.put([self, cause])
+                queue_mergeability(self.repository.mergeable_que, self, cause,
+                                   MERGEABILITY_RETRIES)
             else:
                 self.mergeable = None
 
@@ -283,6 +544,8 @@ class PullReqState:
                 [self.repo_label, self.num]
             )
 
+        self.changed()
+
     def init_build_res(self, builders, *, use_db=True):
         self.build_res = {x: {
             'res': None,
@@ -304,6 +567,7 @@ class PullReqState:
             'res': res,
             'url': url,
         }
+        self.changed()
 
         db_query(
             self.db,
@@ -322,42 +586,26 @@ class PullReqState:
                          for builder, data in self.build_res.items())
 
     def get_repo(self):
-        repo = self.repos[self.repo_label].gh
-        if not repo:
-            repo = self.gh.repository(self.owner, self.name)
-            self.repos[self.repo_label].gh = repo
-
-            assert repo.owner.login == self.owner
-            assert repo.name == self.name
-        return repo
+        return self.repository.get_repo()
 
     def get_test_on_fork_repo(self):
-        if not self.test_on_fork:
-            return None
-
-        repo = self.repos[self.repo_label].gh_test_on_fork
-        if not repo:
-            repo = self.gh.repository(
-                self.test_on_fork['owner'],
-                self.test_on_fork['name'],
-            )
-            self.repos[self.repo_label].gh_test_on_fork = repo
-
-            assert repo.owner.login == self.test_on_fork['owner']
-            assert repo.name == self.test_on_fork['name']
-        return repo
+        return self.repository.get_test_on_fork_repo()
 
     def save(self):
+        self.changed()
         db_query(
             self.db,
-            'INSERT OR REPLACE INTO pull (repo, num, status, merge_sha, title, body, head_sha, head_ref, base_ref, assignee, approved_by, priority, try_, rollup, squash, delegate) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',  # noqa
+            'INSERT OR REPLACE INTO pull (repo, num, status, merge_sha, title, body, head_sha, head_ref, base_ref, assignee, approved_by, priority, try_, rollup, squash, delegate, test_started) VALUES (?, ?, ?, ?, ?, COALESCE(?, (SELECT body FROM pull WHERE repo = ? AND num = ?)), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',  # noqa
             [
                 self.repo_label,
                 self.num,
                 self.status,
                 self.merge_sha,
                 self.title,
-                self.body,
+                # Keep the stored body if it hasn't changed
+                self._body,
+                self.repo_label,
+                self.num,
                 self.head_sha,
                 self.head_ref,
                 self.base_ref,
@@ -368,8 +616,13 @@ class PullReqState:
                 self.rollup,
                 self.squash,
                 self.delegate,
+                self.test_started,
             ])
 
+        if self._body is not None:
+            body_cache.put(self.repo_label, self.num, self._body)
+            self._body = None
+
     def refresh(self):
         issue = self.get_repo().issue(self.num)
 
@@ -394,27 +647,34 @@ class PullReqState:
             issue.edit(title=title)
 
     def change_treeclosed(self, value, src):
-        self.repos[self.repo_label].update_treeclosed(value, src)
+        self.repository.update_treeclosed(value, src)
 
     def blocked_by_closed_tree(self):
-        treeclosed = self.repos[self.repo_label].treeclosed
+        treeclosed = self.repository.treeclosed
         return (treeclosed if self.priority < treeclosed else None,
-                self.repos[self.repo_label].treeclosed_src)
+                self.repository.treeclosed_src)
 
     def start_testing(self, timeout):
-        self.test_started = time.time()     # FIXME: Save in the local database
+        self.test_started = time.time()
+        db_query(
+            self.db,
+            'UPDATE pull SET test_started = ? WHERE repo = ? AND num = ?',
+            [self.test_started, self.repo_label, self.num]
+        )
         self.set_status('pending')
+        self.schedule_timeout(timeout)
 
+    def schedule_timeout(self, timeout):
         wm = weakref.WeakMethod(self.timed_out)
 
         def timed_out():
             m = wm()
             if m:
                 m()
-        timer = Timer(timeout, timed_out)
-        timer.start()
-        self.timeout_timer = timer
+        self.timeout_timer = scheduler.call_at(self.test_started + timeout,
+                                               core.dispatch, timed_out)
 
+    @metrics.operation('timeout')
     def timed_out(self):
         print('* Test timed out: {}'.format(self))
 
@@ -422,27 +682,15 @@ class PullReqState:
         self.save()
         self.set_status('failure')
 
-        utils.github_create_status(
-            self.get_repo(),
-            self.head_sha,
-            'failure',
-            '',
-            'Test timed out',
-            context='homu')
+        self.create_status('failure', '', 'Test timed out')
         self.add_comment(comments.TimedOut())
         self.change_labels(LabelEvent.TIMED_OUT)
 
-    def record_retry_log(self, src, body):
-        # destroy ancient records
+    def record_retry_log(self, src, body, user):
         db_query(
             self.db,
-            "DELETE FROM retry_log WHERE repo = ? AND time < date('now', ?)",
-            [self.repo_label, global_cfg.get('retry_log_expire', '-42 days')],
-        )
-        db_query(
-            self.db,
-            'INSERT INTO retry_log (repo, num, src, msg) VALUES (?, ?, ?, ?)',
-            [self.repo_label, self.num, src, body],
+            'INSERT INTO retry_log (repo, num, src, msg, user) VALUES (?, ?, ?, ?, ?)',  # noqa
+            [self.repo_label, self.num, src, body, user],
         )
 
     @property
@@ -450,7 +698,9 @@ class PullReqState:
         """
         Get the GitHub login name of the author of the pull request
         """
-        return self.get_issue().user.login
+        if self.author_login is None:
+            self.author_login = self.get_issue().user.login
+        return self.author_login
 
 
 def sha_cmp(short, full):
@@ -522,6 +772,10 @@ def parse_commands(body, username, user_id, repo_label, repo_cfg, state,
 
     commands = parse_issue_comment(username, body, sha, my_username, hooks)
 
+    # To trace how the place of the pull request in the queue changed
+    queue_settings = (state.approved_by, state.priority, state.rollup)
+    approved = False
+
     for command in commands:
         found = True
         if command.action == 'approve':
@@ -593,6 +847,8 @@ def parse_commands(body, username, user_id, repo_label, repo_cfg, state,
                 state.set_status('')
 
                 state.save()
+
+                approved = True
             elif realtime and username != my_username:
                 if cur_sha:
                     msg = '`{}` is not a valid commit SHA.'.format(cur_sha)
@@ -695,7 +951,7 @@ def parse_commands(body, username, user_id, repo_label, repo_cfg, state,
             state.set_status('')
             if realtime:
                 event = LabelEvent.TRY if state.try_ else LabelEvent.APPROVED
-                state.record_retry_log(command_src, body)
+                state.record_retry_log(command_src, body, username)
                 state.change_labels(event)
 
         elif command.action in ['try', 'untry'] and realtime:
@@ -798,12 +1054,17 @@ def parse_commands(body, username, user_id, repo_label, repo_cfg, state,
                 continue
             state.change_treeclosed(command.treeclosed_value, command_src)
             state.save()
+            if realtime:
+                tracing.record('treeclosed', state, time.time(),
+                               priority=command.treeclosed_value)
 
         elif command.action == 'untreeclosed':
             if not _reviewer_auth_verified():
                 continue
             state.change_treeclosed(-1, None)
             state.save()
+            if realtime:
+                tracing.record('treeclosed', state, time.time(), priority=-1)
 
         elif command.action == 'hook':
             hook = command.hook_name
@@ -827,9 +1088,35 @@ def parse_commands(body, username, user_id, repo_label, repo_cfg, state,
         if found:
             state_changed = True
 
+    if realtime:
+        trace_queue_change(state, queue_settings, approved)
+
     return state_changed
 
 
+def trace_queue_change(state, before, approved):
+    """Record the approvals and changes of priority of the pull request, as
+    the simulator needs them to replay the queue."""
+    approved_by, priority, rollup = before
+    attrs = {
+        'approved_by': state.approved_by,
+        'priority': state.priority,
+        'rollup': state.rollup,
+    }
+    if approved:
+        tracing.record('approval', state, time.time(), **attrs)
+        tracing.mark(state, 'approved')
+    elif approved_by and not state.approved_by:
+        tracing.record('unapproval', state, time.time())
+        if state.try_:
+            tracing.forget(state, 'approved')
+        else:
+            tracing.forget(state)
+    elif state.approved_by and (priority, rollup) != (state.priority,
+                                                      state.rollup):
+        tracing.record('reprioritization', state, time.time(), **attrs)
+
+
 def handle_hook_response(state, hook_cfg, body, extra_data):
     post_data = {}
     post_data["pull"] = state.num
@@ -904,22 +1191,79 @@ def init_local_git_cmds(repo_cfg, git_cfg):
     return lambda *args: ['git', '-C', fpath] + list(args)
 
 
+# Repositories (owner, name) -> lock of their working copy
+git_locks = {}
+git_locks_lock = Lock()
+
+
+@contextmanager
+def local_git(repo_cfg, git_cfg):
+    """The git command line of the working copy of the repository, for the
+    block. Working copies are used by one handler at a time, and the core is
+    given back meanwhile."""
+    with core.released():
+        with git_locks_lock:
+            lock = git_locks.setdefault(
+                (repo_cfg['owner'], repo_cfg['name']), Lock())
+        with lock:
+            yield init_local_git_cmds(repo_cfg, git_cfg)
+
+
 def branch_equal_to_merge(git_cmd, state, branch):
     utils.logged_call(git_cmd('fetch', 'origin',
                               'pull/{}/merge'.format(state.num)))
     return utils.silent_call(git_cmd('diff', '--quiet', 'FETCH_HEAD', branch)) == 0  # noqa
 
 
-def create_merge(state, repo_cfg, branch, logger, git_cfg,
+class PullChanged(Exception):
+    """The pull request changed while its build was being started."""
+
+
+class PullSnapshot:
+    """What a build of a pull request is started from.
+
+    Starting a build gives the core back while it waits for GitHub, git or
+    the delay of create_merge, and the pull request can be pushed to,
+    unapproved, closed or replaced by a synchronization in the meantime.
+    Whatever is done after one of these waits is checked against the
+    snapshot first, and the work done while the core was given back only
+    uses the snapshot.
+    """
+
+    FIELDS = ['head_sha', 'base_ref', 'approved_by', 'try_', 'squash',
+              'status']
+
+    def __init__(self, state, states):
+        self.states = states
+        for field in self.FIELDS:
+            setattr(self, field, getattr(state, field))
+
+    def check(self, state):
+        """Raise PullChanged unless the pull request is as in the snapshot.
+        Must be called on the core."""
+        current = self.states.get(state.repo_label, {}).get(state.num)
+        if current is not state:
+            raise PullChanged('{!r} was closed or synchronized'.format(state))
+
+        changed = [field for field in self.FIELDS
+                   if getattr(state, field) != getattr(self, field)]
+        if changed:
+            raise PullChanged('{!r} changed: {}'.format(state,
+                                                        ', '.join(changed)))
+
+
+def create_merge(state, repo_cfg, branch, logger, git_cfg, pull,
                  ensure_merge_equal=False):
     # Add some delay to try to make sure the base repo fetch is accurate.
     # It seems like in some cases we're getting the previous commit from GH,
     # e.g., https://github.com/rust-lang/homu/issues/75#issuecomment-1729058969
     # Hopefully a delay helps.
-    time.sleep(60)
-    base_sha = state.get_repo().ref('heads/' + state.base_ref).object.sha
+    with tracing.span('create_merge.sleep', state):
+        core.sleep(60)
+    base_sha = state.get_repo().ref('heads/' + pull.base_ref).object.sha
 
     state.refresh()
+    pull.check(state)
 
     lazy_debug(logger,
                lambda: "create_merge: attempting merge {} into {} on {!r}"
@@ -966,129 +1310,134 @@ def create_merge(state, repo_cfg, branch, logger, git_cfg,
 
     if git_cfg['local_git']:
 
-        git_cmd = init_local_git_cmds(repo_cfg, git_cfg)
+        with local_git(repo_cfg, git_cfg) as git_cmd:
+            with tracing.span('create_merge.fetch', state):
+                utils.logged_call(git_cmd('fetch', 'origin', pull.base_ref,
+                                          'pull/{}/head'.format(state.num)))
+            utils.silent_call(git_cmd('reset', '--hard'))
+            utils.silent_call(git_cmd('rebase', '--abort'))
+            utils.silent_call(git_cmd('merge', '--abort'))
+
+            if repo_cfg.get('linear', False):
+                utils.logged_call(
+                    git_cmd('checkout', '-B', branch, pull.head_sha))
+                try:
+                    args = [base_sha]
+                    if repo_cfg.get('autosquash', False):
+                        args += ['-i', '--autosquash']
+                    utils.logged_call(git_cmd('-c',
+                                              'user.name=' + git_cfg['name'],
+                                              '-c',
+                                              'user.email=' + git_cfg['email'],
+                                              'rebase',
+                                              *args))
+                except subprocess.CalledProcessError:
+                    if repo_cfg.get('autosquash', False):
+                        utils.silent_call(git_cmd('rebase', '--abort'))
+                        if utils.silent_call(git_cmd('rebase', base_sha)) == 0:
+                            desc = 'Auto-squashing failed'
+                            comment = ''
+                else:
+                    ap = '<try>' if pull.try_ else pull.approved_by
+                    text = '\nCloses: #{}\nApproved by: {}'.format(
+                        state.num, ap)
+                    msg_code = 'cat && echo {}'.format(shlex.quote(text))
+                    env_code = 'export GIT_COMMITTER_NAME={} && export GIT_COMMITTER_EMAIL={} && unset GIT_COMMITTER_DATE'.format(shlex.quote(git_cfg['name']), shlex.quote(git_cfg['email']))  # noqa
+                    utils.logged_call(git_cmd('filter-branch', '-f',
+                                              '--msg-filter', msg_code,
+                                              '--env-filter', env_code,
+                                              '{}..'.format(base_sha)))
 
-        utils.logged_call(git_cmd('fetch', 'origin', state.base_ref,
-                                  'pull/{}/head'.format(state.num)))
-        utils.silent_call(git_cmd('reset', '--hard'))
-        utils.silent_call(git_cmd('rebase', '--abort'))
-        utils.silent_call(git_cmd('merge', '--abort'))
+                    if ensure_merge_equal:
+                        if not branch_equal_to_merge(git_cmd, state, branch):
+                            return ''
 
-        if repo_cfg.get('linear', False):
-            utils.logged_call(
-                git_cmd('checkout', '-B', branch, state.head_sha))
-            try:
-                args = [base_sha]
-                if repo_cfg.get('autosquash', False):
-                    args += ['-i', '--autosquash']
-                utils.logged_call(git_cmd('-c',
-                                          'user.name=' + git_cfg['name'],
-                                          '-c',
-                                          'user.email=' + git_cfg['email'],
-                                          'rebase',
-                                          *args))
-            except subprocess.CalledProcessError:
+                    with tracing.span('create_merge.push', state):
+                        return git_push(git_cmd, branch, state)
+            else:
+                utils.logged_call(git_cmd(
+                    'checkout',
+                    '-f',
+                    '-B',
+                    'homu-tmp',
+                    pull.head_sha))
+
+                ok = True
                 if repo_cfg.get('autosquash', False):
-                    utils.silent_call(git_cmd('rebase', '--abort'))
-                    if utils.silent_call(git_cmd('rebase', base_sha)) == 0:
+                    try:
+                        merge_base_sha = subprocess.check_output(
+                            git_cmd(
+                                'merge-base',
+                                base_sha,
+                                pull.head_sha)).decode('ascii').strip()
+                        utils.logged_call(git_cmd(
+                            '-c',
+                            'user.name=' + git_cfg['name'],
+                            '-c',
+                            'user.email=' + git_cfg['email'],
+                            'rebase',
+                            '-i',
+                            '--autosquash',
+                            '--onto',
+                            merge_base_sha, base_sha))
+                    except subprocess.CalledProcessError:
                         desc = 'Auto-squashing failed'
                         comment = ''
-            else:
-                ap = '<try>' if state.try_ else state.approved_by
-                text = '\nCloses: #{}\nApproved by: {}'.format(state.num, ap)
-                msg_code = 'cat && echo {}'.format(shlex.quote(text))
-                env_code = 'export GIT_COMMITTER_NAME={} && export GIT_COMMITTER_EMAIL={} && unset GIT_COMMITTER_DATE'.format(shlex.quote(git_cfg['name']), shlex.quote(git_cfg['email']))  # noqa
-                utils.logged_call(git_cmd('filter-branch', '-f',
-                                          '--msg-filter', msg_code,
-                                          '--env-filter', env_code,
-                                          '{}..'.format(base_sha)))
-
-                if ensure_merge_equal:
-                    if not branch_equal_to_merge(git_cmd, state, branch):
-                        return ''
-
-                return git_push(git_cmd, branch, state)
-        else:
-            utils.logged_call(git_cmd(
-                'checkout',
-                '-f',
-                '-B',
-                'homu-tmp',
-                state.head_sha))
-
-            ok = True
-            if repo_cfg.get('autosquash', False):
-                try:
-                    merge_base_sha = subprocess.check_output(
-                        git_cmd(
-                            'merge-base',
-                            base_sha,
-                            state.head_sha)).decode('ascii').strip()
-                    utils.logged_call(git_cmd(
-                        '-c',
-                        'user.name=' + git_cfg['name'],
-                        '-c',
-                        'user.email=' + git_cfg['email'],
-                        'rebase',
-                        '-i',
-                        '--autosquash',
-                        '--onto',
-                        merge_base_sha, base_sha))
-                except subprocess.CalledProcessError:
-                    desc = 'Auto-squashing failed'
-                    comment = ''
-                    ok = False
-            if state.squash:
-                try:
-                    merge_base_sha = subprocess.check_output(
-                        git_cmd(
-                            'merge-base',
-                            base_sha,
-                            state.head_sha)).decode('ascii').strip()
-                    utils.logged_call(git_cmd(
-                        'reset',
-                        '--soft',
-                        merge_base_sha))
-                    utils.logged_call(git_cmd(
-                        '-c',
-                        'user.name=' + git_cfg['name'],
-                        '-c',
-                        'user.email=' + git_cfg['email'],
-                        'commit',
-                        '-m',
-                        squash_msg))
-                except subprocess.CalledProcessError:
-                    desc = 'Squashing failed'
-                    comment = ''
-                    ok = False
-
-            if ok:
-                utils.logged_call(git_cmd('checkout', '-B', branch, base_sha))
-                try:
-                    subprocess.check_output(
-                        git_cmd(
+                        ok = False
+                if pull.squash:
+                    try:
+                        merge_base_sha = subprocess.check_output(
+                            git_cmd(
+                                'merge-base',
+                                base_sha,
+                                pull.head_sha)).decode('ascii').strip()
+                        utils.logged_call(git_cmd(
+                            'reset',
+                            '--soft',
+                            merge_base_sha))
+                        utils.logged_call(git_cmd(
                             '-c',
                             'user.name=' + git_cfg['name'],
                             '-c',
                             'user.email=' + git_cfg['email'],
-                            'merge',
-                            'heads/homu-tmp',
-                            '--no-ff',
+                            'commit',
                             '-m',
-                            merge_msg),
-                        stderr=subprocess.STDOUT,
-                        universal_newlines=True)
-                except subprocess.CalledProcessError as e:
-                    comment += '<details><summary>Error message</summary>\n\n```text\n' # noqa
-                    comment += e.output
-                    comment += '\n```\n\n</details>'
-                    pass
-                else:
-                    if ensure_merge_equal:
-                        if not branch_equal_to_merge(git_cmd, state, branch):
-                            return ''
+                            squash_msg))
+                    except subprocess.CalledProcessError:
+                        desc = 'Squashing failed'
+                        comment = ''
+                        ok = False
+
+                if ok:
+                    utils.logged_call(git_cmd('checkout', '-B', branch,
+                                              base_sha))
+                    try:
+                        subprocess.check_output(
+                            git_cmd(
+                                '-c',
+                                'user.name=' + git_cfg['name'],
+                                '-c',
+                                'user.email=' + git_cfg['email'],
+                                'merge',
+                                'heads/homu-tmp',
+                                '--no-ff',
+                                '-m',
+                                merge_msg),
+                            stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+                    except subprocess.CalledProcessError as e:
+                        comment += '<details><summary>Error message</summary>\n\n```text\n' # noqa
+                        comment += e.output
+                        comment += '\n```\n\n</details>'
+                        pass
+                    else:
+                        if ensure_merge_equal:
+                            if not branch_equal_to_merge(git_cmd, state,
+                                                         branch):
+                                return ''
 
-                    return git_push(git_cmd, branch, state)
+                        with tracing.span('create_merge.push', state):
+                            return git_push(git_cmd, branch, state)
     else:
         if repo_cfg.get('linear', False) or repo_cfg.get('autosquash', False):
             raise RuntimeError('local_git must be turned on to use this feature')  # noqa
@@ -1099,7 +1448,7 @@ def create_merge(state, repo_cfg, branch, logger, git_cfg,
         # https://github.com/servo/homu/pull/57)
         assert ensure_merge_equal is False
 
-        if branch != state.base_ref:
+        if branch != pull.base_ref:
             utils.github_set_ref(
                 state.get_repo(),
                 'heads/' + branch,
@@ -1110,7 +1459,7 @@ def create_merge(state, repo_cfg, branch, logger, git_cfg,
         try:
             merge_commit = state.get_repo().merge(
                 branch,
-                state.head_sha,
+                pull.head_sha,
                 merge_msg)
         except github3.models.GitHubError as e:
             if e.code != 409:
@@ -1118,14 +1467,9 @@ def create_merge(state, repo_cfg, branch, logger, git_cfg,
         else:
             return merge_commit.sha if merge_commit else ''
 
+    pull.check(state)
     state.set_status('error')
-    utils.github_create_status(
-        state.get_repo(),
-        state.head_sha,
-        'error',
-        '',
-        desc,
-        context='homu')
+    state.create_status('error', '', desc)
 
     state.add_comment(':lock: {}\n\n{}'.format(desc, comment))
     state.change_labels(LabelEvent.CONFLICT)
@@ -1133,42 +1477,41 @@ def create_merge(state, repo_cfg, branch, logger, git_cfg,
     return ''
 
 
-def pull_is_rebased(state, repo_cfg, git_cfg, base_sha):
+def pull_is_rebased(state, repo_cfg, git_cfg, base_sha, pull):
     assert git_cfg['local_git']
-    git_cmd = init_local_git_cmds(repo_cfg, git_cfg)
-
-    utils.logged_call(git_cmd('fetch', 'origin', state.base_ref,
-                              'pull/{}/head'.format(state.num)))
+    with local_git(repo_cfg, git_cfg) as git_cmd:
+        utils.logged_call(git_cmd('fetch', 'origin', pull.base_ref,
+                                  'pull/{}/head'.format(state.num)))
 
-    return utils.silent_call(git_cmd('merge-base', '--is-ancestor',
-                                     base_sha, state.head_sha)) == 0
+        return utils.silent_call(git_cmd('merge-base', '--is-ancestor',
+                                         base_sha, pull.head_sha)) == 0
 
 
 # We could fetch this from GitHub instead, but that API is being deprecated:
 # https://developer.github.com/changes/2013-04-25-deprecating-merge-commit-sha/
 def get_github_merge_sha(state, repo_cfg, git_cfg):
     assert git_cfg['local_git']
-    git_cmd = init_local_git_cmds(repo_cfg, git_cfg)
-
     if state.mergeable is not True:
         return None
 
-    utils.logged_call(git_cmd('fetch', 'origin',
-                              'pull/{}/merge'.format(state.num)))
+    with local_git(repo_cfg, git_cfg) as git_cmd:
+        utils.logged_call(git_cmd('fetch', 'origin',
+                                  'pull/{}/merge'.format(state.num)))
 
-    return subprocess.check_output(git_cmd('rev-parse', 'FETCH_HEAD')).decode('ascii').strip()  # noqa
+        return subprocess.check_output(git_cmd('rev-parse', 'FETCH_HEAD')).decode('ascii').strip()  # noqa
 
 
 def do_exemption_merge(state, logger, repo_cfg, git_cfg, url, check_merge,
-                       reason):
+                       reason, pull):
 
     try:
         merge_sha = create_merge(
             state,
             repo_cfg,
-            state.base_ref,
+            pull.base_ref,
             logger,
             git_cfg,
+            pull,
             check_merge)
     except subprocess.CalledProcessError:
         print('* Unable to create a merge commit for the exempted PR: {}'.format(state))  # noqa
@@ -1177,12 +1520,12 @@ def do_exemption_merge(state, logger, repo_cfg, git_cfg, url, check_merge,
 
     if not merge_sha:
         return False
+    pull.check(state)
 
     desc = 'Test exempted'
 
     state.set_status('success')
-    utils.github_create_status(state.get_repo(), state.head_sha, 'success',
-                               url, desc, context='homu')
+    state.create_status('success', url, desc)
     state.add_comment(':zap: {}: {}.'.format(desc, reason))
     state.change_labels(LabelEvent.EXEMPTED)
 
@@ -1193,10 +1536,11 @@ def do_exemption_merge(state, logger, repo_cfg, git_cfg, url, check_merge,
     return True
 
 
-def try_travis_exemption(state, logger, repo_cfg, git_cfg):
+@metrics.operation('exemption')
+def try_travis_exemption(state, logger, repo_cfg, git_cfg, pull):
 
     travis_info = None
-    for info in utils.github_iter_statuses(state.get_repo(), state.head_sha):
+    for info in utils.github_iter_statuses(state.get_repo(), pull.head_sha):
         if info.context == 'continuous-integration/travis-ci/pr':
             travis_info = info
             break
@@ -1223,19 +1567,20 @@ def try_travis_exemption(state, logger, repo_cfg, git_cfg):
     if not travis_commit:
         return False
 
-    base_sha = state.get_repo().ref('heads/' + state.base_ref).object.sha
+    base_sha = state.get_repo().ref('heads/' + pull.base_ref).object.sha
 
     if (travis_commit.parents[0]['sha'] == base_sha and
-            travis_commit.parents[1]['sha'] == state.head_sha):
+            travis_commit.parents[1]['sha'] == pull.head_sha):
         # make sure we check against the github merge sha before pushing
         return do_exemption_merge(state, logger, repo_cfg, git_cfg,
                                   travis_info.target_url, True,
-                                  "merge already tested by Travis CI")
+                                  "merge already tested by Travis CI", pull)
 
     return False
 
 
-def try_status_exemption(state, logger, repo_cfg, git_cfg):
+@metrics.operation('exemption')
+def try_status_exemption(state, logger, repo_cfg, git_cfg, pull):
 
     # If all the builders are status-based, then we can do some checks to
     # exempt testing under the following cases:
@@ -1264,7 +1609,7 @@ def try_status_exemption(state, logger, repo_cfg, git_cfg):
 
     # let's first check that all the statuses we want are set to success
     statuses_pass = set()
-    for info in utils.github_iter_statuses(state.get_repo(), state.head_sha):
+    for info in utils.github_iter_statuses(state.get_repo(), pull.head_sha):
         if info.context in status_equivalences and info.state == 'success':
             statuses_pass.add(status_equivalences[info.context])
 
@@ -1272,10 +1617,11 @@ def try_status_exemption(state, logger, repo_cfg, git_cfg):
         return False
 
     # is the PR fully rebased?
-    base_sha = state.get_repo().ref('heads/' + state.base_ref).object.sha
-    if pull_is_rebased(state, repo_cfg, git_cfg, base_sha):
+    base_sha = state.get_repo().ref('heads/' + pull.base_ref).object.sha
+    if pull_is_rebased(state, repo_cfg, git_cfg, base_sha, pull):
         return do_exemption_merge(state, logger, repo_cfg, git_cfg, '', False,
-                                  "pull fully rebased and already tested")
+                                  "pull fully rebased and already tested",
+                                  pull)
 
     # check if we can use the github merge sha as proof
     merge_sha = get_github_merge_sha(state, repo_cfg, git_cfg)
@@ -1290,26 +1636,29 @@ def try_status_exemption(state, logger, repo_cfg, git_cfg):
     merge_commit = state.get_repo().commit(merge_sha)
     if (statuses_all == statuses_merge_pass and
             merge_commit.parents[0]['sha'] == base_sha and
-            merge_commit.parents[1]['sha'] == state.head_sha):
+            merge_commit.parents[1]['sha'] == pull.head_sha):
         # make sure we check against the github merge sha before pushing
         return do_exemption_merge(state, logger, repo_cfg, git_cfg, '', True,
-                                  "merge already tested")
+                                  "merge already tested", pull)
 
     return False
 
 
-def start_build(state, repo_cfgs, buildbot_slots, logger, db, git_cfg):
+def start_build(state, repo_cfgs, buildbot_slots, logger, db, git_cfg, pull):
     if buildbot_slots[0]:
         return True
 
     lazy_debug(logger, lambda: "start_build on {!r}".format(state.get_repo()))
 
     pr = state.get_repo().pull_request(state.num)
+    pull.check(state)
     assert state.head_sha == pr.head.sha
     assert state.base_ref == pr.base.ref
 
     repo_cfg = repo_cfgs[state.repo_label]
 
+    tracing.record_since('queue_wait', state, 'queued')
+
     builders = []
     branch = 'try' if state.try_ else 'auto'
     branch = repo_cfg.get('branch', {}).get(branch, branch)
@@ -1358,15 +1707,18 @@ def start_build(state, repo_cfgs, buildbot_slots, logger, db, git_cfg):
     if (only_status_builders and state.approved_by and
             repo_cfg.get('status_based_exemption', False)):
         if can_try_travis_exemption:
-            if try_travis_exemption(state, logger, repo_cfg, git_cfg):
+            if try_travis_exemption(state, logger, repo_cfg, git_cfg, pull):
                 return True
-        if try_status_exemption(state, logger, repo_cfg, git_cfg):
+        if try_status_exemption(state, logger, repo_cfg, git_cfg, pull):
             return True
 
-    merge_sha = create_merge(state, repo_cfg, branch, logger, git_cfg)
+    with tracing.span('create_merge', state, try_build=state.try_):
+        merge_sha = create_merge(state, repo_cfg, branch, logger, git_cfg,
+                                 pull)
     lazy_debug(logger, lambda: "start_build: merge_sha={}".format(merge_sha))
     if not merge_sha:
         return False
+    pull.check(state)
 
     state.init_build_res(builders)
     state.merge_sha = merge_sha
@@ -1391,13 +1743,7 @@ def start_build(state, repo_cfgs, buildbot_slots, logger, db, git_cfg):
         state.head_sha,
         state.merge_sha,
     )
-    utils.github_create_status(
-        state.get_repo(),
-        state.head_sha,
-        'pending',
-        '',
-        desc,
-        context='homu')
+    state.create_status('pending', '', desc)
 
     if state.try_:
         state.add_comment(comments.TryBuildStarted(
@@ -1413,7 +1759,7 @@ def start_build(state, repo_cfgs, buildbot_slots, logger, db, git_cfg):
     return True
 
 
-def start_rebuild(state, repo_cfgs):
+def start_rebuild(state, repo_cfgs, pull):
     repo_cfg = repo_cfgs[state.repo_label]
 
     if 'buildbot' not in repo_cfg or not state.build_res:
@@ -1434,18 +1780,21 @@ def start_rebuild(state, repo_cfgs):
     if not builders or not succ_builders:
         return False
 
-    base_sha = state.get_repo().ref('heads/' + state.base_ref).object.sha
-    _parents = state.get_repo().commit(state.merge_sha).parents
+    merge_sha = state.merge_sha
+    base_sha = state.get_repo().ref('heads/' + pull.base_ref).object.sha
+    _parents = state.get_repo().commit(merge_sha).parents
     parent_shas = [x['sha'] for x in _parents]
 
     if base_sha not in parent_shas:
         return False
 
+    pull.check(state)
     utils.github_set_ref(
         state.get_repo(),
         'tags/homu-tmp',
-        state.merge_sha,
+        merge_sha,
         force=True)
+    pull.check(state)
 
     builders.sort()
     succ_builders.sort()
@@ -1469,6 +1818,8 @@ def start_rebuild(state, repo_cfgs):
                 state.add_comment(':bomb: Failed to start rebuilding: `{}`'.format(err))  # noqa
                 return False
 
+    tracing.record_since('queue_wait', state, 'queued')
+
     timeout = repo_cfg.get('timeout', DEFAULT_TEST_TIMEOUT)
     state.start_testing(timeout)
 
@@ -1477,61 +1828,127 @@ def start_rebuild(state, repo_cfgs):
     msg_3 = ' are reusable. Rebuilding'
     msg_4 = ' only {}'.format(', '.join('[{}]({})'.format(builder, url) for builder, url in builders))  # noqa
 
-    utils.github_create_status(
-        state.get_repo(),
-        state.head_sha,
-        'pending',
-        '',
-        '{}{}...'.format(msg_1, msg_3),
-        context='homu')
+    state.create_status('pending', '', '{}{}...'.format(msg_1, msg_3))
 
     state.add_comment(':zap: {}{}{}{}...'.format(msg_1, msg_2, msg_3, msg_4))
 
     return True
 
 
-def start_build_or_rebuild(state, repo_cfgs, *args):
-    if start_rebuild(state, repo_cfgs):
+def start_build_or_rebuild(state, repo_cfgs, buildbot_slots, logger, db,
+                           git_cfg, pull):
+    if start_rebuild(state, repo_cfgs, pull):
         return True
 
-    return start_build(state, repo_cfgs, *args)
+    return start_build(state, repo_cfgs, buildbot_slots, logger, db, git_cfg,
+                       pull)
+
+
+def queue_candidates(repo_states, treeclosed):
+    """The pull requests to build next, from the sorted states of a
+    repository, with what to build: 'approved' pull requests first, then
+    approved ones that only had a 'tried' build, then 'try' builds.
+
+    Candidates are yielded as the previous one fails to start, so they are
+    looked at in their current state. The simulator plays the queue with the
+    same rules.
+    """
+    for state in repo_states:
+        if state.priority < treeclosed:
+            continue
+        if state.status == 'pending' and not state.try_:
+            break
+
+        elif state.status == 'success' and state.fake_merge_sha:
+            break
+
+        elif state.status == '' and state.approved_by:
+            yield 'approved', state
+
+        elif state.status == 'success' and state.try_ and state.approved_by:
+            yield 'tried', state
 
+    for state in repo_states:
+        if state.status == '' and state.try_:
+            yield 'try', state
 
+
+@metrics.operation('queue')
 def process_queue(states, repos, repo_cfgs, logger, buildbot_slots, db,
                   git_cfg):
-    for repo_label, repo in repos.items():
-        repo_states = sorted(states[repo_label].values())
-
-        for state in repo_states:
-            lazy_debug(logger, lambda: "process_queue: state={!r}, building {}"
-                       .format(state, repo_label))
-            if state.priority < repo.treeclosed:
+    for repo_label in list(repos):
+        started = False
+        # Unless the repository was removed meanwhile
+        while repo_label in repos:
+            try:
+                started = start_next_build(repo_label, states, repos,
+                                           repo_cfgs, logger, buildbot_slots,
+                                           db, git_cfg)
+            except PullChanged as e:
+                # The queue may look different now, so it is looked at anew
+                logger.info('Not building: {}'.format(e))
                 continue
-            if state.status == 'pending' and not state.try_:
-                break
+            break
+        if started:
+            return
 
-            elif state.status == 'success' and hasattr(state, 'fake_merge_sha'):  # noqa
-                break
 
-            elif state.status == '' and state.approved_by:
-                if start_build_or_rebuild(state, repo_cfgs, buildbot_slots,
-                                          logger, db, git_cfg):
-                    return
+def start_next_build(repo_label, states, repos, repo_cfgs, logger,
+                     buildbot_slots, db, git_cfg):
+    repo_states = sorted(states[repo_label].values())
 
-            elif state.status == 'success' and state.try_ and state.approved_by:  # noqa
+    for kind, state in queue_candidates(repo_states,
+                                        repos[repo_label].treeclosed):
+        lazy_debug(logger, lambda: "process_queue: state={!r}, building {}"
+                   .format(state, repo_label))
+        if kind == 'approved':
+            started = start_build_or_rebuild(state, repo_cfgs,
+                                             buildbot_slots, logger, db,
+                                             git_cfg,
+                                             PullSnapshot(state, states))
+        else:
+            if kind == 'tried':
                 state.try_ = False
 
                 state.save()
 
-                if start_build(state, repo_cfgs, buildbot_slots, logger, db,
-                               git_cfg):
-                    return
+            started = start_build(state, repo_cfgs, buildbot_slots,
+                                  logger, db, git_cfg,
+                                  PullSnapshot(state, states))
+        if started:
+            return True
+    return False
+
 
-        for state in repo_states:
-            if state.status == '' and state.try_:
-                if start_build(state, repo_cfgs, buildbot_slots, logger, db,
-                               git_cfg):
-                    return
+@metrics.operation('mergeability')
+def update_mergeability(state, cause, mergeable, re_pull_num):
+    if state.mergeable is True and mergeable is False:
+        if cause:
+            mat = re_pull_num.search(cause['title'])
+
+            if mat:
+                issue_or_commit = '#' + mat.group(1)
+            else:
+                issue_or_commit = cause['sha']
+        else:
+            issue_or_commit = ''
+
+        _blame = ''
+        if issue_or_commit:
+            _blame = ' (presumably {})'.format(issue_or_commit)
+        state.add_comment(
+            ':umbrella: The latest upstream changes{} made this '
+            'pull request unmergeable. Please [resolve the merge conflicts]'
+            '(https://rustc-dev-guide.rust-lang.org/git.html#rebasing-and-conflicts).'  # noqa
+            .format(_blame)
+        )
+        state.change_labels(LabelEvent.CONFLICT)
+
+    state.set_mergeable(mergeable, que=False)
+
+
+def queue_mergeability(mergeable_que, state, cause, retries):
+    mergeable_que.put([state, cause, retries, time.time()])
 
 
 def fetch_mergeability(mergeable_que):
@@ -1539,40 +1956,28 @@ def fetch_mergeability(mergeable_que):
 
     while True:
         try:
-            state, cause = mergeable_que.get()
+            state, cause, retries, queued_at = mergeable_que.get()
+            metrics.mergeable_queue_wait_seconds.observe(
+                time.time() - queued_at)
 
-            if state.status == 'success':
+            # The states are only read on the core
+            if core.call(getattr, state, 'status') == 'success':
                 continue
 
-            pull_request = state.get_repo().pull_request(state.num)
-            if pull_request is None or pull_request.mergeable is None:
-                time.sleep(5)
+            with metrics.operation('mergeability'):
                 pull_request = state.get_repo().pull_request(state.num)
+            if pull_request is None or pull_request.mergeable is None:
+                if retries > 0:
+                    # GitHub computes mergeability in the background. Ask
+                    # again later instead of holding up the rest of the queue
+                    scheduler.call_later(MERGEABILITY_RETRY_DELAY,
+                                         queue_mergeability, mergeable_que,
+                                         state, cause, retries - 1)
+                    continue
             mergeable = pull_request is not None and pull_request.mergeable
 
-            if state.mergeable is True and mergeable is False:
-                if cause:
-                    mat = re_pull_num.search(cause['title'])
-
-                    if mat:
-                        issue_or_commit = '#' + mat.group(1)
-                    else:
-                        issue_or_commit = cause['sha']
-                else:
-                    issue_or_commit = ''
-
-                _blame = ''
-                if issue_or_commit:
-                    _blame = ' (presumably {})'.format(issue_or_commit)
-                state.add_comment(
-                    ':umbrella: The latest upstream changes{} made this '
-                    'pull request unmergeable. Please [resolve the merge conflicts]'  # noqa
-                    '(https://rustc-dev-guide.rust-lang.org/git.html#rebasing-and-conflicts).'  # noqa
-                    .format(_blame)
-                )
-                state.change_labels(LabelEvent.CONFLICT)
-
-            state.set_mergeable(mergeable, que=False)
+            core.call(update_mergeability, state, cause, mergeable,
+                      re_pull_num)
 
         except Exception:
             print('* Error while fetching mergeability')
@@ -1582,11 +1987,63 @@ def fetch_mergeability(mergeable_que):
             mergeable_que.task_done()
 
 
+@metrics.operation('sync')
 def synchronize(repo_label, repo_cfg, logger, gh, states, repos, db, mergeable_que, my_username, repo_labels):  # noqa
     logger.info('Synchronizing {}...'.format(repo_label))
+    health.sync_started(repo_label)
+    try:
+        repo = gh.repository(repo_cfg['owner'], repo_cfg['name'])
+
+        github_cfg = global_cfg.get('github', {})
+        gh_v4 = github_v4.GitHubV4(
+            github_cfg['access_token'],
+            github_cfg.get('graphql_url', github_v4.GRAPHQL_URL),
+            page_size=github_cfg.get('graphql_page_size',
+                                     github_v4.DEFAULT_PAGE_SIZE),
+        )
+        # Fetching can take a while on big repositories, so it happens before
+        # taking over the states
+        pulls = list(gh_v4.iter_pull_requests(repo_cfg['owner'],
+                                              repo_cfg['name']))
+
+        core.call(replace_states, repo_label, repo_cfg, repo, pulls, gh,
+                  states, repos, db, mergeable_que, my_username)
+    except BaseException:
+        health.sync_failed(repo_label)
+        raise
+    health.sync_done(repo_label)
+
+    logger.info('Done synchronizing {}!'.format(repo_label))
+
+
+def synchronize_or_retry(*args, delay=SYNC_RETRY_DELAY):
+    """Like synchronize, but if it fails, try again later, waiting twice as
+    long every time, until it works. Otherwise the repository would stay out
+    of date, and homu not ready, until someone synchronizes it again."""
+    try:
+        synchronize(*args)
+    except Exception:
+        print('* Error while synchronizing {}, retrying in {}s'.format(
+            args[0], delay))
+        traceback.print_exc()
+
+        scheduler.call_later(delay, retry_synchronize, args,
+                             min(delay * 2, SYNC_RETRY_MAX_DELAY))
 
-    repo = gh.repository(repo_cfg['owner'], repo_cfg['name'])
 
+def retry_synchronize(args, delay):
+    repo_label, repos = args[0], args[5]
+    # The repository may have been removed in the meantime
+    if repo_label not in repos:
+        return
+
+    # Synchronizing takes a while, so it doesn't hold up a scheduler worker
+    Thread(target=synchronize_or_retry, args=args,
+           kwargs={'delay': delay}).start()
+
+
+def replace_states(repo_label, repo_cfg, repo, pulls, gh, states, repos, db,
+                   mergeable_que, my_username):
     db_query(db, 'DELETE FROM pull WHERE repo = ?', [repo_label])
     db_query(db, 'DELETE FROM build_res WHERE repo = ?', [repo_label])
     db_query(db, 'DELETE FROM mergeable WHERE repo = ?', [repo_label])
@@ -1596,12 +2053,19 @@ def synchronize(repo_label, repo_cfg, logger, gh, states, repos, db, mergeable_q
         saved_states[num] = {
             'merge_sha': state.merge_sha,
             'build_res': state.build_res,
+            'test_started': state.test_started,
         }
+        # The timeouts of the builds still running are scheduled again below
+        if state.timeout_timer:
+            state.timeout_timer.cancel()
+            state.timeout_timer = None
 
     states[repo_label] = {}
-    repos[repo_label] = Repository(repo, repo_label, db)
+    repos[repo_label] = Repository(repo, repo_label, db, github=gh,
+                                   repo_cfg=repo_cfg,
+                                   mergeable_que=mergeable_que)
 
-    for pull in repo.iter_pulls(state='open'):
+    for pull in pulls:
         db_query(
             db,
             'SELECT status FROM pull WHERE repo = ? AND num = ?',
@@ -1610,27 +2074,25 @@ def synchronize(repo_label, repo_cfg, logger, gh, states, repos, db, mergeable_q
         if row:
             status = row[0]
         else:
-            status = ''
-            for info in utils.github_iter_statuses(repo, pull.head.sha):
-                if info.context == 'homu':
-                    status = info.state
-                    break
+            status = pull.status
 
-        state = PullReqState(pull.number, pull.head.sha, status, db, repo_label, mergeable_que, gh, repo_cfg['owner'], repo_cfg['name'], repo_cfg.get('labels', {}), repos, repo_cfg.get('test-on-fork'))  # noqa
+        state = PullReqState(pull.number, pull.head_sha, status,
+                             repos[repo_label])
         state.title = pull.title
         state.body = suppress_pings(pull.body or "")
         state.body = suppress_ignore_block(state.body)
-        state.head_ref = pull.head.repo[0] + ':' + pull.head.ref
-        state.base_ref = pull.base.ref
+        state.head_ref = pull.head_ref
+        state.base_ref = pull.base_ref
         state.set_mergeable(None)
-        state.assignee = pull.assignee.login if pull.assignee else ''
+        state.assignee = pull.assignee
+        state.labels = pull.labels
 
-        for comment in pull.iter_comments():
-            if comment.original_commit_id == pull.head.sha:
+        for comment in pull.review_comments:
+            if comment.original_commit_id == pull.head_sha:
                 parse_commands(
                     comment.body,
-                    comment.user.login,
-                    comment.user.id,
+                    comment.login,
+                    comment.user_id,
                     repo_label,
                     repo_cfg,
                     state,
@@ -1638,25 +2100,21 @@ def synchronize(repo_label, repo_cfg, logger, gh, states, repos, db, mergeable_q
                     db,
                     states,
                     sha=comment.original_commit_id,
-                    command_src=comment.to_json()['html_url'],
-                    # FIXME switch to `comment.html_url`
-                    #       after updating github3 to 1.3.0+
+                    command_src=comment.html_url,
                 )
 
-        for comment in pull.iter_issue_comments():
+        for comment in pull.issue_comments:
             parse_commands(
                 comment.body,
-                comment.user.login,
-                comment.user.id,
+                comment.login,
+                comment.user_id,
                 repo_label,
                 repo_cfg,
                 state,
                 my_username,
                 db,
                 states,
-                command_src=comment.to_json()['html_url'],
-                # FIXME switch to `comment.html_url`
-                #       after updating github3 to 1.3.0+
+                command_src=comment.html_url,
             )
 
         saved_state = saved_states.get(pull.number)
@@ -1665,10 +2123,142 @@ def synchronize(repo_label, repo_cfg, logger, gh, states, repos, db, mergeable_q
                 setattr(state, key, val)
 
         state.save()
+        if state.status == 'pending':
+            state.schedule_timeout(
+                repo_cfg.get('timeout', DEFAULT_TEST_TIMEOUT))
 
         states[repo_label][pull.number] = state
+        state.changed()
 
-    logger.info('Done synchronizing {}!'.format(repo_label))
+
+def stored_builders(repo_cfg):
+    builders = []
+    if 'buildbot' in repo_cfg:
+        builders += repo_cfg['buildbot']['builders']
+    if 'travis' in repo_cfg:
+        builders += ['travis']
+    if 'status' in repo_cfg:
+        builders += ['status-' + key for key, value in repo_cfg['status'].items() if 'context' in value]  # noqa
+    if 'checks' in repo_cfg:
+        builders += ['checks-' + key for key, value in repo_cfg['checks'].items() if 'name' in value]  # noqa
+    if len(builders) == 0:
+        raise RuntimeError('Invalid configuration')
+    return builders
+
+
+def expire_retry_log(db):
+    """Destroy the ancient records of the retry log, and do it again later."""
+    try:
+        db_query(
+            db,
+            "DELETE FROM retry_log WHERE time < datetime('now', ?)",
+            [global_cfg.get('retry_log_expire', '-42 days')],
+        )
+    finally:
+        scheduler.call_later(RETRY_LOG_EXPIRE_INTERVAL, expire_retry_log, db)
+
+
+def load_states(db, repos, repo_cfgs, logger):
+    """Rebuild the pull request states of every configured repository.
+
+    Each table is read in a single pass, and rows that don't belong to an open
+    pull request of a configured repository are pruned with set-based deletes.
+    """
+    started = time.time()
+    labels = list(repos)
+    states = {repo_label: {} for repo_label in labels}
+    stale_builders = []
+
+    with db_query_lock:
+        db.execute('BEGIN')
+        try:
+            db.execute(
+                'DELETE FROM pull WHERE repo NOT IN ({})'
+                .format(', '.join('?' * len(labels))),
+                labels,
+            )
+            # FIXME: There might be a better solution
+            db.execute('''
+                UPDATE pull SET status = ''
+                WHERE status = 'pending' AND COALESCE(merge_sha, '') = ''
+            ''')
+            db.execute('''
+                DELETE FROM build_res WHERE NOT EXISTS (
+                    SELECT 1 FROM pull
+                    WHERE pull.repo = build_res.repo
+                    AND pull.num = build_res.num
+                    AND pull.merge_sha = build_res.merge_sha
+                )
+            ''')
+            db.execute('''
+                DELETE FROM mergeable WHERE NOT EXISTS (
+                    SELECT 1 FROM pull
+                    WHERE pull.repo = mergeable.repo
+                    AND pull.num = mergeable.num
+                )
+            ''')
+
+            db.execute('SELECT repo, num, head_sha, status, title, head_ref, base_ref, assignee, approved_by, priority, try_, rollup, squash, delegate, merge_sha, test_started FROM pull')  # noqa
+            for repo_label, num, head_sha, status, title, head_ref, base_ref, assignee, approved_by, priority, try_, rollup, squash, delegate, merge_sha, test_started in db.fetchall():  # noqa
+                state = PullReqState(num, head_sha, status, repos[repo_label])
+                state.title = title
+                # The body is loaded lazily from the database
+                state._body = None
+                state.head_ref = head_ref
+                state.base_ref = base_ref
+                state.assignee = assignee
+
+                state.approved_by = approved_by
+                state.priority = int(priority)
+                state.try_ = bool(try_)
+                state.rollup = rollup
+                state.squash = bool(squash)
+                state.delegate = delegate
+                if test_started is not None:
+                    state.test_started = test_started
+                if merge_sha:
+                    builders = stored_builders(repo_cfgs[repo_label])
+                    state.init_build_res(builders, use_db=False)
+                    state.merge_sha = merge_sha
+
+                states[repo_label][num] = state
+
+            db.execute('SELECT repo, num, builder, res, url FROM build_res')
+            for repo_label, num, builder, res, url in db.fetchall():
+                state = states[repo_label][num]
+                if builder not in state.build_res:
+                    stale_builders.append([repo_label, num, builder])
+                    continue
+
+                state.build_res[builder] = {
+                    'res': bool(res) if res is not None else None,
+                    'url': url,
+                }
+
+            if stale_builders:
+                db.executemany(
+                    'DELETE FROM build_res WHERE repo = ? AND num = ? AND builder = ?',  # noqa
+                    stale_builders,
+                )
+
+            db.execute('SELECT repo, num, mergeable FROM mergeable')
+            for repo_label, num, mergeable in db.fetchall():
+                states[repo_label][num].mergeable = (
+                    bool(mergeable) if mergeable is not None else None
+                )
+
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    logger.info('Loaded {} pull requests of {} repositories in {:.3f}s'.format(
+        sum(len(repo_states) for repo_states in states.values()),
+        len(states),
+        time.time() - started,
+    ))
+
+    return states
 
 
 def process_config(config):
@@ -1709,12 +2299,19 @@ def arguments():
         action='store',
         help='Path to cfg.toml',
         default='cfg.toml')
+    parser.add_argument(
+        '--shard',
+        action='store',
+        type=int,
+        help='Run as the worker process of the given shard (used internally '
+             'by sharded setups)')
 
     return parser.parse_args()
 
 
 def main():
     global global_cfg
+    started = time.time()
     args = arguments()
 
     logger = logging.getLogger('homu')
@@ -1735,9 +2332,23 @@ def main():
         else:
             raise
     cfg = process_config(cfg)
+    # Write what is still queued when homu stops
+    atexit.register(logs.setup(logger, cfg.get('logging', {})).stop)
+
+    if args.shard is not None:
+        cfg = shard.worker_config(cfg, args.shard)
+    elif shard.shard_count(cfg) > 1:
+        shard.front(cfg, args, logger)
+        return
+
     global_cfg = cfg
 
     gh = github3.login(token=cfg['github']['access_token'])
+    if 'api_url' in cfg['github']:
+        gh._session.base_url = cfg['github']['api_url'].rstrip('/')
+    metrics.instrument_session(gh._session)
+    # Other handlers run while one waits for GitHub
+    gh._session.request = core.releasing(gh._session.request)
     user = gh.user()
     cfg_git = cfg.get('git', {})
     user_email = cfg_git.get('email')
@@ -1755,6 +2366,10 @@ def main():
     my_username = user.login
     repo_labels = {}
     mergeable_que = Queue()
+    metrics.mergeable_queue_depth.set_function(mergeable_que.qsize)
+    metrics.mergeable_queue_lag_seconds.set_function(
+        lambda: health.queue_lag(mergeable_que))
+    metrics.webhook_lag_seconds.set_function(health.event_lag)
     git_cfg = {
         'name': user_name,
         'email': user_email,
@@ -1769,70 +2384,15 @@ def main():
                               isolation_level=None)
     db = db_conn.cursor()
 
-    db_query(db, '''CREATE TABLE IF NOT EXISTS pull (
-        repo TEXT NOT NULL,
-        num INTEGER NOT NULL,
-        status TEXT NOT NULL,
-        merge_sha TEXT,
-        title TEXT,
-        body TEXT,
-        head_sha TEXT,
-        head_ref TEXT,
-        base_ref TEXT,
-        assignee TEXT,
-        approved_by TEXT,
-        priority INTEGER,
-        try_ INTEGER,
-        rollup INTEGER,
-        squash INTEGER,
-        delegate TEXT,
-        UNIQUE (repo, num)
-    )''')
-
-    db_query(db, '''CREATE TABLE IF NOT EXISTS build_res (
-        repo TEXT NOT NULL,
-        num INTEGER NOT NULL,
-        builder TEXT NOT NULL,
-        res INTEGER,
-        url TEXT NOT NULL,
-        merge_sha TEXT NOT NULL,
-        UNIQUE (repo, num, builder)
-    )''')
-
-    db_query(db, '''CREATE TABLE IF NOT EXISTS mergeable (
-        repo TEXT NOT NULL,
-        num INTEGER NOT NULL,
-        mergeable INTEGER NOT NULL,
-        UNIQUE (repo, num)
-    )''')
-    db_query(db, '''CREATE TABLE IF NOT EXISTS repos (
-        repo TEXT NOT NULL,
-        treeclosed INTEGER NOT NULL,
-        treeclosed_src TEXT,
-        UNIQUE (repo)
-    )''')
-
-    db_query(db, '''CREATE TABLE IF NOT EXISTS retry_log (
-        repo TEXT NOT NULL,
-        num INTEGER NOT NULL,
-        time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-        src TEXT NOT NULL,
-        msg TEXT NOT NULL
-    )''')
-    db_query(db, '''
-        CREATE INDEX IF NOT EXISTS retry_log_time_index ON retry_log
-        (repo, time DESC)
-    ''')
-
-    # manual DB migration :/
-    try:
-        db_query(db, 'SELECT treeclosed_src FROM repos LIMIT 0')
-    except sqlite3.OperationalError:
-        db_query(db, 'ALTER TABLE repos ADD COLUMN treeclosed_src TEXT')
-    try:
-        db_query(db, 'SELECT squash FROM pull LIMIT 0')
-    except sqlite3.OperationalError:
-        db_query(db, 'ALTER TABLE pull ADD COLUMN squash INT')
+    migrate(db, logger)
+    expire_retry_log(db)
+
+    if 'tracing' in cfg:
+        tracing.start(
+            cfg['tracing']['file'],
+            cfg['tracing'].get('max_bytes', tracing.DEFAULT_MAX_BYTES),
+            cfg['tracing'].get('backups', tracing.DEFAULT_BACKUPS),
+        )
 
     for repo_label, repo_cfg in cfg['repo'].items():
         repo_cfgs[repo_label] = repo_cfg
@@ -1845,102 +2405,55 @@ def main():
             tof = repo_cfg['test-on-fork']
             repo_labels[tof['owner'], tof['name']] = repo_label
 
-        repo_states = {}
-        repos[repo_label] = Repository(None, repo_label, db)
+        repos[repo_label] = Repository(None, repo_label, db, github=gh,
+                                       repo_cfg=repo_cfg,
+                                       mergeable_que=mergeable_que)
 
-        db_query(
-            db,
-            'SELECT num, head_sha, status, title, body, head_ref, base_ref, assignee, approved_by, priority, try_, rollup, squash, delegate, merge_sha FROM pull WHERE repo = ?',   # noqa
-            [repo_label])
-        for num, head_sha, status, title, body, head_ref, base_ref, assignee, approved_by, priority, try_, rollup, squash, delegate, merge_sha in db.fetchall():  # noqa
-            state = PullReqState(num, head_sha, status, db, repo_label, mergeable_que, gh, repo_cfg['owner'], repo_cfg['name'], repo_cfg.get('labels', {}), repos, repo_cfg.get('test-on-fork'))  # noqa
-            state.title = title
-            state.body = body
-            state.head_ref = head_ref
-            state.base_ref = base_ref
-            state.assignee = assignee
-
-            state.approved_by = approved_by
-            state.priority = int(priority)
-            state.try_ = bool(try_)
-            state.rollup = rollup
-            state.squash = bool(squash)
-            state.delegate = delegate
-            builders = []
-            if merge_sha:
-                if 'buildbot' in repo_cfg:
-                    builders += repo_cfg['buildbot']['builders']
-                if 'travis' in repo_cfg:
-                    builders += ['travis']
-                if 'status' in repo_cfg:
-                    builders += ['status-' + key for key, value in repo_cfg['status'].items() if 'context' in value]  # noqa
-                if 'checks' in repo_cfg:
-                    builders += ['checks-' + key for key, value in repo_cfg['checks'].items() if 'name' in value]  # noqa
-                if len(builders) == 0:
-                    raise RuntimeError('Invalid configuration')
-
-                state.init_build_res(builders, use_db=False)
-                state.merge_sha = merge_sha
-
-            elif state.status == 'pending':
-                # FIXME: There might be a better solution
-                state.status = ''
+    loading = time.time()
+    states.update(load_states(db, repos, repo_cfgs, logger))
+    health.loaded(sum(len(repo_states) for repo_states in states.values()),
+                  time.time() - loading)
 
-                state.save()
-
-            repo_states[num] = state
+    core.start()
 
-        states[repo_label] = repo_states
+    # Queue runs can give the core back while they wait (see create_merge),
+    # so a run requested in the meantime is folded into the current one
+    queue_run = {'running': False, 'requested': False}
 
-    db_query(
-        db,
-        'SELECT repo, num, builder, res, url, merge_sha FROM build_res')
-    for repo_label, num, builder, res, url, merge_sha in db.fetchall():
-        try:
-            state = states[repo_label][num]
-            if builder not in state.build_res:
-                raise KeyError
-            if state.merge_sha != merge_sha:
-                raise KeyError
-        except KeyError:
-            db_query(
-                db,
-                'DELETE FROM build_res WHERE repo = ? AND num = ? AND builder = ?',   # noqa
-                [repo_label, num, builder])
-            continue
-
-        state.build_res[builder] = {
-            'res': bool(res) if res is not None else None,
-            'url': url,
-        }
+    def run_queue():
+        queue_run['requested'] = True
+        if queue_run['running']:
+            return
 
-    db_query(db, 'SELECT repo, num, mergeable FROM mergeable')
-    for repo_label, num, mergeable in db.fetchall():
+        queue_run['running'] = True
         try:
-            state = states[repo_label][num]
-        except KeyError:
-            db_query(
-                db,
-                'DELETE FROM mergeable WHERE repo = ? AND num = ?',
-                [repo_label, num])
-            continue
-
-        state.mergeable = bool(mergeable) if mergeable is not None else None
-
-    db_query(db, 'SELECT repo FROM pull GROUP BY repo')
-    for repo_label, in db.fetchall():
-        if repo_label not in repos:
-            db_query(db, 'DELETE FROM pull WHERE repo = ?', [repo_label])
-
-    queue_handler_lock = Lock()
+            while queue_run['requested']:
+                queue_run['requested'] = False
+                with metrics.process_queue_seconds.time():
+                    process_queue(states, repos, repo_cfgs, logger, buildbot_slots, db, git_cfg)  # noqa
+        finally:
+            queue_run['running'] = False
 
     def queue_handler():
-        with queue_handler_lock:
-            return process_queue(states, repos, repo_cfgs, logger, buildbot_slots, db, git_cfg)  # noqa
+        core.call(run_queue)
+
+    outbound.start(cfg['github'].get('outbound_workers',
+                                     outbound.DEFAULT_WORKERS))
+    scheduler.call_later(metrics.USAGE_LOG_INTERVAL, metrics.log_usage,
+                         logger.getChild('github_usage'))
 
     os.environ['GIT_SSH'] = os.path.join(os.path.dirname(__file__), 'git_helper.py')  # noqa
     os.environ['GIT_EDITOR'] = 'cat'
 
+    # Builds that were running when homu stopped still have to time out
+    for repo_label, repo_states in states.items():
+        timeout = repo_cfgs[repo_label].get('timeout', DEFAULT_TEST_TIMEOUT)
+        for state in repo_states.values():
+            if state.status == 'pending':
+                state.schedule_timeout(timeout)
+
+    logger.info('Started in {:.3f}s'.format(time.time() - started))
+
     from . import server
     Thread(
         target=server.start,
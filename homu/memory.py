@@ -0,0 +1,153 @@
+"""Memory footprint reports for the `memory` and `tracemalloc` admin
+commands.
+
+Sizes are approximate: they add up `sys.getsizeof` of the objects reachable
+from each pull request state, not counting what is shared between states
+(the repository, interned strings and small integers aside).
+"""
+
+import gc
+import resource
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+
+from .profiling import thread_name
+
+DEFAULT_TOP = 20
+DEFAULT_FRAMES = 10
+
+# Attributes of the states that point to shared objects
+SHARED_ATTRS = {'repository', 'timeout_timer', '__weakref__'}
+
+# Snapshot taken by `tracemalloc` with `action = "snapshot"`, that `top`
+# compares to
+_baseline = None
+
+
+def deep_size(obj, seen=None):
+    """The size of `obj` and of the containers and strings it holds."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen)
+                    for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+def state_size(state):
+    seen = set()
+    size = sys.getsizeof(state)
+    for attr in type(state).__slots__:
+        if attr not in SHARED_ATTRS:
+            size += deep_size(getattr(state, attr, None), seen)
+    return size
+
+
+def rss():
+    """The resident set size of the process, in bytes."""
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # Only the peak is available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def repo_report(repo_states, repo):
+    return {
+        'states': len(repo_states),
+        'bytes': sum(state_size(state) for state in repo_states.values()),
+        'builders': sum(len(state.build_res)
+                        for state in repo_states.values()),
+        'timers': sum(1 for state in repo_states.values()
+                      if state.timeout_timer is not None),
+        'change_log': len(repo.change_log) if repo is not None else 0,
+    }
+
+
+def report(states, repos, caches, queues, *, types=False, top=DEFAULT_TOP):
+    """Memory usage of the process, by repository and cache.
+
+    `caches` maps names to objects with a `usage()` method returning their
+    number of entries and size, and `queues` maps names to their length.
+    """
+    threads = Counter(thread_name(thread.name)
+                      for thread in threading.enumerate())
+
+    res = {
+        'rss': rss(),
+        'threads': dict(threads),
+        'repos': {
+            repo_label: repo_report(repo_states, repos.get(repo_label))
+            for repo_label, repo_states in states.items()
+        },
+        'caches': {},
+        'queues': queues,
+    }
+    for name, cache in caches.items():
+        entries, size = cache.usage()
+        res['caches'][name] = {'entries': entries, 'bytes': size}
+
+    if types:
+        # Walks every object tracked by the garbage collector: slow
+        counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+        res['types'] = dict(counts.most_common(top))
+
+    return res
+
+
+def tracemalloc_command(cmd):
+    global _baseline
+
+    action = cmd.get('action', 'top')
+    if action == 'start':
+        tracemalloc.start(cmd.get('frames', DEFAULT_FRAMES))
+        _baseline = None
+        return {'tracing': True}
+
+    if action == 'stop':
+        tracemalloc.stop()
+        _baseline = None
+        return {'tracing': False}
+
+    if not tracemalloc.is_tracing():
+        return {'error': 'tracemalloc is not started'}
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+    if action == 'snapshot':
+        _baseline = snapshot
+        return {'tracing': True}
+
+    group = cmd.get('group', 'lineno')
+    top = cmd.get('top', DEFAULT_TOP)
+    if _baseline is not None:
+        # What grew since the baseline
+        stats = snapshot.compare_to(_baseline, group)[:top]
+        sites = [{
+            'site': stat.traceback.format(),
+            'bytes': stat.size,
+            'bytes_diff': stat.size_diff,
+            'count': stat.count,
+            'count_diff': stat.count_diff,
+        } for stat in stats]
+    else:
+        stats = snapshot.statistics(group)[:top]
+        sites = [{
+            'site': stat.traceback.format(),
+            'bytes': stat.size,
+            'count': stat.count,
+        } for stat in stats]
+
+    current, peak = tracemalloc.get_traced_memory()
+    return {'traced': current, 'peak': peak, 'sites': sites}
@@ -0,0 +1,356 @@
+"""Metrics of the running instance, served on /metrics in the Prometheus text
+exposition format.
+
+There are only a few kinds of metrics here, so they are implemented directly
+rather than pulling in a client library. Every metric registers itself when
+it is created, and the whole registry is rendered on each scrape.
+"""
+
+import bisect
+import contextvars
+import re
+import time
+import urllib.parse
+from contextlib import contextmanager
+from threading import Lock
+
+from . import scheduler
+
+# Seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300)
+LOCK_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+SHA_RE = re.compile(r'[0-9a-f]{40}')
+USAGE_LOG_INTERVAL = 3600
+USAGE_LOG_TOP = 10
+
+_registry = []
+
+
+def escape(value):
+    return (str(value).replace('\\', r'\\')
+                      .replace('"', r'\"')
+                      .replace('\n', r'\n'))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in zip(names, values)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} expects the labels {}'.format(
+                self.name, ', '.join(self.labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """Yield the (suffix, label names, label values, value) of every
+        sample."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix,
+                                            format_labels(names, values),
+                                            format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield '', self.labels, key, value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """Read the value of this unlabelled gauge from `function` when the
+        metrics are collected."""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            yield '', (), (), self._function()
+            return
+
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield '', self.labels, key, value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # The count of each bucket, then the total count and sum
+            counts = self._values.get(key)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1) + [0, 0]
+                self._values[key] = counts
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self._values.items())
+
+        names = self.labels + ('le',)
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', names, key + (format_value(bound),), cumulative  # noqa
+            yield '_count', self.labels, key, counts[-2]
+            yield '_sum', self.labels, key, counts[-1]
+
+
+def render():
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+webhook_seconds = Histogram(
+    'homu_webhook_seconds',
+    'Time from receiving a webhook to the end of its handling',
+    ['event'],
+)
+webhook_lag_seconds = Gauge(
+    'homu_webhook_lag_seconds',
+    'How long the oldest webhook waiting to be handled has waited',
+)
+process_queue_seconds = Histogram(
+    'homu_process_queue_seconds',
+    'Duration of the passes over the queues',
+)
+mergeable_queue_depth = Gauge(
+    'homu_mergeable_queue_depth',
+    'Pull requests waiting for their mergeability to be checked',
+)
+mergeable_queue_lag_seconds = Gauge(
+    'homu_mergeable_queue_lag_seconds',
+    'How long the oldest pull request in the mergeability queue has waited',
+)
+mergeable_queue_wait_seconds = Histogram(
+    'homu_mergeable_queue_wait_seconds',
+    'Time pull requests wait for their mergeability to be checked',
+)
+db_lock_wait_seconds = Histogram(
+    'homu_db_lock_wait_seconds',
+    'Time spent waiting for the lock of the database cursor',
+    buckets=LOCK_BUCKETS,
+)
+github_requests = Counter(
+    'homu_github_requests_total',
+    'Requests made to the GitHub API',
+    ['method', 'endpoint', 'status'],
+)
+github_request_seconds = Histogram(
+    'homu_github_request_seconds',
+    'Latency of the requests made to the GitHub API',
+    ['method', 'endpoint'],
+)
+git_seconds = Histogram(
+    'homu_git_seconds',
+    'Duration of the git commands',
+    ['command'],
+)
+github_rate_limit_remaining = Gauge(
+    'homu_github_rate_limit_remaining',
+    'Requests left in the current GitHub rate limit window',
+    ['resource'],
+)
+log_records_dropped = Counter(
+    'homu_log_records_dropped_total',
+    'Log records dropped because the logging queue was full',
+)
+
+# The logical operations being run, outermost first. Contexts are carried
+# over to the core, the scheduler and the outbound queue, so that requests
+# are attributed to the operation that caused them wherever they are made.
+_operations = contextvars.ContextVar('operations', default=())
+
+
+@contextmanager
+def operation(name):
+    """Attribute the GitHub requests made in this block (or by this function,
+    as a decorator) to the operation `name`, nested in the current one."""
+    token = _operations.set(_operations.get() + (name,))
+    try:
+        yield
+    finally:
+        _operations.reset(token)
+
+
+def current_operation():
+    return '/'.join(_operations.get()) or 'other'
+
+
+class Usage:
+    """Cumulative GitHub API usage by operation."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._totals = {}
+
+    def record(self, operation, size, seconds):
+        with self._lock:
+            totals = self._totals.setdefault(operation, [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += size
+            totals[2] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                operation: {'requests': requests, 'bytes': size,
+                            'seconds': seconds}
+                for operation, (requests, size, seconds)
+                in self._totals.items()
+            }
+
+
+github_usage = Usage()
+
+
+def usage_report(usage, previous=None):
+    """The operations of a usage snapshot, most requests first, less what
+    they had in `previous`."""
+    previous = previous or {}
+    rows = []
+    for operation, totals in usage.items():
+        before = previous.get(operation, {})
+        row = {key: value - before.get(key, 0)
+               for key, value in totals.items()}
+        if row['requests']:
+            rows.append(dict(row, operation=operation))
+    rows.sort(key=lambda row: (-row['requests'], row['operation']))
+    return rows
+
+
+def log_usage(logger, previous=None):
+    """Log the GitHub API usage since the last summary, and do it again
+    later."""
+    usage = github_usage.snapshot()
+    try:
+        rows = usage_report(usage, previous)
+        if rows:
+            logger.info('GitHub API usage in the last {} minutes: {}'.format(
+                USAGE_LOG_INTERVAL // 60,
+                ', '.join('{operation}: {requests} requests, {bytes} bytes, '
+                          '{seconds:.1f}s'.format(**row)
+                          for row in rows[:USAGE_LOG_TOP]),
+            ))
+    finally:
+        scheduler.call_later(USAGE_LOG_INTERVAL, log_usage, logger, usage)
+
+
+def github_endpoint(url):
+    """The path of a GitHub API URL, with the parts identifying a particular
+    repository, pull request, commit or ref replaced by placeholders."""
+    parts = urllib.parse.urlsplit(url).path.strip('/').split('/')
+    if parts[0] == 'repos' and len(parts) >= 3:
+        parts[1:3] = ['{owner}', '{repo}']
+    if 'refs' in parts[:-1]:
+        parts[parts.index('refs') + 1:] = ['{ref}']
+
+    return '/' + '/'.join(
+        '{num}' if part.isdigit() else
+        '{sha}' if SHA_RE.fullmatch(part) else
+        part
+        for part in parts
+    )
+
+
+def observe_github_response(res, *args, **kwargs):
+    method = res.request.method
+    endpoint = github_endpoint(res.request.url)
+    seconds = res.elapsed.total_seconds()
+    github_requests.inc(method=method, endpoint=endpoint,
+                        status=res.status_code)
+    github_request_seconds.observe(seconds, method=method, endpoint=endpoint)
+    # None of the requests made to GitHub are streamed, so the body is read
+    # in full anyway
+    github_usage.record(current_operation(), len(res.content), seconds)
+
+    remaining = res.headers.get('X-RateLimit-Remaining')
+    if remaining is not None:
+        github_rate_limit_remaining.set(
+            int(remaining),
+            resource=res.headers.get('X-RateLimit-Resource', 'core'))
+
+
+def instrument_session(session):
+    """Record the requests made through a requests session."""
+    session.hooks['response'].append(observe_github_response)
+
+
+def git_command(args):
+    """The subcommand run by a git command line."""
+    args = iter(args[1:])
+    for arg in args:
+        if arg in ('-C', '-c'):
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+    return ''
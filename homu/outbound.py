@@ -0,0 +1,173 @@
+import contextvars
+import github3
+import itertools
+import requests
+import sys
+import time
+import traceback
+from queue import Queue
+from threading import Lock, Thread
+from urllib3.exceptions import NewConnectionError
+
+DEFAULT_WORKERS = 4
+RETRIES = 3
+# Longest wait for the rate limit to be lifted before sending again
+MAX_RATE_LIMIT_WAIT = 60
+
+
+class OutboundQueue:
+    """Sends comments, commit statuses and label updates from worker threads.
+
+    Every action is tied to a key (usually the repository label and pull
+    request number) and all the actions sharing a key are handled by the same
+    worker, in the order they were submitted. Actions submitted with a
+    `coalesce` key are dropped if a newer action with the same `coalesce` key
+    was submitted before they ran.
+
+    Failed actions are sent again when GitHub couldn't be reached, answered
+    with a server error or refused them because of the rate limit. Actions
+    that aren't `idempotent`, like creating a comment, are only sent again
+    when GitHub can't have applied them already.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, retries=RETRIES):
+        self.retries = retries
+        self._queues = [Queue() for _ in range(workers)]
+        self._seq = itertools.count()
+        self._latest = {}
+        self._lock = Lock()
+
+    def start(self):
+        for que in self._queues:
+            Thread(target=self._work, args=[que], daemon=True).start()
+
+    def submit(self, key, action, *, coalesce=None, description='',
+               idempotent=True):
+        seq = next(self._seq)
+        if coalesce is not None:
+            with self._lock:
+                self._latest[coalesce] = seq
+
+        que = self._queues[hash(key) % len(self._queues)]
+        que.put((seq, coalesce, action, description, idempotent,
+                 contextvars.copy_context()))
+
+    def join(self):
+        for que in self._queues:
+            que.join()
+
+    def pending(self):
+        return sum(que.qsize() for que in self._queues)
+
+    def _superseded(self, seq, coalesce):
+        if coalesce is None:
+            return False
+
+        with self._lock:
+            if self._latest.get(coalesce) != seq:
+                return True
+            del self._latest[coalesce]
+            return False
+
+    def _work(self, que):
+        while True:
+            seq, coalesce, action, description, idempotent, context = \
+                que.get()
+            try:
+                if not self._superseded(seq, coalesce):
+                    context.run(self._run, action, description, idempotent)
+            except Exception:
+                print('* Error while sending {} to GitHub'.format(description),
+                      file=sys.stderr)
+                traceback.print_exc()
+            finally:
+                que.task_done()
+
+    def _run(self, action, description, idempotent=True):
+        for i in range(self.retries, 0, -1):
+            try:
+                action()
+            except (github3.models.GitHubError, requests.exceptions.RequestException) as e:  # noqa
+                if i == 1 or not retryable(e, idempotent):
+                    raise
+
+                print('* Intermittent GitHub error while sending {}: {}'
+                      .format(description, e), file=sys.stderr)
+                time.sleep(retry_delay(e, 2 ** (self.retries - i)))
+            else:
+                return
+
+
+def rate_limited(error):
+    """Whether GitHub refused a request because of the rate limit."""
+    if not isinstance(error, github3.models.GitHubError) or error.code != 403:
+        return False
+    headers = error.response.headers
+    return (headers.get('X-RateLimit-Remaining') == '0' or
+            'Retry-After' in headers or
+            'rate limit' in str(error.msg).lower())
+
+
+def not_sent(error):
+    """Whether the request failed before reaching GitHub."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    reason = getattr(error.args[0] if error.args else None, 'reason', None)
+    return isinstance(reason, NewConnectionError)
+
+
+def retryable(error, idempotent=True):
+    """Whether an action that failed with `error` can be sent again."""
+    if rate_limited(error) or not_sent(error):
+        # Refused or never sent: GitHub didn't apply it
+        return True
+    if not idempotent:
+        return False
+    if isinstance(error, github3.models.GitHubError):
+        return error.code >= 500
+    return isinstance(error, requests.exceptions.ConnectionError)
+
+
+def retry_delay(error, backoff):
+    """Seconds to wait before sending again."""
+    if not rate_limited(error):
+        return backoff
+
+    headers = error.response.headers
+    try:
+        if 'Retry-After' in headers:
+            delay = float(headers['Retry-After'])
+        else:
+            delay = float(headers['X-RateLimit-Reset']) - time.time()
+    except (KeyError, ValueError):
+        delay = backoff
+    return min(max(delay, backoff), MAX_RATE_LIMIT_WAIT)
+
+
+_queue = None
+
+
+def start(workers=DEFAULT_WORKERS):
+    global _queue
+
+    _queue = OutboundQueue(workers)
+    _queue.start()
+
+
+def submit(key, action, *, coalesce=None, description='', idempotent=True):
+    """Queue an outbound GitHub write.
+
+    The action runs synchronously when the background workers haven't been
+    started, e.g. in tests and tools.
+    """
+    if _queue is None:
+        action()
+    else:
+        _queue.submit(key, action, coalesce=coalesce, description=description,
+                      idempotent=idempotent)
+
+
+def pending():
+    return _queue.pending() if _queue else 0
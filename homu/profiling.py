@@ -0,0 +1,169 @@
+"""Profiling a running instance through admin commands.
+
+`profile` samples the stacks of all the threads (web server, core, scheduler,
+outbound, mergeability and sync threads) for a few seconds and returns them
+collapsed, one line per distinct stack with the number of samples it was
+seen in, ready for flamegraph tools. Sampling only reads the frames from a
+separate thread, so the profiled code isn't slowed down.
+
+`profile_webhooks` runs cProfile around the handlers of the given webhook
+events for a few seconds instead, and returns the pstats report of all the
+handlers that ran in the meantime. Handlers take turns on the core, and the
+time a handler spends waiting for the others to give it back isn't counted:
+its profile only covers what the handler itself did, waits on GitHub and git
+included.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from . import core
+
+DEFAULT_INTERVAL = 0.01
+MIN_INTERVAL = 0.001
+DEFAULT_SECONDS = 10
+# The response has to come back before the proxies in front give up
+MAX_SECONDS = 30
+STATS_LIMIT = 50
+
+THREAD_NUMBER_RE = re.compile(r'[-_]?\d+$')
+
+_sampling = threading.Lock()
+
+
+def frame_name(code):
+    path = os.path.join(*code.co_filename.split(os.sep)[-2:])
+    return '{} ({}:{})'.format(code.co_name, path, code.co_firstlineno)
+
+
+def thread_name(name):
+    # Threads of the same pool are merged
+    return THREAD_NUMBER_RE.sub('', name) or name
+
+
+def sample(seconds, interval=DEFAULT_INTERVAL):
+    """Sample the stacks of all the other threads every `interval` seconds.
+
+    Returns the number of times each collapsed stack was seen, and the
+    number of samples taken.
+    """
+    me = threading.get_ident()
+    stacks = Counter()
+    samples = 0
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(thread_name(names.get(ident, str(ident))))
+            stacks[';'.join(reversed(stack))] += 1
+
+        samples += 1
+        time.sleep(interval)
+
+    return stacks, samples
+
+
+def collapsed(stacks):
+    return ''.join('{} {}\n'.format(stack, count)
+                   for stack, count in stacks.most_common())
+
+
+class HandlerProfiles:
+    """cProfile runs of the handlers enabled for profiling."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = frozenset()
+        self._profiles = []
+
+    def start(self, names):
+        with self._lock:
+            self._names = frozenset(names)
+            self._profiles = []
+
+    def stop(self):
+        with self._lock:
+            profiles = self._profiles
+            self._names = frozenset()
+            self._profiles = []
+        return profiles
+
+    @contextmanager
+    def profile(self, name):
+        if name not in self._names:
+            yield
+            return
+
+        profile = cProfile.Profile(core.clock)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                if name in self._names:
+                    self._profiles.append(profile)
+
+
+handlers = HandlerProfiles()
+
+
+def profile_handler(name):
+    """Run the block under cProfile if handlers called `name` are being
+    profiled."""
+    return handlers.profile(name)
+
+
+def stats_report(profiles, sort='cumulative', limit=STATS_LIMIT):
+    if not profiles:
+        return 'No profiled handler ran\n'
+
+    out = io.StringIO()
+    stats = pstats.Stats(profiles[0], stream=out)
+    for profile in profiles[1:]:
+        stats.add(profile)
+    stats.sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def command(cmd):
+    """Run the profiling admin command `cmd`, which takes the time it
+    profiles for. It must not run on the core, which it would hold up."""
+    seconds = min(float(cmd.get('seconds', DEFAULT_SECONDS)), MAX_SECONDS)
+
+    if not _sampling.acquire(blocking=False):
+        return 'A profile is already running'
+    try:
+        if cmd['cmd'] == 'profile':
+            interval = max(float(cmd.get('interval', DEFAULT_INTERVAL)),
+                           MIN_INTERVAL)
+            stacks, samples = sample(seconds, interval)
+            return '# {} samples\n{}'.format(samples, collapsed(stacks))
+
+        handlers.start(['webhook:' + event for event in cmd['events']])
+        try:
+            time.sleep(seconds)
+        finally:
+            profiles = handlers.stop()
+        return stats_report(profiles, cmd.get('sort', 'cumulative'))
+    finally:
+        _sampling.release()
+
+
+COMMANDS = {'profile', 'profile_webhooks'}
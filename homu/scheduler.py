@@ -0,0 +1,116 @@
+import contextvars
+import heapq
+import itertools
+import queue
+import sys
+import time
+import traceback
+from threading import Condition, Thread
+
+DEFAULT_WORKERS = 4
+
+
+class Handle:
+    __slots__ = ['when', 'callback', 'args', 'context', 'cancelled']
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.context = contextvars.copy_context()
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """Runs delayed callbacks: timers, retries and backoffs.
+
+    Pending callbacks are kept in a heap ordered by their deadline, and a
+    single thread sleeps until the earliest one is due. Due callbacks are
+    handed to a fixed pool of workers, so a slow callback doesn't delay the
+    others. Times are wall-clock timestamps, which allows deadlines to be
+    persisted across restarts.
+
+    Like the core, the workers are daemon threads rather than an executor,
+    which would refuse work once the main thread is done.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = Condition()
+        self._thread = None
+        self._due = queue.Queue()
+
+    def call_at(self, when, callback, *args):
+        handle = Handle(when, callback, args)
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._counter), handle))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+                for i in range(self.workers):
+                    Thread(target=self._work, name='scheduler-{}'.format(i),
+                           daemon=True).start()
+            self._cond.notify()
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def pending(self):
+        with self._cond:
+            return sum(1 for _, _, handle in self._heap
+                       if not handle.cancelled)
+
+    def _next(self):
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                delay = self._heap[0][0] - time.time()
+                if delay <= 0:
+                    return heapq.heappop(self._heap)[2]
+                self._cond.wait(delay)
+
+    def _run(self):
+        while True:
+            self._due.put(self._next())
+
+    def _work(self):
+        while True:
+            self._call(self._due.get())
+
+    def _call(self, handle):
+        if handle.cancelled:
+            return
+
+        try:
+            handle.context.run(handle.callback, *handle.args)
+        except Exception:
+            print('* Error in scheduled callback {!r}'
+                  .format(handle.callback), file=sys.stderr)
+            traceback.print_exc()
+
+
+_scheduler = Scheduler()
+
+
+def call_at(when, callback, *args):
+    return _scheduler.call_at(when, callback, *args)
+
+
+def call_later(delay, callback, *args):
+    return _scheduler.call_later(delay, callback, *args)
+
+
+def pending():
+    return _scheduler.pending()
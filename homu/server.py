@@ -1,19 +1,36 @@
+import datetime
+import email.utils
+import gzip
+import hashlib
 import hmac
 import json
+import sqlite3
+import time
 import urllib.parse
 from .main import (
     PullReqState,
+    body_cache,
     parse_commands,
+    queue_changed,
     db_query,
     IGNORE_BLOCK_END,
     IGNORE_BLOCK_START,
     INTERRUPTED_BY_HOMU_RE,
     suppress_ignore_block,
     suppress_pings,
-    synchronize,
+    synchronize_or_retry,
     LabelEvent,
 )
 from . import comments
+from . import core
+from . import health
+from . import logs
+from . import memory
+from . import metrics
+from . import outbound
+from . import profiling
+from . import scheduler
+from . import tracing
 from . import utils
 from .utils import lazy_debug
 import github3
@@ -30,18 +47,21 @@ from bottle import (
     response,
     error,
 )
-from threading import Thread
+from collections import OrderedDict
+from threading import BoundedSemaphore, Lock, Thread
 import sys
 import os
-import traceback
-from retrying import retry
 import random
 import string
-import time
 
 import bottle
 bottle.BaseRequest.MEMFILE_MAX = 1024 * 1024 * 10
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 class G:
     pass
@@ -57,6 +77,18 @@ ROLLUP_STR = {
     1: 'always',
 }
 
+QUEUE_SNAPSHOTS = 64
+# Seconds
+EVENTS_WAIT = 5
+EVENTS_RETRY = 5
+DEFAULT_THREADS = 16
+DEFAULT_EVENT_STREAMS = 8
+BROTLI_QUALITY = 5
+
+FAST_FORWARD_DELAY = 60
+FAST_FORWARD_ATTEMPTS = 5
+FAST_FORWARD_RETRY_DELAY = 10
+
 
 def find_state(sha):
     for repo_label, repo_states in g.states.items():
@@ -93,10 +125,16 @@ def result(repo_label, pull):
         abort(404, 'No build results for pull request {}'.format(pull))
 
     state = states[0]
-    builders = []
     repo_url = 'https://github.com/{}/{}'.format(
         g.cfg['repo'][repo_label]['owner'],
         g.cfg['repo'][repo_label]['name'])
+
+    return g.tpls['build_res'].render(repo_label=repo_label, repo_url=repo_url,
+                                      builders=build_results(state), pull=pull)
+
+
+def build_results(state):
+    builders = []
     for (builder, data) in state.build_res.items():
         result = "pending"
         if data['res'] is not None:
@@ -112,8 +150,198 @@ def result(repo_label, pull):
 
         builders.append(builder_details)
 
-    return g.tpls['build_res'].render(repo_label=repo_label, repo_url=repo_url,
-                                      builders=builders, pull=pull)
+    return builders
+
+
+class QueueSnapshots:
+    """Rendered queue pages, rebuilt only when one of their repositories
+    changes."""
+
+    def __init__(self, size=QUEUE_SNAPSHOTS):
+        self.size = size
+        self._snapshots = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, versions, render):
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and snapshot.versions == versions:
+                self._snapshots.move_to_end(key)
+                return snapshot
+
+        # Rendering happens outside of the lock; at worst a page is rendered
+        # twice by concurrent requests
+        snapshot = QueueSnapshot.render(versions, render)
+
+        with self._lock:
+            self._snapshots[key] = snapshot
+            self._snapshots.move_to_end(key)
+            while len(self._snapshots) > self.size:
+                self._snapshots.popitem(last=False)
+
+        return snapshot
+
+    def usage(self):
+        with self._lock:
+            return (len(self._snapshots),
+                    sum(len(body) for snapshot in self._snapshots.values()
+                        for body in snapshot.bodies.values()))
+
+
+class QueueSnapshot:
+    __slots__ = ['versions', 'etag', 'last_modified', 'bodies']
+
+    @classmethod
+    def render(cls, versions, render):
+        self = cls()
+        self.versions = versions
+
+        body = render().encode('utf-8')
+        self.etag = 'W/"{}"'.format(hashlib.sha1(body).hexdigest())
+        self.last_modified = int(max((changed_at for _, _, changed_at
+                                      in versions), default=time.time()))
+        self.bodies = {
+            'identity': body,
+            'gzip': gzip.compress(body, mtime=0),
+        }
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(body, quality=BROTLI_QUALITY)
+
+        return self
+
+    def response(self):
+        response.set_header('ETag', self.etag)
+        # Dates only have a resolution of a second, and the queue may still
+        # change in the second it last changed in, without its date changing.
+        # So until that second is over there is no date to revalidate with,
+        # lest clients get a 304 for the version before that change.
+        dated = self.last_modified < int(time.time())
+        if dated:
+            response.set_header('Last-Modified',
+                                email.utils.formatdate(self.last_modified,
+                                                       usegmt=True))
+        # Always revalidate, the queue changes all the time
+        response.set_header('Cache-Control', 'no-cache')
+        response.set_header('Vary', 'Accept-Encoding')
+
+        if_none_match = request.headers.get('If-None-Match')
+        if_modified_since = request.headers.get('If-Modified-Since')
+        if if_none_match is not None:
+            not_modified = self.etag in [etag.strip() for etag
+                                         in if_none_match.split(',')]
+        elif if_modified_since is not None and dated:
+            since = bottle.parse_date(if_modified_since)
+            not_modified = since is not None and since >= self.last_modified
+        else:
+            not_modified = False
+
+        if not_modified:
+            response.status = 304
+            return b''
+
+        encodings = accepted_encodings()
+        for encoding in ['br', 'gzip']:
+            if encoding in encodings and encoding in self.bodies:
+                response.set_header('Content-Encoding', encoding)
+                return self.bodies[encoding]
+        return self.bodies['identity']
+
+
+def accepted_encodings():
+    encodings = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        encoding, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(encoding.strip().lower())
+    return encodings
+
+
+queue_snapshots = QueueSnapshots()
+
+
+def queue_labels(repo_label):
+    if repo_label == 'all':
+        return sorted(g.repos)
+
+    labels = repo_label.split('+')
+    for label in labels:
+        if label not in g.states:
+            abort(404, 'No such repository: {}'.format(label))
+    return labels
+
+
+def sse(event, data, version=None):
+    msg = ''
+    if version is not None:
+        msg += 'id: {}\n'.format(version)
+    return msg + 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+
+
+# Must come before the queue page, which would match it as well
+@get('/queue/<repo_label:path>/events')
+def queue_events(repo_label):
+    """Send the changes of the queue as server-sent events.
+
+    Each request is a short long-poll: it waits up to `EVENTS_WAIT` seconds
+    for changes, sends them and ends. The browser reconnects `EVENTS_RETRY`
+    seconds later, resuming from the last event it got, so that a page left
+    open doesn't keep a server thread to itself.
+    """
+    labels = queue_labels(repo_label)
+
+    last = (request.headers.get('Last-Event-ID') or
+            request.query.get('since'))
+    try:
+        last = int(last)
+    except (TypeError, ValueError):
+        abort(400, 'Missing or invalid version')
+
+    if not g.event_streams.acquire(blocking=False):
+        abort(503, 'Too many event streams, try again later')
+
+    def stream():
+        try:
+            yield 'retry: {}\n\n'.format(EVENTS_RETRY * 1000)
+
+            repos = [g.repos[label] for label in labels]
+            deadline = time.time() + EVENTS_WAIT
+            with queue_changed:
+                while max(repo.version for repo in repos) == last:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    queue_changed.wait(remaining)
+
+            # Read before the changes, so that none is missed
+            version = max(repo.version for repo in repos)
+            changes = queue_changes(labels, repos, last)
+            if changes is None:
+                # Too much changed, the page has to be reloaded
+                yield sse('reset', {})
+                return
+
+            for label, nums in changes.items():
+                for num in nums:
+                    state = g.states[label].get(num)
+                    yield sse('change', {
+                        'repo_label': label,
+                        'num': num,
+                        'row': api_row(state) if state else None,
+                    }, version)
+        finally:
+            g.event_streams.release()
+
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+    # Ask reverse proxies to pass the events through as they come
+    response.set_header('X-Accel-Buffering', 'no')
+    return stream()
 
 
 @get('/queue/<repo_label:path>')
@@ -121,6 +349,26 @@ def queue(repo_label):
     if repo_label not in g.cfg['repo'] and repo_label != 'all':
         abort(404)
 
+    if repo_label == 'all':
+        labels = sorted(g.repos)
+    else:
+        labels = repo_label.split('+')
+    # The version of each repository, and when it last changed
+    versions = tuple((label,
+                      getattr(g.repos.get(label), 'version', None),
+                      getattr(g.repos.get(label), 'changed_at', 0))
+                     for label in labels)
+
+    # The page picks up the live changes from there
+    version = max((version or 0 for _, version, _ in versions), default=0)
+
+    key = (repo_label, request.query.get('prs', ''))
+    snapshot = queue_snapshots.get(key, versions,
+                                   lambda: render_queue(repo_label, version))
+    return snapshot.response()
+
+
+def render_queue(repo_label, version=None):
     logger = g.logger.getChild('queue')
 
     lazy_debug(logger, lambda: 'repo_label: {}'.format(repo_label))
@@ -153,36 +401,7 @@ def queue(repo_label):
         prechecked_prs = set(request.query.get('prs').split(','))
 
     pull_states = sorted(states)
-    rows = []
-    for state in pull_states:
-        treeclosed = (single_repo_closed and
-                      state.priority < g.repos[state.repo_label].treeclosed)
-        status_ext = ''
-
-        if state.try_:
-            status_ext += ' (try)'
-
-        rows.append({
-            'status': state.get_status(),
-            'status_ext': status_ext,
-            'priority': state.priority,
-            'rollup': ROLLUP_STR.get(state.rollup, ''),
-            'prechecked': str(state.num) in prechecked_prs,
-            'url': 'https://github.com/{}/{}/pull/{}'.format(state.owner,
-                                                             state.name,
-                                                             state.num),
-            'num': state.num,
-            'approved_by': state.approved_by,
-            'title': state.title,
-            'head_ref': state.head_ref,
-            'mergeable': ('yes' if state.mergeable is True else
-                          'no' if state.mergeable is False else ''),
-            'assignee': state.assignee,
-            'repo_label': state.repo_label,
-            'repo_url': 'https://github.com/{}/{}'.format(state.owner,
-                                                          state.name),
-            'greyed': "treeclosed" if treeclosed else "",
-        })
+    rows = queue_rows(pull_states, prechecked_prs, single_repo_closed)
 
     return g.tpls['queue'].render(
         repo_url=repo_url,
@@ -197,40 +416,333 @@ def queue(repo_label):
         failed=len([x for x in pull_states if x.status == 'failure' or
                    x.status == 'error']),
         multiple=multiple,
+        version=version,
     )
 
 
-@get('/retry_log/<repo_label:path>')
-def retry_log(repo_label):
+@get('/shard/queue/<repo_label:path>')
+def shard_queue(repo_label):
+    # Used by the front process of a sharded homu to render queues spanning
+    # several shards
+    states = []
+    for label in repo_label.split('+'):
+        states += g.states.get(label, {}).values()
+
+    pull_states = sorted(states)
+    rows = queue_rows(pull_states, set())
+    for row, state in zip(rows, pull_states):
+        row['sort_key'] = state.sort_key()
+
+    return {
+        'rows': rows,
+        'approved': len([x for x in pull_states if x.approved_by]),
+        'rolled_up': len([x for x in pull_states if x.rollup > 0]),
+        'failed': len([x for x in pull_states if x.status == 'failure' or
+                      x.status == 'error']),
+    }
+
+
+@get('/shard/repos')
+def shard_repos():
+    return {'repos': [{'repo_label': label,
+                       'treeclosed': g.repos[label].treeclosed}
+                      for label in sorted(g.repos)]}
+
+
+def queue_rows(pull_states, prechecked_prs, single_repo_closed=None):
+    return [queue_row(state, prechecked_prs, single_repo_closed)
+            for state in pull_states]
+
+
+def queue_row(state, prechecked_prs, single_repo_closed=None):
+    treeclosed = (single_repo_closed and
+                  state.priority < g.repos[state.repo_label].treeclosed)
+    status_ext = ''
+
+    if state.try_:
+        status_ext += ' (try)'
+
+    return {
+        'status': state.get_status(),
+        'status_ext': status_ext,
+        'priority': state.priority,
+        'rollup': ROLLUP_STR.get(state.rollup, ''),
+        'prechecked': str(state.num) in prechecked_prs,
+        'url': 'https://github.com/{}/{}/pull/{}'.format(state.owner,
+                                                         state.name,
+                                                         state.num),
+        'num': state.num,
+        'approved_by': state.approved_by,
+        'title': state.title,
+        'head_ref': state.head_ref,
+        'mergeable': ('yes' if state.mergeable is True else
+                      'no' if state.mergeable is False else ''),
+        'assignee': state.assignee,
+        'repo_label': state.repo_label,
+        'repo_url': 'https://github.com/{}/{}'.format(state.owner,
+                                                      state.name),
+        'greyed': "treeclosed" if treeclosed else "",
+    }
+
+
+def api_row(state):
+    row = queue_row(state, set())
+    # Presentation only
+    del row['prechecked']
+    del row['greyed']
+    row['treeclosed'] = state.priority < state.repository.treeclosed
+    row['version'] = state.version
+    return row
+
+
+API_QUEUE_FIELDS = [
+    'status', 'status_ext', 'priority', 'rollup', 'url', 'num',
+    'approved_by', 'title', 'head_ref', 'mergeable', 'assignee',
+    'repo_label', 'repo_url', 'treeclosed', 'version',
+]
+API_RESULTS_FIELDS = [
+    'repo_label', 'num', 'status', 'merge_sha', 'version', 'builders',
+]
+# Number of rows serialized at once when streaming
+API_CHUNK_SIZE = 100
+RETRY_LOG_PAGE_SIZE = 100
+RETRY_LOG_MAX_PAGE_SIZE = 1000
+
+
+def api_fields(known):
+    if not request.query.get('fields'):
+        return None
+
+    fields = request.query.get('fields').split(',')
+    unknown = [field for field in fields if field not in known]
+    if unknown:
+        abort(400, 'Unknown fields: {}'.format(', '.join(unknown)))
+    return fields
+
+
+def select_fields(row, fields):
+    if fields is None:
+        return row
+    return {field: row[field] for field in fields}
+
+
+def queue_changes(labels, repos, since):
+    """The numbers of the pull requests changed after the version `since`,
+    by repository, or None when only a full view of the queue is up to
+    date."""
+    if since is None:
+        return None
+
+    changes = {}
+    for label, repo in zip(labels, repos):
+        if not repo.changes_known_since(since):
+            return None
+
+        nums = {num for _, num in repo.changes_since(since)}
+        # A change to the whole repository, e.g. a tree closure
+        if None in nums:
+            return None
+        changes[label] = sorted(nums)
+
+    return changes
+
+
+@get('/api/queue/<repo_label:path>')
+def api_queue(repo_label):
+    labels = queue_labels(repo_label)
+    fields = api_fields(API_QUEUE_FIELDS)
+    since = request.query.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            abort(400, 'Invalid version: {}'.format(since))
+
+    # The version has to be read before the states, so that clients asking
+    # for the changes since this version don't miss any
+    repos = [g.repos[label] for label in labels]
+    version = max((repo.version for repo in repos), default=0)
+    changes = queue_changes(labels, repos, since)
+    full = changes is None
+
+    states = []
+    removed = []
+    for label in labels:
+        if full:
+            states += list(g.states[label].values())
+            continue
+
+        for num in changes[label]:
+            state = g.states[label].get(num)
+            if state is None:
+                removed.append({'repo_label': label, 'num': num})
+            else:
+                states.append(state)
+    pull_states = sorted(states)
+
+    head = {'version': version, 'full': full}
+    if not full:
+        head['removed'] = removed
+
+    def stream():
+        # Rows are serialized as they are sent, so that the whole response
+        # never has to be held in memory
+        yield json.dumps(head)[:-1] + ', "rows": ['
+        for i in range(0, len(pull_states), API_CHUNK_SIZE):
+            chunk = pull_states[i:i + API_CHUNK_SIZE]
+            yield (', ' if i else '') + ', '.join(
+                json.dumps(select_fields(api_row(state), fields))
+                for state in chunk
+            )
+        yield ']}'
+
+    response.content_type = 'application/json'
+    return stream()
+
+
+@get('/api/results/<repo_label:path>/<pull:int>')
+def api_results(repo_label, pull):
+    if repo_label not in g.states:
+        abort(404, 'No such repository: {}'.format(repo_label))
+    state = g.states[repo_label].get(pull)
+    if state is None:
+        abort(404, 'No build results for pull request {}'.format(pull))
+
+    fields = api_fields(API_RESULTS_FIELDS)
+
+    return select_fields({
+        'repo_label': repo_label,
+        'num': state.num,
+        'status': state.get_status(),
+        'merge_sha': state.merge_sha,
+        'version': state.version,
+        'builders': build_results(state),
+    }, fields)
+
+
+def retry_log_db():
+    """A connection of its own to the database, so that browsing the retry
+    log doesn't hold the lock of the shared cursor."""
+    db_file = g.cfg.get('db', {}).get('file', 'main.db')
+    return sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(db_file)),  # noqa
+                           uri=True)
+
+
+def parse_date(name):
+    value = request.query.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date().isoformat()  # noqa
+    except ValueError:
+        abort(400, 'Invalid date for {}: {}'.format(name, value))
+
+
+def parse_cursor(value):
+    """The (time, rowid) of a retry log cursor."""
+    when, _, rowid = value.rpartition(',')
+    try:
+        return when, int(rowid)
+    except ValueError:
+        abort(400, 'Invalid cursor: {}'.format(value))
+
+
+def retry_log_page(repo_label):
+    """Query one page of the retry log, newest first, with the filters of the
+    request.
+
+    Pages are delimited by the time and id of the last entry of the previous
+    page rather than by an offset, so that the indexes on the time are used
+    all the way down. The cursor carries both, so that it still works once
+    that entry has expired.
+    """
     if repo_label not in g.cfg['repo']:
         abort(404)
 
+    try:
+        limit = min(int(request.query.get('limit', RETRY_LOG_PAGE_SIZE)),
+                    RETRY_LOG_MAX_PAGE_SIZE)
+        num = int(request.query.num) if request.query.get('num') else None
+    except ValueError:
+        abort(400, 'Invalid number')
+    before = None
+    if request.query.get('before'):
+        before = parse_cursor(request.query.before)
+    since = parse_date('since')
+    until = parse_date('until')
+    user = request.query.get('user')
+
+    where = ['repo = ?']
+    args = [repo_label]
+    if num is not None:
+        where.append('num = ?')
+        args.append(num)
+    if user:
+        where.append('user = ?')
+        args.append(user)
+    if since:
+        where.append('time >= ?')
+        args.append(since)
+    if until:
+        where.append("time < date(?, '+1 day')")
+        args.append(until)
+    if before is not None:
+        where.append('(time, rowid) < (?, ?)')
+        args.extend(before)
+
+    conn = retry_log_db()
+    try:
+        rows = conn.execute(
+            '''
+                SELECT rowid, num, time, src, msg, user FROM retry_log
+                WHERE {} ORDER BY time DESC, rowid DESC LIMIT ?
+            '''.format(' AND '.join(where)),
+            args + [limit + 1],
+        ).fetchall()
+    finally:
+        conn.close()
+
+    logs = [
+        {'id': rowid, 'num': num, 'time': time, 'src': src, 'msg': msg,
+         'user': user}
+        for rowid, num, time, src, msg, user in rows[:limit]
+    ]
+    return {
+        'logs': logs,
+        'next': ('{},{}'.format(logs[-1]['time'], logs[-1]['id'])
+                 if len(rows) > limit else None),
+    }
+
+
+@get('/api/retry_log/<repo_label:path>')
+def api_retry_log(repo_label):
+    return retry_log_page(repo_label)
+
+
+@get('/retry_log/<repo_label:path>')
+def retry_log(repo_label):
     logger = g.logger.getChild('retry_log')
 
     lazy_debug(logger, lambda: 'repo_label: {}'.format(repo_label))
 
+    page = retry_log_page(repo_label)
+
     repo_url = 'https://github.com/{}/{}'.format(
         g.cfg['repo'][repo_label]['owner'],
         g.cfg['repo'][repo_label]['name'],
     )
 
-    db_query(
-        g.db,
-        '''
-            SELECT num, time, src, msg FROM retry_log
-            WHERE repo = ? ORDER BY time DESC
-        ''',
-        [repo_label],
-    )
-    logs = [
-        {'num': num, 'time': time, 'src': src, 'msg': msg}
-        for num, time, src, msg in g.db.fetchall()
-    ]
+    next_url = None
+    if page['next'] is not None:
+        query = dict(request.query, before=page['next'])
+        next_url = '?' + urllib.parse.urlencode(query)
 
     return g.tpls['retry_log'].render(
         repo_url=repo_url,
         repo_label=repo_label,
-        logs=logs,
+        logs=page['logs'],
+        next_url=next_url,
+        filters=request.query,
     )
 
 
@@ -319,15 +831,15 @@ def rollup(user_gh, state, repo_label, repo_cfg, repo):
             failures.append(state)
             continue
 
-        state.body = suppress_pings(state.body or "")
-        state.body = suppress_ignore_block(state.body)
+        body = suppress_pings(state.body or "")
+        body = suppress_ignore_block(body)
 
         merge_msg = 'Rollup merge of #{} - {}, r={}\n\n{}\n\n{}'.format(
             state.num,
             state.head_ref,
             state.approved_by,
             state.title,
-            state.body,
+            body,
         )
 
         try:
@@ -388,7 +900,7 @@ def github():
     payload = request.body.read()
     info = request.json
 
-    lazy_debug(logger, lambda: 'info: {}'.format(utils.remove_url_keys_from_json(info)))  # noqa
+    logger.debug('info', extra={'payload': logs.Payload(info)})
 
     owner_info = info['repository']['owner']
     owner = owner_info.get('login') or owner_info['name']
@@ -405,6 +917,25 @@ def github():
 
     event_type = request.headers['X-Github-Event']
 
+    # GitHub only needs to know that the event was delivered
+    core.dispatch(handle_webhook, time.perf_counter(), health.event_received(),
+                  event_type, info, repo_label, repo_cfg, logger)
+
+    return 'OK'
+
+
+def handle_webhook(received, token, event_type, *args):
+    health.event_started(token)
+    try:
+        with metrics.operation('webhook:' + event_type), \
+                profiling.profile_handler('webhook:' + event_type):
+            handle_github_event(event_type, *args)
+    finally:
+        metrics.webhook_seconds.observe(time.perf_counter() - received,
+                                        event=event_type)
+
+
+def handle_github_event(event_type, info, repo_label, repo_cfg, logger):
     if event_type == 'pull_request_review_comment':
         action = info['action']
         original_commit_id = info['comment']['original_commit_id']
@@ -451,13 +982,7 @@ def github():
             state.save()
 
         elif action in ['opened', 'reopened']:
-            state = PullReqState(pull_num, head_sha, '', g.db, repo_label,
-                                 g.mergeable_que, g.gh,
-                                 info['repository']['owner']['login'],
-                                 info['repository']['name'],
-                                 repo_cfg.get('labels', {}),
-                                 g.repos,
-                                 repo_cfg.get('test-on-fork'))
+            state = PullReqState(pull_num, head_sha, '', g.repos[repo_label])
             state.title = info['pull_request']['title']
             state.body = info['pull_request']['body']
             state.head_ref = info['pull_request']['head']['repo']['owner']['login'] + ':' + info['pull_request']['head']['ref']  # noqa
@@ -465,6 +990,8 @@ def github():
             state.set_mergeable(info['pull_request']['mergeable'])
             state.assignee = (info['pull_request']['assignee']['login'] if
                               info['pull_request']['assignee'] else '')
+            state.labels = {label['name']
+                            for label in info['pull_request']['labels']}
 
             found = False
 
@@ -498,13 +1025,18 @@ def github():
             state.save()
 
             g.states[repo_label][pull_num] = state
+            state.changed()
 
             if found:
                 g.queue_handler()
 
         elif action == 'closed':
             state = g.states[repo_label][pull_num]
-            if hasattr(state, 'fake_merge_sha'):
+            if state.approved_by and state.status != 'success':
+                # Closed without being merged
+                tracing.record('unapproval', state, time.time())
+            tracing.forget(state)
+            if state.fake_merge_sha:
                 def inner():
                     utils.github_set_ref(
                         state.get_repo(),
@@ -519,9 +1051,11 @@ def github():
                                       ' ({})'.format(state.fake_merge_sha,
                                                      err))
 
-                utils.retry_until(inner, fail, state)
+                utils.retry_later(inner, fail, state)
 
             del g.states[repo_label][pull_num]
+            g.repos[repo_label].changed(pull_num)
+            body_cache.discard(repo_label, pull_num)
 
             db_query(g.db, 'DELETE FROM pull WHERE repo = ? AND num = ?',
                      [repo_label, pull_num])
@@ -539,6 +1073,17 @@ def github():
 
             state.save()
 
+        elif action in ['labeled', 'unlabeled']:
+            # Only the label of the event is applied: the list of labels of
+            # the payload may be older than the changes homu made since
+            state = g.states[repo_label].get(pull_num)
+            if state:
+                label = info['label']['name']
+                if action == 'labeled':
+                    state.labels_changed(added=[label])
+                else:
+                    state.labels_changed(removed=[label])
+
         elif action == 'edited':
             state = g.states[repo_label][pull_num]
 
@@ -595,6 +1140,9 @@ def github():
         if action == 'created' and 'pull_request' in info['issue'] and state:
             state.title = info['issue']['title']
             state.body = info['issue']['body']
+            if state.labels is None:
+                state.labels = {label['name']
+                                for label in info['issue']['labels']}
 
             if parse_commands(
                 body,
@@ -674,6 +1222,61 @@ def github():
     return 'OK'
 
 
+@metrics.operation('fast_forward')
+def fast_forward(state, url, repo_cfg, attempt):
+    if attempt == 0:
+        state.add_comment(comments.BuildCompleted(
+            approved_by=state.approved_by,
+            base_ref=state.base_ref,
+            builders={k: v["url"] for k, v in state.build_res.items()},
+            merge_sha=state.merge_sha,
+        ))
+        state.change_labels(LabelEvent.SUCCEED)
+
+    def set_ref_inner():
+        utils.github_set_ref(state.get_repo(), 'heads/' +
+                             state.base_ref, state.merge_sha)
+        if state.test_on_fork is not None:
+            utils.github_set_ref(state.get_test_on_fork_repo(),
+                                 'heads/' + state.base_ref,
+                                 state.merge_sha, force=True)
+
+    def set_ref():
+        try:
+            set_ref_inner()
+        except github3.models.GitHubError:
+            utils.github_create_status(
+                state.get_repo(),
+                state.merge_sha,
+                'success', '',
+                'Branch protection bypassed',
+                context='homu')
+            set_ref_inner()
+
+    try:
+        with tracing.span('fast_forward', state, attempt=attempt) as attrs:
+            attrs['success'] = False
+            set_ref()
+            attrs['success'] = True
+        state.fake_merge(repo_cfg)
+        tracing.record_since('merge', state, 'approved')
+    except github3.models.GitHubError as e:
+        if attempt + 1 < FAST_FORWARD_ATTEMPTS:
+            scheduler.call_later(FAST_FORWARD_RETRY_DELAY, core.dispatch,
+                                 fast_forward, state, url, repo_cfg,
+                                 attempt + 1)
+            return
+
+        state.set_status('error')
+        desc = ('Test was successful, but fast-forwarding failed:'
+                ' {}'.format(e))
+        state.create_status('error', url, desc)
+
+        state.add_comment(':eyes: ' + desc)
+
+    g.queue_handler()
+
+
 def report_build_res(succ, url, builder, state, logger, repo_cfg):
     lazy_debug(logger,
                lambda: 'build result {}: builder = {}, succ = {}, current build_res = {}'  # noqa
@@ -681,74 +1284,24 @@ def report_build_res(succ, url, builder, state, logger, repo_cfg):
                                state.build_res_summary()))
 
     state.set_build_res(builder, succ, url)
+    tracing.record('ci:' + builder, state, state.test_started, success=succ,
+                   try_build=state.try_)
 
     if succ:
         if all(x['res'] for x in state.build_res.values()):
             state.set_status('success')
-            utils.github_create_status(
-                state.get_repo(), state.head_sha,
-                'success', url, "Test successful", context='homu'
-            )
+            state.create_status('success', url, "Test successful")
 
             if state.approved_by and not state.try_:
-                # The set_ref call below sometimes fails with 422 failed to
-                # fast forward. We believe this is a spurious error on GitHub's
-                # side, though it's not entirely clear why. We sleep for 1
-                # minute before trying it after setting the status to try to
-                # increase the likelihood it will work, and also retry the
+                # The set_ref call in fast_forward sometimes fails with 422
+                # failed to fast forward. We believe this is a spurious error
+                # on GitHub's side, though it's not entirely clear why. We wait
+                # for 1 minute before trying it after setting the status to try
+                # to increase the likelihood it will work, and also retry the
                 # set_ref a few times.
-                time.sleep(60)
-                state.add_comment(comments.BuildCompleted(
-                    approved_by=state.approved_by,
-                    base_ref=state.base_ref,
-                    builders={k: v["url"] for k, v in state.build_res.items()},
-                    merge_sha=state.merge_sha,
-                ))
-                state.change_labels(LabelEvent.SUCCEED)
-
-                def set_ref_inner():
-                    utils.github_set_ref(state.get_repo(), 'heads/' +
-                                         state.base_ref, state.merge_sha)
-                    if state.test_on_fork is not None:
-                        utils.github_set_ref(state.get_test_on_fork_repo(),
-                                             'heads/' + state.base_ref,
-                                             state.merge_sha, force=True)
-
-                def set_ref():
-                    try:
-                        set_ref_inner()
-                    except github3.models.GitHubError:
-                        utils.github_create_status(
-                            state.get_repo(),
-                            state.merge_sha,
-                            'success', '',
-                            'Branch protection bypassed',
-                            context='homu')
-                        set_ref_inner()
-
-                error = None
-                for i in range(0, 5):
-                    try:
-                        set_ref()
-                        state.fake_merge(repo_cfg)
-                        error = None
-                    except github3.models.GitHubError as e:
-                        error = e
-                        pass
-                    if error is None:
-                        break
-                    else:
-                        time.sleep(10)
-
-                if error is not None:
-                    state.set_status('error')
-                    desc = ('Test was successful, but fast-forwarding failed:'
-                            ' {}'.format(error))
-                    utils.github_create_status(state.get_repo(),
-                                               state.head_sha, 'error', url,
-                                               desc, context='homu')
-
-                    state.add_comment(':eyes: ' + desc)
+                scheduler.call_later(FAST_FORWARD_DELAY, core.dispatch,
+                                     fast_forward, state, url, repo_cfg, 0)
+                return
             else:
                 state.add_comment(comments.TryBuildCompleted(
                     builders={k: v["url"] for k, v in state.build_res.items()},
@@ -759,10 +1312,7 @@ def report_build_res(succ, url, builder, state, logger, repo_cfg):
     else:
         if state.status == 'pending':
             state.set_status('failure')
-            utils.github_create_status(
-                state.get_repo(), state.head_sha,
-                'failure', url, "Test failed", context='homu'
-            )
+            state.create_status('failure', url, "Test failed")
 
             if state.try_:
                 state.add_comment(comments.TryBuildFailed(
@@ -786,10 +1336,16 @@ def buildbot():
 
     response.content_type = 'text/plain'
 
-    for row in json.loads(request.forms.packets):
+    return core.call(handle_buildbot_packets, request.forms.packets,
+                     request.forms.secret, logger)
+
+
+@metrics.operation('buildbot')
+def handle_buildbot_packets(packets, secret, logger):
+    for row in json.loads(packets):
         if row['event'] == 'buildFinished':
             info = row['payload']['build']
-            lazy_debug(logger, lambda: 'info: {}'.format(info))
+            logger.debug('info', extra={'payload': logs.Payload(info)})
             props = dict(x[:2] for x in info['properties'])
 
             if 'retry' in info['text']:
@@ -814,7 +1370,7 @@ def buildbot():
 
             repo_cfg = g.repo_cfgs[repo_label]
 
-            if request.forms.secret != repo_cfg['buildbot']['secret']:
+            if secret != repo_cfg['buildbot']['secret']:
                 abort(400, 'Invalid secret')
 
             build_succ = 'successful' in info['text'] or info['results'] == 0
@@ -852,8 +1408,7 @@ def buildbot():
                     mat = INTERRUPTED_BY_HOMU_RE.search(res.text)
                     if mat:
                         interrupt_token = mat.group(1)
-                        if getattr(state, 'interrupt_token',
-                                   '') != interrupt_token:
+                        if state.interrupt_token != interrupt_token:
                             state.interrupt_token = interrupt_token
 
                             if state.status == 'pending':
@@ -863,11 +1418,7 @@ def buildbot():
                                         'to prioritize another pull request.')
                                 state.add_comment(desc)
                                 state.change_labels(LabelEvent.INTERRUPTED)
-                                utils.github_create_status(state.get_repo(),
-                                                           state.head_sha,
-                                                           'error', url,
-                                                           desc,
-                                                           context='homu')
+                                state.create_status('error', url, desc)
 
                                 g.queue_handler()
 
@@ -881,7 +1432,7 @@ def buildbot():
 
         elif row['event'] == 'buildStarted':
             info = row['payload']['build']
-            lazy_debug(logger, lambda: 'info: {}'.format(info))
+            logger.debug('info', extra={'payload': logs.Payload(info)})
             props = dict(x[:2] for x in info['properties'])
 
             if not props['revision']:
@@ -895,7 +1446,7 @@ def buildbot():
                 if info['builderName'] in state.build_res:
                     repo_cfg = g.repo_cfgs[repo_label]
 
-                    if request.forms.secret != repo_cfg['buildbot']['secret']:
+                    if secret != repo_cfg['buildbot']['secret']:
                         abort(400, 'Invalid secret')
 
                     url = '{}/builders/{}/builds/{}'.format(
@@ -929,28 +1480,20 @@ def synch(user_gh, state, repo_label, repo_cfg, repo):
             abort(400, 'Homu does not have write access on the repository')
         raise e
 
-    Thread(target=synchronize, args=[repo_label, repo_cfg, g.logger,
-                                     g.gh, g.states, g.repos, g.db,
-                                     g.mergeable_que, g.my_username,
-                                     g.repo_labels]).start()
+    Thread(target=synchronize_or_retry,
+           args=[repo_label, repo_cfg, g.logger, g.gh, g.states, g.repos,
+                 g.db, g.mergeable_que, g.my_username,
+                 g.repo_labels]).start()
 
     return 'Synchronizing {}...'.format(repo_label)
 
 
 def synch_all():
-    @retry(wait_exponential_multiplier=1000, wait_exponential_max=600000)
-    def sync_repo(repo_label, g):
-        try:
-            synchronize(repo_label, g.repo_cfgs[repo_label], g.logger, g.gh,
-                        g.states, g.repos, g.db, g.mergeable_que,
-                        g.my_username, g.repo_labels)
-        except Exception:
-            print('* Error while synchronizing {}'.format(repo_label))
-            traceback.print_exc()
-            raise
-
-    for repo_label in g.repos:
-        sync_repo(repo_label, g)
+    # A repository that fails is retried later, without holding up the others
+    for repo_label in list(g.repos):
+        synchronize_or_retry(repo_label, g.repo_cfgs[repo_label], g.logger,
+                             g.gh, g.states, g.repos, g.db, g.mergeable_que,
+                             g.my_username, g.repo_labels)
     print('* Done synchronizing all')
 
 
@@ -959,23 +1502,36 @@ def admin():
     if request.json['secret'] != g.cfg['web']['secret']:
         return 'Authentication failure'
 
-    if request.json['cmd'] == 'repo_new':
-        repo_label = request.json['repo_label']
-        repo_cfg = request.json['repo_cfg']
+    # Profiles watch the other handlers run and trace queries read files, so
+    # they don't hold the core
+    if request.json['cmd'] in profiling.COMMANDS:
+        response.content_type = 'text/plain'
+        return profiling.command(request.json)
+    if request.json['cmd'] in tracing.COMMANDS:
+        return tracing.command(request.json)
+
+    return core.call(admin_command, request.json)
+
+
+@metrics.operation('admin')
+def admin_command(cmd):
+    if cmd['cmd'] == 'repo_new':
+        repo_label = cmd['repo_label']
+        repo_cfg = cmd['repo_cfg']
 
         g.states[repo_label] = {}
         g.repos[repo_label] = None
         g.repo_cfgs[repo_label] = repo_cfg
         g.repo_labels[repo_cfg['owner'], repo_cfg['name']] = repo_label
 
-        Thread(target=synchronize, args=[repo_label, repo_cfg, g.logger,
-                                         g.gh, g.states, g.repos, g.db,
-                                         g.mergeable_que, g.my_username,
-                                         g.repo_labels]).start()
+        Thread(target=synchronize_or_retry,
+               args=[repo_label, repo_cfg, g.logger, g.gh, g.states, g.repos,
+                     g.db, g.mergeable_que, g.my_username,
+                     g.repo_labels]).start()
         return 'OK'
 
-    elif request.json['cmd'] == 'repo_del':
-        repo_label = request.json['repo_label']
+    elif cmd['cmd'] == 'repo_del':
+        repo_label = cmd['repo_label']
         repo_cfg = g.repo_cfgs[repo_label]
 
         db_query(g.db, 'DELETE FROM pull WHERE repo = ?', [repo_label])
@@ -989,9 +1545,9 @@ def admin():
 
         return 'OK'
 
-    elif request.json['cmd'] == 'repo_edit':
-        repo_label = request.json['repo_label']
-        repo_cfg = request.json['repo_cfg']
+    elif cmd['cmd'] == 'repo_edit':
+        repo_label = cmd['repo_label']
+        repo_cfg = cmd['repo_cfg']
 
         assert repo_cfg['owner'] == g.repo_cfgs[repo_label]['owner']
         assert repo_cfg['name'] == g.repo_cfgs[repo_label]['name']
@@ -1000,7 +1556,31 @@ def admin():
 
         return 'OK'
 
-    elif request.json['cmd'] == 'sync_all':
+    elif cmd['cmd'] == 'github_usage':
+        return {
+            'operations': metrics.usage_report(metrics.github_usage.snapshot()),  # noqa
+        }
+
+    elif cmd['cmd'] == 'memory':
+        return memory.report(
+            g.states,
+            g.repos,
+            caches={
+                'body_cache': body_cache,
+                'queue_snapshots': queue_snapshots,
+            },
+            queues={
+                'scheduler': scheduler.pending(),
+                'outbound': outbound.pending(),
+                'mergeable': g.mergeable_que.qsize(),
+            },
+            types=cmd.get('types', False),
+        )
+
+    elif cmd['cmd'] == 'tracemalloc':
+        return memory.tracemalloc_command(cmd)
+
+    elif cmd['cmd'] == 'sync_all':
         Thread(target=synch_all).start()
 
         return 'OK'
@@ -1009,10 +1589,25 @@ def admin():
 
 
 @get('/health')
-def health():
+@get('/health/live')
+def health_live():
     return 'OK'
 
 
+@get('/health/ready')
+def health_ready():
+    report = health.report(g.mergeable_que, g.cfg['web'].get('health', {}))
+    if not report['ready']:
+        response.status = 503
+    return report
+
+
+@get('/metrics')
+def export_metrics():
+    response.content_type = 'text/plain; version=0.0.4'
+    return metrics.render()
+
+
 @error(404)
 def not_found(error):
     return g.tpls['404'].render()
@@ -1029,8 +1624,8 @@ def redirect_to_canonical_host():
         scheme="https"
     )
 
-    # Disable redirects on the health check endpoint.
-    if request_url.path == "/health":
+    # Disable redirects on the health check endpoints.
+    if request_url.path == "/health" or request_url.path.startswith("/health/"):  # noqa
         return
 
     # Handle hostname changes
@@ -1054,8 +1649,12 @@ def redirect_to_canonical_host():
         redirect(urllib.parse.urlunparse(redirect_url), 301)
 
 
-def start(cfg, states, queue_handler, repo_cfgs, repos, logger,
-          buildbot_slots, my_username, db, repo_labels, mergeable_que, gh):
+def start_event():
+    # Webhooks keep the id GitHub gave their delivery, to find them there
+    logs.set_event(request.headers.get('X-GitHub-Delivery'))
+
+
+def load_templates(cfg):
     env = jinja2.Environment(
         loader=jinja2.FileSystemLoader(pkg_resources.resource_filename(__name__, 'html')),  # noqa
         autoescape=True,
@@ -1067,7 +1666,11 @@ def start(cfg, states, queue_handler, repo_cfgs, repos, logger,
     tpls['build_res'] = env.get_template('build_res.html')
     tpls['retry_log'] = env.get_template('retry_log.html')
     tpls['404'] = env.get_template('404.html')
+    return tpls
+
 
+def start(cfg, states, queue_handler, repo_cfgs, repos, logger,
+          buildbot_slots, my_username, db, repo_labels, mergeable_que, gh):
     g.cfg = cfg
     g.states = states
     g.queue_handler = queue_handler
@@ -1075,23 +1678,29 @@ def start(cfg, states, queue_handler, repo_cfgs, repos, logger,
     g.repos = repos
     g.logger = logger.getChild('server')
     g.buildbot_slots = buildbot_slots
-    g.tpls = tpls
+    g.tpls = load_templates(cfg)
     g.my_username = my_username
     g.db = db
     g.repo_labels = repo_labels
     g.mergeable_que = mergeable_que
     g.gh = gh
+    g.event_streams = BoundedSemaphore(
+        cfg['web'].get('event_streams', DEFAULT_EVENT_STREAMS))
 
     bottle.app().add_hook("before_request", redirect_to_canonical_host)
+    bottle.app().add_hook("before_request", start_event)
 
     # Synchronize all PR data on startup
     if cfg['web'].get('sync_on_start', False):
+        for repo_label in repos:
+            health.sync_pending(repo_label)
         Thread(target=synch_all).start()
 
     try:
         run(host=cfg['web'].get('host', '0.0.0.0'),
             port=cfg['web']['port'],
-            server='waitress')
+            server='waitress',
+            threads=cfg['web'].get('threads', DEFAULT_THREADS))
     except OSError as e:
         print(e, file=sys.stderr)
         os._exit(1)
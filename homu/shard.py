@@ -0,0 +1,420 @@
+"""Running the repositories of one configuration in several processes.
+
+With `[shards] count` set above 1, `homu` starts a front process that spawns
+one worker process per shard. Every repository belongs to exactly one shard,
+and each worker is a regular homu that only knows about the repositories of
+its own shard, with its own database. The front process verifies and routes
+the webhooks, proxies the web interface and merges the pages spanning several
+shards.
+"""
+
+import bottle
+import hmac
+import json
+import os
+import requests
+import subprocess
+import sys
+import time
+import traceback
+import urllib.parse
+import zlib
+from bottle import abort, request, response
+from threading import Thread
+
+RESTART_DELAY = 5
+WORKER_TIMEOUT = 60
+
+# Headers that only make sense for a single connection, and must not be
+# forwarded by a proxy
+HOP_BY_HOP_HEADERS = {
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailers',
+    'transfer-encoding',
+    'upgrade',
+    'content-length',
+}
+
+
+def shard_count(cfg):
+    return cfg.get('shards', {}).get('count', 1)
+
+
+def shard_of(repo_label, repo_cfg, count):
+    if 'shard' in repo_cfg:
+        return repo_cfg['shard'] % count
+    # crc32 rather than hash(), which changes between processes
+    return zlib.crc32(repo_label.encode('utf-8')) % count
+
+
+def worker_port(cfg, index):
+    base_port = cfg.get('shards', {}).get('base_port', cfg['web']['port'] + 1)
+    return base_port + index
+
+
+def worker_file(db_file, index):
+    root, ext = os.path.splitext(db_file)
+    return '{}.shard{}{}'.format(root, index, ext)
+
+
+def worker_config(cfg, index):
+    """The configuration of the worker process of the given shard."""
+    count = shard_count(cfg)
+
+    cfg = dict(cfg)
+    cfg['repo'] = {
+        repo_label: repo_cfg
+        for repo_label, repo_cfg in cfg.get('repo', {}).items()
+        if shard_of(repo_label, repo_cfg, count) == index
+    }
+    db_cfg = cfg.get('db', {})
+    cfg['db'] = dict(db_cfg,
+                     file=worker_file(db_cfg.get('file', 'main.db'), index))
+    if 'tracing' in cfg:
+        cfg['tracing'] = dict(cfg['tracing'],
+                              file=worker_file(cfg['tracing']['file'], index))
+    # Only the front process is reachable from the outside
+    cfg['web'] = dict(cfg['web'],
+                      host='127.0.0.1',
+                      port=worker_port(cfg, index))
+
+    return cfg
+
+
+def merge_queues(results, prechecked_prs):
+    """Merge the queue rows returned by several workers."""
+    rows = sorted((row for result in results for row in result['rows']),
+                  key=lambda row: row['sort_key'])
+    for row in rows:
+        row['prechecked'] = str(row['num']) in prechecked_prs
+
+    return {
+        'states': rows,
+        'total': len(rows),
+        'approved': sum(result['approved'] for result in results),
+        'rolled_up': sum(result['rolled_up'] for result in results),
+        'failed': sum(result['failed'] for result in results),
+    }
+
+
+class Front:
+    def __init__(self, cfg, logger):
+        self.cfg = cfg
+        self.logger = logger
+        self.count = shard_count(cfg)
+        self.shards = {}
+        self.repo_cfgs = {}
+        self.repo_labels = {}
+
+        for repo_label, repo_cfg in cfg['repo'].items():
+            self.add_repo(repo_label, repo_cfg)
+
+    def add_repo(self, repo_label, repo_cfg):
+        self.shards[repo_label] = shard_of(repo_label, repo_cfg, self.count)
+        self.repo_cfgs[repo_label] = repo_cfg
+        self.repo_labels[repo_cfg['owner'], repo_cfg['name']] = repo_label
+        if 'test-on-fork' in repo_cfg:
+            tof = repo_cfg['test-on-fork']
+            self.repo_labels[tof['owner'], tof['name']] = repo_label
+
+    def url(self, index, path):
+        port = worker_port(self.cfg, index)
+        return 'http://127.0.0.1:{}{}'.format(port, path)
+
+    def shard(self, repo_label):
+        try:
+            return self.shards[repo_label]
+        except KeyError:
+            abort(404, 'No such repository: {}'.format(repo_label))
+
+    def forward(self, index):
+        """Proxy the current request to the worker of the given shard."""
+        url = self.url(index, request.fullpath)
+        if request.query_string:
+            url += '?' + request.query_string
+
+        headers = {key: value for key, value in request.headers.items()
+                   if key.lower() not in HOP_BY_HOP_HEADERS}
+        try:
+            res = requests.request(request.method, url,
+                                   data=request.body.read(),
+                                   headers=headers,
+                                   allow_redirects=False,
+                                   stream=True,
+                                   timeout=WORKER_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            self.logger.warn('Shard {} is unreachable: {}'.format(index, e))
+            abort(502, 'Bad Gateway')
+
+        # Pass the body through untouched, including its content encoding.
+        # Event streams are relayed as they come.
+        if res.headers.get('Content-Type', '').startswith('text/event-stream'):
+            body = res.raw.stream(decode_content=False)
+        else:
+            body = res.raw.read(decode_content=False)
+        return bottle.HTTPResponse(body, res.status_code, {
+            key: value for key, value in res.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS
+        })
+
+    def fetch(self, index, path):
+        try:
+            res = requests.get(self.url(index, path), timeout=WORKER_TIMEOUT)
+            res.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self.logger.warn('Shard {} is unreachable: {}'.format(index, e))
+            abort(502, 'Bad Gateway')
+        return res.json()
+
+    def github(self):
+        payload = request.body.read()
+        info = json.loads(payload.decode('utf-8'))
+
+        owner_info = info['repository']['owner']
+        owner = owner_info.get('login') or owner_info['name']
+        try:
+            repo_label = self.repo_labels[owner, info['repository']['name']]
+        except KeyError:
+            abort(404, 'Unknown repository')
+        repo_cfg = self.repo_cfgs[repo_label]
+
+        hmac_method, hmac_sig = request.headers['X-Hub-Signature'].split('=')
+        if not hmac.compare_digest(hmac_sig, hmac.new(
+            repo_cfg['github']['secret'].encode('utf-8'),
+            payload,
+            hmac_method,
+        ).hexdigest()):
+            abort(400, 'Invalid signature')
+
+        return self.forward(self.shards[repo_label])
+
+    def buildbot(self):
+        # Buildbot reports builds by commit, which only the worker running
+        # the build knows about. The others ignore it.
+        res = None
+        for index in range(self.count):
+            res = self.forward(index)
+            if res.status_code != 200:
+                break
+        return res
+
+    def callback(self):
+        state = json.loads(request.query.state)
+        return self.forward(self.shard(state['repo_label']))
+
+    def admin(self):
+        cmd = request.json
+        if cmd['cmd'] == 'sync_all':
+            for index in range(self.count):
+                res = self.forward(index)
+            return res
+
+        if cmd['cmd'] == 'repo_new':
+            if cmd['secret'] != self.cfg['web']['secret']:
+                return 'Authentication failure'
+            self.add_repo(cmd['repo_label'], cmd['repo_cfg'])
+
+        # Commands about the process itself go to the shard they name
+        if 'repo_label' not in cmd:
+            return self.forward(self.worker(cmd.get('shard', 0)))
+
+        res = self.forward(self.shard(cmd['repo_label']))
+        if cmd['cmd'] == 'repo_del' and res.body == b'OK':
+            del self.shards[cmd['repo_label']]
+            del self.repo_cfgs[cmd['repo_label']]
+        return res
+
+    def index(self):
+        repos = []
+        for index in range(self.count):
+            repos += self.fetch(index, '/shard/repos')['repos']
+        repos.sort(key=lambda repo: repo['repo_label'])
+
+        return self.tpls['index'].render(repos=repos)
+
+    def labels_by_shard(self, repo_label):
+        if repo_label == 'all':
+            labels = sorted(self.shards)
+        else:
+            labels = repo_label.split('+')
+
+        by_shard = {}
+        for label in labels:
+            by_shard.setdefault(self.shard(label), []).append(label)
+        return by_shard
+
+    def api_queue(self, repo_label):
+        by_shard = self.labels_by_shard(repo_label)
+        if len(by_shard) == 1:
+            return self.forward(next(iter(by_shard)))
+
+        def fetch_all(query):
+            query = urllib.parse.urlencode(query)
+            return [self.fetch(index, '/api/queue/{}?{}'.format(
+                        '+'.join(labels), query))
+                    for index, labels in sorted(by_shard.items())]
+
+        query = dict(request.query)
+        results = fetch_all(query)
+        if (any(result['full'] for result in results) and
+                not all(result['full'] for result in results)):
+            # The changes since that version can't all be listed: everyone
+            # has to send everything
+            del query['since']
+            results = fetch_all(query)
+
+        # Rows are only ordered within each shard
+        merged = {
+            'version': max(result['version'] for result in results),
+            'full': any(result['full'] for result in results),
+        }
+        if not merged['full']:
+            merged['removed'] = [removed for result in results
+                                 for removed in result['removed']]
+        merged['rows'] = [row for result in results for row in result['rows']]
+        return merged
+
+    def queue_events(self, repo_label):
+        by_shard = self.labels_by_shard(repo_label)
+        if len(by_shard) != 1:
+            abort(404, 'Live updates of several shards are not supported')
+        return self.forward(next(iter(by_shard)))
+
+    def queue(self, repo_label):
+        by_shard = self.labels_by_shard(repo_label)
+
+        # Queues of a single shard are rendered by the worker itself
+        if repo_label != 'all' and len(by_shard) == 1:
+            return self.forward(next(iter(by_shard)))
+
+        results = [self.fetch(index, '/shard/queue/' + '+'.join(labels))
+                   for index, labels in sorted(by_shard.items())]
+        prechecked_prs = set()
+        if request.query.get('prs'):
+            prechecked_prs = set(request.query.get('prs').split(','))
+
+        return self.tpls['queue'].render(
+            repo_url=None,
+            repo_label=repo_label,
+            treeclosed=None,
+            treeclosed_src=None,
+            oauth_client_id=self.cfg['github']['app_client_id'],
+            multiple=True,
+            **merge_queues(results, prechecked_prs)
+        )
+
+    def worker(self, index):
+        try:
+            index = int(index)
+        except ValueError:
+            abort(400, 'Invalid shard')
+        if not 0 <= index < self.count:
+            abort(404, 'No such shard')
+        return index
+
+    def health_ready(self):
+        # Ready when every worker is
+        shards = []
+        for index in range(self.count):
+            try:
+                res = requests.get(self.url(index, '/health/ready'),
+                                   timeout=WORKER_TIMEOUT)
+                shards.append(res.json())
+            except (requests.exceptions.RequestException, ValueError) as e:
+                shards.append({'ready': False,
+                               'reasons': ['unreachable: {}'.format(e)]})
+
+        ready = all(shard['ready'] for shard in shards)
+        if not ready:
+            response.status = 503
+        return {'ready': ready, 'shards': shards}
+
+    def metrics(self):
+        # Every worker has metrics of its own, scraped one by one
+        return self.forward(self.worker(request.query.get('shard', 0)))
+
+    def app(self):
+        from . import server
+
+        self.tpls = server.load_templates(self.cfg)
+        server.g.cfg = self.cfg
+
+        app = bottle.Bottle()
+        app.add_hook('before_request', server.redirect_to_canonical_host)
+
+        app.route('/', 'GET', self.index)
+        app.route('/queue/<repo_label:path>/events', 'GET', self.queue_events)
+        app.route('/queue/<repo_label:path>', 'GET', self.queue)
+        app.route('/results/<repo_label:path>/<pull:int>', 'GET',
+                  lambda repo_label, pull: self.forward(
+                      self.shard(repo_label)))
+        app.route('/retry_log/<repo_label:path>', 'GET',
+                  lambda repo_label: self.forward(self.shard(repo_label)))
+        app.route('/api/queue/<repo_label:path>', 'GET', self.api_queue)
+        app.route('/api/retry_log/<repo_label:path>', 'GET',
+                  lambda repo_label: self.forward(self.shard(repo_label)))
+        app.route('/api/results/<repo_label:path>/<pull:int>', 'GET',
+                  lambda repo_label, pull: self.forward(
+                      self.shard(repo_label)))
+        app.route('/callback', 'GET', self.callback)
+        app.route('/github', 'POST', self.github)
+        app.route('/buildbot', 'POST', self.buildbot)
+        app.route('/admin', 'POST', self.admin)
+        app.route('/assets/<file:path>', 'GET', server.server_static)
+        app.route('/health', 'GET', lambda: 'OK')
+        app.route('/health/live', 'GET', lambda: 'OK')
+        app.route('/health/ready', 'GET', self.health_ready)
+        app.route('/metrics', 'GET', self.metrics)
+        app.error(404)(lambda error: self.tpls['404'].render())
+
+        return app
+
+
+def worker_command(index, args):
+    # Not `-m homu.main`: the server would import a second copy of
+    # homu.main, with its own (empty) global_cfg and queue change tracking
+    cmd = [sys.executable, '-c', 'from homu.main import main; main()',
+           '--config', args.config,
+           '--shard', str(index)]
+    if args.verbose:
+        cmd.append('--verbose')
+    return cmd
+
+
+def supervise(index, args, logger):
+    cmd = worker_command(index, args)
+
+    while True:
+        try:
+            proc = subprocess.Popen(cmd)
+            code = proc.wait()
+            logger.warn('Shard {} exited with code {}, restarting'
+                        .format(index, code))
+        except Exception:
+            print('* Error while running shard {}'.format(index))
+            traceback.print_exc()
+
+        time.sleep(RESTART_DELAY)
+
+
+def front(cfg, args, logger):
+    proxy = Front(cfg, logger)
+    logger.info('Running {} repositories in {} shards'
+                .format(len(proxy.shards), proxy.count))
+
+    for index in range(proxy.count):
+        Thread(target=supervise, args=[index, args, logger],
+               daemon=True).start()
+
+    try:
+        bottle.run(app=proxy.app(),
+                   host=cfg['web'].get('host', '0.0.0.0'),
+                   port=cfg['web']['port'],
+                   server='waitress')
+    except OSError as e:
+        print(e, file=sys.stderr)
+        os._exit(1)
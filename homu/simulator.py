@@ -0,0 +1,405 @@
+"""Replay the queue of a repository offline, to estimate what changing its
+policies would do to the merge throughput.
+
+The history comes from the spans homu records when `[tracing]` is enabled:
+approvals, unapprovals and changes of priority, tree closures, and the
+outcome and duration of every build. The queue is played on a virtual clock
+with the rules of process_queue (`queue_candidates`) over real
+PullReqState objects, sorted like in homu. A simulated build of a pull
+request takes the outcome and duration of its next recorded build; pull
+requests that had no build of their own (e.g. they were merged in a rollup)
+get the median successful build.
+
+    python -m homu.simulator traces.jsonl --repo rust [--ignore-priority]
+        [--ignore-treeclosed] [--rollup-batch 10] [--merge-delay 0]
+
+The policies are compared to a replay with the current ones, and to what
+was recorded.
+"""
+
+import argparse
+import collections
+import heapq
+import json
+import statistics
+
+from . import tracing
+from .main import PullReqState, queue_candidates
+from .server import FAST_FORWARD_DELAY
+
+# `rollup=always`
+ROLLUP_ALWAYS = 1
+
+# Used when the history has no builds at all
+DEFAULT_BUILD_SECONDS = 3600
+# The sleep before creating the merge commit, when the history has none
+DEFAULT_CREATE_MERGE_SECONDS = 60
+
+Build = collections.namedtuple('Build', ['duration', 'success'])
+
+
+class History:
+    def __init__(self):
+        # (time, action, num, attrs), sorted by time
+        self.events = []
+        # num -> recorded builds on the auto branch, in order
+        self.builds = collections.defaultdict(list)
+        self.create_merge = []
+        # Durations of the recorded merges, from approval
+        self.merges = []
+
+    @property
+    def start(self):
+        return self.events[0][0] if self.events else 0
+
+    @property
+    def end(self):
+        return self.events[-1][0] if self.events else 0
+
+    def median_build(self):
+        durations = [build.duration for builds in self.builds.values()
+                     for build in builds if build.success]
+        if not durations:
+            return Build(DEFAULT_BUILD_SECONDS, True)
+        return Build(statistics.median(durations), True)
+
+    def create_merge_seconds(self):
+        if not self.create_merge:
+            return DEFAULT_CREATE_MERGE_SECONDS
+        return statistics.median(self.create_merge)
+
+
+def load_history(spans, repo_label):
+    history = History()
+    # (num, start) -> [(duration, success)] of each builder
+    builders = collections.defaultdict(list)
+
+    for span in spans:
+        if span['repo_label'] != repo_label:
+            continue
+
+        name = span['name']
+        num = span['num']
+        if name in ('approval', 'reprioritization'):
+            history.events.append((span['start'], name, num, {
+                'priority': span.get('priority', 0),
+                'rollup': span.get('rollup', 0),
+            }))
+        elif name in ('unapproval', 'treeclosed'):
+            history.events.append((span['start'], name, num, span))
+        elif name.startswith('ci:') and not span.get('try_build'):
+            builders[num, span['start']].append(
+                (span['duration'], span['success']))
+        elif name == 'create_merge' and not span.get('try_build'):
+            history.create_merge.append(span['duration'])
+        elif name == 'merge':
+            history.merges.append(span['duration'])
+
+    for (num, start), results in sorted(builders.items()):
+        failures = [duration for duration, success in results if not success]
+        if failures:
+            # homu gives up at the first failing builder
+            build = Build(min(failures), False)
+        else:
+            build = Build(max(duration for duration, _ in results), True)
+        history.builds[num].append(build)
+
+    history.events.sort(key=lambda event: event[0])
+    return history
+
+
+class Policy:
+    def __init__(self, *, ignore_priority=False, ignore_treeclosed=False,
+                 rollup_batch=1, merge_delay=None):
+        self.ignore_priority = ignore_priority
+        self.ignore_treeclosed = ignore_treeclosed
+        # How many `rollup=always` pull requests to build together
+        self.rollup_batch = rollup_batch
+        # What homu waits around each build besides CI: the sleep of
+        # create_merge, and the delay before fast-forwarding
+        self.merge_delay = merge_delay
+
+    def __repr__(self):
+        return 'Policy({})'.format(', '.join(
+            '{}={!r}'.format(key, value)
+            for key, value in vars(self).items()))
+
+
+class Simulation:
+    def __init__(self, history, policy):
+        self.history = history
+        self.policy = policy
+        self.clock = history.start
+        self._events = []
+        self._seq = 0
+
+        self.states = {}
+        self.treeclosed = -1
+        self.builds_left = {num: collections.deque(builds)
+                            for num, builds in history.builds.items()}
+        self.median_build = history.median_build()
+        # The pull requests being built, and the outcomes they used
+        self.building = None
+
+        self.approved_at = {}
+        self.queued_at = {}
+        self.queue_waits = []
+        self.times_to_merge = []
+        self.merged_in_window = 0
+        self.builds = 0
+        self.failed_builds = 0
+
+    def schedule(self, time, action, *args):
+        heapq.heappush(self._events, (time, self._seq, action, args))
+        self._seq += 1
+
+    def run(self):
+        for time, name, num, attrs in self.history.events:
+            self.schedule(time, name, num, attrs)
+
+        while self._events:
+            self.clock, _, action, args = heapq.heappop(self._events)
+            getattr(self, 'on_' + action)(*args)
+            self.process_queue()
+
+        return self.report()
+
+    def state(self, num):
+        state = self.states.get(num)
+        if state is None:
+            state = self.states[num] = PullReqState(num, '', '', None)
+        return state
+
+    def queue(self, state):
+        state.status = ''
+        self.queued_at[state.num] = self.clock
+
+    # History
+
+    def on_approval(self, num, attrs):
+        state = self.state(num)
+        self.on_reprioritization(num, attrs)
+        state.approved_by = 'approved'
+        self.approved_at.setdefault(num, self.clock)
+        if state.status != 'pending':
+            self.queue(state)
+
+    def on_reprioritization(self, num, attrs):
+        state = self.state(num)
+        state.priority = 0 if self.policy.ignore_priority else attrs['priority']  # noqa
+        state.rollup = attrs['rollup']
+
+    def on_unapproval(self, num, attrs):
+        state = self.states.get(num)
+        if state is None:
+            return
+
+        state.approved_by = ''
+        state.status = ''
+        self.approved_at.pop(num, None)
+        if self.building and state in self.building:
+            # The build is for a commit that isn't approved anymore
+            self.building.pop(state)
+            if not self.building:
+                self.building = None
+
+    def on_treeclosed(self, num, attrs):
+        if not self.policy.ignore_treeclosed:
+            self.treeclosed = attrs['priority']
+
+    # Queue
+
+    def process_queue(self):
+        if self.building:
+            return
+
+        repo_states = sorted(self.states.values())
+        for kind, state in queue_candidates(repo_states, self.treeclosed):
+            # Try builds don't hold the queue
+            if kind != 'approved':
+                continue
+
+            batch = [state]
+            if state.rollup == ROLLUP_ALWAYS:
+                batch += [
+                    other for other in repo_states
+                    if other is not state and
+                    other.rollup == ROLLUP_ALWAYS and
+                    other.status == '' and other.approved_by and
+                    other.priority >= self.treeclosed
+                ][:self.policy.rollup_batch - 1]
+            self.start_build(batch)
+            return
+
+    def next_build(self, state):
+        builds = self.builds_left.get(state.num)
+        if builds:
+            return builds.popleft()
+        return self.median_build
+
+    def start_build(self, batch):
+        self.building = collections.OrderedDict()
+        for state in batch:
+            self.building[state] = self.next_build(state)
+            state.status = 'pending'
+            self.queue_waits.append(
+                self.clock - self.queued_at.pop(state.num, self.clock))
+
+        outcomes = list(self.building.values())
+        success = all(build.success for build in outcomes)
+        if success:
+            duration = max(build.duration for build in outcomes)
+        else:
+            duration = min(build.duration for build in outcomes
+                           if not build.success)
+
+        if self.policy.merge_delay is not None:
+            duration += self.policy.merge_delay
+        else:
+            duration += self.history.create_merge_seconds()
+            if success:
+                duration += FAST_FORWARD_DELAY
+
+        self.builds += 1
+        self.schedule(self.clock + duration, 'build_done', self.building)
+
+    def on_build_done(self, building):
+        if building is not self.building:
+            # Cancelled
+            return
+        self.building = None
+
+        if all(build.success for build in building.values()):
+            for state in building:
+                del self.states[state.num]
+                self.times_to_merge.append(
+                    self.clock - self.approved_at.pop(state.num))
+                if self.clock <= self.history.end:
+                    self.merged_in_window += 1
+            return
+
+        self.failed_builds += 1
+        for state, build in building.items():
+            if build.success:
+                # Not the culprit, it goes back to the queue and keeps its
+                # recorded outcome for the next build
+                if build is not self.median_build:
+                    self.builds_left.setdefault(
+                        state.num, collections.deque()).appendleft(build)
+                self.queue(state)
+            else:
+                state.status = 'failure'
+
+    def report(self):
+        hours = max(self.history.end - self.history.start, 1) / 3600
+        return {
+            'merged': len(self.times_to_merge),
+            'merges_per_hour': self.merged_in_window / hours,
+            'builds': self.builds,
+            'failed_builds': self.failed_builds,
+            'queue_wait': distribution(self.queue_waits),
+            'time_to_merge': distribution(self.times_to_merge),
+            'left_approved': len(self.approved_at),
+        }
+
+
+def distribution(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    res = {'p{}'.format(p): tracing.percentile(values, p)
+           for p in tracing.PERCENTILES}
+    res.update(count=len(values), max=values[-1])
+    return res
+
+
+def simulate(history, policy):
+    return Simulation(history, policy).run()
+
+
+def recorded(history):
+    hours = max(history.end - history.start, 1) / 3600
+    return {
+        'merged': len(history.merges),
+        'merges_per_hour': len(history.merges) / hours,
+        'builds': sum(len(builds) for builds in history.builds.values()),
+        'failed_builds': sum(not build.success
+                             for builds in history.builds.values()
+                             for build in builds),
+        'time_to_merge': distribution(history.merges),
+    }
+
+
+def print_reports(reports):
+    rows = [
+        ('merged', lambda res: res.get('merged')),
+        ('merges per hour', lambda res: res.get('merges_per_hour')),
+        ('builds', lambda res: res.get('builds')),
+        ('failed builds', lambda res: res.get('failed_builds')),
+    ]
+    for name in ('queue_wait', 'time_to_merge'):
+        for p in ['p{}'.format(p) for p in tracing.PERCENTILES] + ['max']:
+            rows.append(('{} {} (h)'.format(name.replace('_', ' '), p),
+                         lambda res, name=name, p=p:
+                         res[name][p] / 3600
+                         if p in res.get(name, {}) else None))
+
+    print('{:<26}'.format('') + ''.join('{:>14}'.format(title)
+                                        for title in reports))
+    for name, value in rows:
+        cells = []
+        for res in reports.values():
+            cell = value(res)
+            cells.append('{:>14}'.format(
+                '-' if cell is None else
+                '{:.2f}'.format(cell) if isinstance(cell, float) else
+                str(cell)))
+        print('{:<26}'.format(name) + ''.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay the queue of a repository from the traces of '
+                    'homu, under alternative policies')
+    parser.add_argument('traces', help='tracing file of homu, read with its '
+                                       'rotated copies')
+    parser.add_argument('--repo', required=True, help='repository label')
+    parser.add_argument('--since', type=float,
+                        help='only replay the spans after this timestamp')
+    parser.add_argument('--ignore-priority', action='store_true',
+                        help='build in approval order')
+    parser.add_argument('--ignore-treeclosed', action='store_true',
+                        help='never close the tree')
+    parser.add_argument('--rollup-batch', type=int, default=1,
+                        help='build up to this many rollup=always pull '
+                             'requests together')
+    parser.add_argument('--merge-delay', type=float,
+                        help='seconds homu waits around each build besides '
+                             'CI, instead of the recorded ones')
+    parser.add_argument('--json', action='store_true',
+                        help='print the reports as JSON')
+    args = parser.parse_args()
+
+    spans = tracing.read(args.traces, args.since)
+    history = load_history(spans, args.repo)
+
+    reports = collections.OrderedDict()
+    reports['recorded'] = recorded(history)
+    reports['current'] = simulate(history, Policy())
+    policy = Policy(
+        ignore_priority=args.ignore_priority,
+        ignore_treeclosed=args.ignore_treeclosed,
+        rollup_batch=args.rollup_batch,
+        merge_delay=args.merge_delay,
+    )
+    if vars(policy) != vars(Policy()):
+        reports['alternative'] = simulate(history, policy)
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print_reports(reports)
+
+
+if __name__ == '__main__':
+    main()
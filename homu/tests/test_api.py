@@ -0,0 +1,166 @@
+import json
+import pytest
+import sqlite3
+from bottle import HTTPError, request, response
+from threading import BoundedSemaphore
+
+from homu import server
+from homu.db import migrate
+from homu.main import PullReqState, Repository
+
+
+def new_repo():
+    db = sqlite3.connect(':memory:', isolation_level=None).cursor()
+    migrate(db)
+    repo = Repository(None, 'rust', db,
+                      repo_cfg={'owner': 'rust-lang', 'name': 'rust'})
+    server.g.repos = {'rust': repo}
+    server.g.states = {'rust': {}}
+    return repo
+
+
+def add_pull(repo, num, title):
+    state = PullReqState(num, 'sha', '', repo)
+    state.title = title
+    state.save()
+    server.g.states['rust'][num] = state
+    return state
+
+
+def get(handler, *args, query=''):
+    request.bind({'REQUEST_METHOD': 'GET', 'QUERY_STRING': query})
+    response.bind()
+    body = handler(*args)
+    if not isinstance(body, dict):
+        body = json.loads(''.join(body))
+    return body
+
+
+def test_api_queue_rows_and_fields():
+    repo = new_repo()
+    for num in range(1, 251):
+        add_pull(repo, num, 'PR {}'.format(num))
+
+    res = get(server.api_queue, 'rust', query='fields=num,title')
+
+    assert res['full'] is True
+    assert res['version'] == repo.version
+    assert len(res['rows']) == 250
+    assert res['rows'][0] == {'num': 1, 'title': 'PR 1'}
+
+
+def test_api_queue_since():
+    repo = new_repo()
+    first = add_pull(repo, 1, 'first')
+    add_pull(repo, 2, 'second')
+    add_pull(repo, 3, 'third')
+    since = get(server.api_queue, 'rust')['version']
+
+    first.set_status('pending')
+    del server.g.states['rust'][3]
+    repo.changed(3)
+
+    res = get(server.api_queue, 'rust', query='since={}'.format(since))
+
+    assert res['full'] is False
+    assert [row['num'] for row in res['rows']] == [1]
+    assert res['rows'][0]['status'] == 'pending'
+    assert res['removed'] == [{'repo_label': 'rust', 'num': 3}]
+
+    # Changes from before this repository was loaded aren't known
+    res = get(server.api_queue, 'rust', query='since=1')
+    assert res['full'] is True
+    assert len(res['rows']) == 2
+
+
+def test_api_results():
+    repo = new_repo()
+    state = add_pull(repo, 1, 'first')
+    state.init_build_res(['linux', 'windows'], use_db=False)
+    state.set_build_res('linux', True, 'https://ci/1')
+
+    res = get(server.api_results, 'rust', 1, query='fields=num,builders')
+
+    assert res == {
+        'num': 1,
+        'builders': [
+            {'name': 'linux', 'result': 'success', 'url': 'https://ci/1'},
+            {'name': 'windows', 'result': 'pending'},
+        ],
+    }
+
+
+def test_queue_events():
+    repo = new_repo()
+    first = add_pull(repo, 1, 'first')
+    since = repo.version
+    first.set_status('approved')
+    server.g.event_streams = BoundedSemaphore(1)
+
+    request.bind({'REQUEST_METHOD': 'GET', 'QUERY_STRING': '',
+                  'HTTP_LAST_EVENT_ID': str(since)})
+    response.bind()
+    stream = server.queue_events('rust')
+
+    assert next(stream).startswith('retry: ')
+    event = next(stream)
+    assert event.startswith('id: {}\nevent: change\n'.format(repo.version))
+    data = json.loads(event.split('data: ')[1])
+    assert (data['num'], data['row']['status']) == (1, 'approved')
+
+    # Only so many streams at once
+    with pytest.raises(HTTPError) as e:
+        server.queue_events('rust')
+    assert e.value.status_code == 503
+    # Ends once the changes are sent
+    assert list(stream) == []
+    assert server.g.event_streams.acquire(blocking=False)
+    server.g.event_streams.release()
+
+
+def test_queue_events_wait_for_changes(monkeypatch):
+    repo = new_repo()
+    add_pull(repo, 1, 'first')
+    server.g.event_streams = BoundedSemaphore(1)
+    monkeypatch.setattr(server, 'EVENTS_WAIT', 0.01)
+
+    request.bind({'REQUEST_METHOD': 'GET',
+                  'QUERY_STRING': 'since={}'.format(repo.version)})
+    response.bind()
+    stream = server.queue_events('rust')
+
+    assert next(stream).startswith('retry: ')
+    assert list(stream) == []
+    assert server.g.event_streams.acquire(blocking=False)
+
+
+def test_api_retry_log(tmp_path):
+    db_file = str(tmp_path / 'main.db')
+    db = sqlite3.connect(db_file, isolation_level=None).cursor()
+    migrate(db)
+    for day in range(1, 6):
+        db.execute(
+            'INSERT INTO retry_log (repo, num, time, src, msg, user) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            ['rust', day % 2, '2020-01-0{} 12:00:00'.format(day), 'src',
+             'retry', 'alice' if day < 4 else 'bob'],
+        )
+    server.g.cfg = {'repo': {'rust': {}}, 'db': {'file': db_file}}
+
+    page = get(server.api_retry_log, 'rust', query='limit=2')
+    assert [log['time'][:10] for log in page['logs']] == \
+        ['2020-01-05', '2020-01-04']
+    page = get(server.api_retry_log, 'rust',
+               query='limit=2&before={}'.format(page['next']))
+    assert [log['time'][:10] for log in page['logs']] == \
+        ['2020-01-03', '2020-01-02']
+    # The entry the cursor points at has expired meanwhile
+    db.execute('DELETE FROM retry_log WHERE rowid = ?',
+               [page['logs'][-1]['id']])
+    page = get(server.api_retry_log, 'rust',
+               query='limit=2&before={}'.format(page['next']))
+    assert len(page['logs']) == 1 and page['next'] is None
+
+    page = get(server.api_retry_log, 'rust',
+               query='user=alice&num=1&until=2020-01-02')
+    assert [log['time'][:10] for log in page['logs']] == ['2020-01-01']
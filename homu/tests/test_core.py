@@ -0,0 +1,96 @@
+import concurrent.futures.thread
+from threading import Event
+
+import pytest
+
+from homu.core import Core
+
+
+def new_core():
+    core = Core(workers=4)
+    core.start()
+    return core
+
+
+def test_handlers_run_one_at_a_time_in_order():
+    core = new_core()
+    running = []
+    seen = []
+
+    def handler(i):
+        running.append(i)
+        assert len(running) == 1
+        seen.append(i)
+        running.remove(i)
+
+    futures = [core.submit(handler, i) for i in range(50)]
+    for future in futures:
+        future.result(5)
+
+    assert seen == list(range(50))
+
+
+def test_nested_calls_run_directly():
+    core = new_core()
+
+    assert core.call(lambda: core.call(lambda: 42)) == 42
+
+
+def test_call_raises_the_handler_error():
+    core = new_core()
+
+    def handler():
+        raise ValueError('nope')
+
+    with pytest.raises(ValueError):
+        core.call(handler)
+
+
+def test_sleep_lets_other_handlers_run():
+    core = new_core()
+    order = []
+
+    def waiting():
+        core.sleep(0.05)
+        order.append('waiting')
+
+    future = core.submit(waiting)
+    core.call(lambda: order.append('other'))
+    future.result(5)
+
+    assert order == ['other', 'waiting']
+
+
+def test_handlers_run_after_the_main_thread_is_done(monkeypatch):
+    # What concurrent.futures does when the interpreter starts shutting down,
+    # i.e. once homu's main() has returned
+    monkeypatch.setattr(concurrent.futures.thread, '_shutdown', True)
+    core = new_core()
+
+    assert core.call(lambda: 42) == 42
+
+
+def test_released_blocks_let_other_handlers_run():
+    core = new_core()
+    waiting = Event()
+    order = []
+
+    def io():
+        # e.g. a request to GitHub: the core is free until it returns
+        waiting.wait(5)
+        order.append('io done')
+
+    def handler():
+        assert core.in_core()
+        with core.released():
+            assert not core.in_core()
+            io()
+        assert core.in_core()
+        order.append('handler done')
+
+    future = core.submit(handler)
+    core.call(lambda: order.append('other'))
+    waiting.set()
+    future.result(5)
+
+    assert order == ['other', 'io done', 'handler done']
@@ -0,0 +1,78 @@
+import sqlite3
+
+from homu.db import MIGRATIONS, columns, migrate
+
+
+def new_db():
+    return sqlite3.connect(':memory:', isolation_level=None).cursor()
+
+
+def user_version(db):
+    db.execute('PRAGMA user_version')
+    return db.fetchone()[0]
+
+
+def indexes(db, table):
+    db.execute('PRAGMA index_list({})'.format(table))
+    return {row[1] for row in db.fetchall()}
+
+
+def test_migrate_new_database():
+    db = new_db()
+    migrate(db)
+
+    assert user_version(db) == len(MIGRATIONS)
+    assert 'test_started' in columns(db, 'pull')
+    assert 'pull_status_index' in indexes(db, 'pull')
+    assert 'build_res_merge_sha_index' in indexes(db, 'build_res')
+    assert 'user' in columns(db, 'retry_log')
+    assert 'retry_log_user_index' in indexes(db, 'retry_log')
+
+
+def test_migrate_is_idempotent():
+    db = new_db()
+    migrate(db)
+    db.execute("INSERT INTO repos (repo, treeclosed) VALUES ('rust', 5)")
+    migrate(db)
+
+    assert user_version(db) == len(MIGRATIONS)
+    db.execute('SELECT repo, treeclosed FROM repos')
+    assert db.fetchall() == [('rust', 5)]
+
+
+def test_migrate_unversioned_database():
+    # Schema of a database created before the squash and treeclosed_src
+    # columns were added
+    db = new_db()
+    db.execute('''CREATE TABLE pull (
+        repo TEXT NOT NULL,
+        num INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        merge_sha TEXT,
+        title TEXT,
+        body TEXT,
+        head_sha TEXT,
+        head_ref TEXT,
+        base_ref TEXT,
+        assignee TEXT,
+        approved_by TEXT,
+        priority INTEGER,
+        try_ INTEGER,
+        rollup INTEGER,
+        delegate TEXT,
+        UNIQUE (repo, num)
+    )''')
+    db.execute('''CREATE TABLE repos (
+        repo TEXT NOT NULL,
+        treeclosed INTEGER NOT NULL,
+        UNIQUE (repo)
+    )''')
+    db.execute("INSERT INTO pull (repo, num, status) VALUES ('rust', 1, '')")
+
+    migrate(db)
+
+    assert user_version(db) == len(MIGRATIONS)
+    assert {'squash', 'test_started'} <= columns(db, 'pull')
+    assert 'treeclosed_src' in columns(db, 'repos')
+    db.execute('SELECT repo, num FROM pull')
+    assert db.fetchall() == [('rust', 1)]
@@ -0,0 +1,219 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from homu.github_v4 import GitHubV4, GitHubV4Error
+
+
+def comment(body, login, user_id, url, created_at, commit=None):
+    node = {
+        'body': body,
+        'createdAt': created_at,
+        'author': {'login': login, 'databaseId': user_id},
+        'url': url,
+    }
+    if commit is not None:
+        node['originalCommit'] = {'oid': commit}
+    return node
+
+
+def connection(nodes, cursor=None):
+    return {
+        'pageInfo': {'hasNextPage': cursor is not None, 'endCursor': cursor},
+        'nodes': nodes,
+    }
+
+
+def pull(number, *, comments=None, reviews=None, status='SUCCESS'):
+    return {
+        'number': number,
+        'title': 'PR {}'.format(number),
+        'body': 'Body of {}'.format(number),
+        'headRefOid': 'sha{}'.format(number),
+        'headRefName': 'branch{}'.format(number),
+        'headRepositoryOwner': {'login': 'contributor'},
+        'baseRefName': 'master',
+        'assignees': {'nodes': [{'login': 'reviewer'}]},
+        'labels': connection([{'name': 'S-waiting-on-review'}]),
+        'commits': {'nodes': [{'commit': {
+            'status': {'context': {'state': status}} if status else None,
+        }}]},
+        'comments': comments or connection([]),
+        'reviews': reviews or connection([]),
+    }
+
+
+class FixtureServer:
+    """Stand-in for the GitHub GraphQL endpoint.
+
+    Responses are picked from `pages` by the `after` (or `id`) variable of
+    the request, so tests can describe pagination declaratively.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                payload = json.loads(self.rfile.read(length))
+                fixture.requests.append((self.headers, payload))
+
+                variables = payload['variables']
+                key = (variables.get('number'), variables.get('id'),
+                       variables.get('after'))
+                body = json.dumps(fixture.pages[key]).encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/graphql'.format(
+            self.httpd.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def pulls_page(nodes, cursor=None):
+    return {'data': {'repository': {
+        'pullRequests': connection(nodes, cursor),
+    }}}
+
+
+def test_iter_pull_requests_pages():
+    pages = {
+        (None, None, None): pulls_page([pull(1), pull(2)], 'page2'),
+        (None, None, 'page2'): pulls_page([pull(3, status=None)]),
+    }
+
+    with FixtureServer(pages) as server:
+        gh = GitHubV4('token', server.url, page_size=2)
+        pulls = list(gh.iter_pull_requests('rust-lang', 'rust'))
+
+    assert [p.number for p in pulls] == [1, 2, 3]
+    assert len(server.requests) == 2
+
+    headers, payload = server.requests[0]
+    assert headers['Authorization'] == 'bearer token'
+    assert payload['variables'] == {
+        'owner': 'rust-lang',
+        'name': 'rust',
+        'after': None,
+        'pageSize': 2,
+    }
+
+    first = pulls[0]
+    assert first.title == 'PR 1'
+    assert first.body == 'Body of 1'
+    assert first.head_sha == 'sha1'
+    assert first.head_ref == 'contributor:branch1'
+    assert first.base_ref == 'master'
+    assert first.assignee == 'reviewer'
+    assert first.labels == {'S-waiting-on-review'}
+    assert first.status == 'success'
+    assert pulls[2].status == ''
+
+
+def test_iter_pull_requests_follows_label_pages():
+    first = pull(1)
+    first['labels'] = connection([{'name': 'S-waiting-on-bors'}], 'l1')
+    first['headRepositoryOwner'] = None
+    pages = {
+        (None, None, None): pulls_page([first]),
+        (1, None, 'l1'): {'data': {'repository': {'pullRequest': {
+            'labels': connection([{'name': 'T-compiler'}]),
+        }}}},
+    }
+
+    with FixtureServer(pages) as server:
+        gh = GitHubV4('token', server.url)
+        [pr] = gh.iter_pull_requests('rust-lang', 'rust')
+
+    assert pr.labels == {'S-waiting-on-bors', 'T-compiler'}
+    # The head repository was deleted
+    assert pr.head_ref == 'ghost:branch1'
+
+
+def test_iter_pull_requests_follows_comment_pages():
+    issue_comments = connection([
+        comment('@bors r+', 'jack', 1, 'url1', '2020-01-01T00:00:00Z'),
+    ], 'c1')
+    reviews = connection([{
+        'id': 'review1',
+        'comments': connection([
+            comment('@bors p=1', 'jill', 2, 'url3', '2020-01-03T00:00:00Z',
+                    'sha1'),
+        ], 'r1c1'),
+    }], 'r1')
+
+    pages = {
+        (None, None, None): pulls_page([
+            pull(1, comments=issue_comments, reviews=reviews),
+        ]),
+        (1, None, 'c1'): {'data': {'repository': {'pullRequest': {
+            'comments': connection([
+                comment('@bors p=2', 'jack', 1, 'url2',
+                        '2020-01-02T00:00:00Z'),
+            ]),
+        }}}},
+        (1, None, 'r1'): {'data': {'repository': {'pullRequest': {
+            'reviews': connection([{
+                'id': 'review2',
+                'comments': connection([
+                    comment('@bors rollup', 'jill', 2, 'url5',
+                            '2020-01-05T00:00:00Z', 'sha0'),
+                ]),
+            }]),
+        }}}},
+        (None, 'review1', 'r1c1'): {'data': {'node': {
+            'comments': connection([
+                comment('@bors r-', 'jill', 2, 'url4',
+                        '2020-01-04T00:00:00Z', 'sha1'),
+            ]),
+        }}},
+    }
+
+    with FixtureServer(pages) as server:
+        gh = GitHubV4('token', server.url)
+        pulls = list(gh.iter_pull_requests('rust-lang', 'rust'))
+
+    assert len(pulls) == 1
+    assert len(server.requests) == 4
+
+    assert [c.html_url for c in pulls[0].issue_comments] == ['url1', 'url2']
+    assert [c.html_url for c in pulls[0].review_comments] == [
+        'url3', 'url4', 'url5',
+    ]
+
+    review_comment = pulls[0].review_comments[0]
+    assert review_comment.login == 'jill'
+    assert review_comment.user_id == 2
+    assert review_comment.original_commit_id == 'sha1'
+
+
+def test_query_errors_are_raised():
+    pages = {
+        (None, None, None): {'errors': [{'message': 'Bad credentials'}]},
+    }
+
+    with FixtureServer(pages) as server:
+        gh = GitHubV4('token', server.url)
+        with pytest.raises(GitHubV4Error, match='Bad credentials'):
+            list(gh.iter_pull_requests('rust-lang', 'rust'))
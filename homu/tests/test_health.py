@@ -0,0 +1,53 @@
+import time
+from queue import Queue
+
+from homu.health import Health
+
+
+def test_ready_once_loaded_and_synchronized():
+    health = Health()
+    health.sync_pending('rust')
+    res = health.report()
+    assert not res['ready']
+    assert res['reasons'] == ['the pull requests are being loaded',
+                              'rust is not synchronized yet (pending)']
+
+    health.loaded(10, 0.5)
+    health.sync_started('rust')
+    health.sync_failed('rust')
+    assert health.report()['reasons'] == [
+        'rust is not synchronized yet (failed)']
+
+    health.sync_started('rust')
+    health.sync_done('rust')
+    res = health.report()
+    assert res['ready'] and res['synchronizations']['rust']['state'] == 'done'
+
+    # Later synchronizations don't take it out of the pool
+    health.sync_started('rust')
+    assert health.report()['ready']
+
+
+def test_lagging():
+    health = Health()
+    health.loaded(0, 0)
+
+    token = health.event_received()
+    health._events[token] -= 120
+    health.event_received()
+    mergeable_que = Queue()
+    mergeable_que.put([None, None, 0, time.time() - 1000])
+    for seconds in [0.01] * 8 + [5, 5]:
+        health.db_write(seconds)
+
+    res = health.report(mergeable_que, {'max_db_write': 2})
+    assert res['events']['pending'] == 2
+    assert res['mergeability']['pending'] == 1
+    assert res['db_writes']['p50'] == 0.01
+    assert [reason.split(' wait')[0] for reason in res['reasons']] == [
+        'webhooks', 'mergeability checks', 'database writes take 5.000s']
+
+    health.event_started(token)
+    mergeable_que.get()
+    res = health.report(mergeable_que, {'max_db_write': 10})
+    assert res['ready'], res['reasons']
@@ -0,0 +1,135 @@
+from homu import server, utils
+from homu.main import LabelEvent, PullReqState, Repository
+
+
+class FakeGitHub:
+    def __init__(self, labels):
+        self.labels = set(labels)
+        self.calls = []
+
+    def iter_labels(self, repo, num):
+        self.calls.append(('list',))
+        return [type('Label', (), {'name': name}) for name in self.labels]
+
+    def add_labels(self, repo, num, labels):
+        self.calls.append(('add', list(labels)))
+        self.labels.update(labels)
+
+    def remove_label(self, repo, num, label):
+        self.calls.append(('remove', label))
+        self.labels.discard(label)
+
+
+def new_state(monkeypatch, labels, label_events):
+    fake = FakeGitHub(labels)
+    monkeypatch.setattr(utils, 'github_iter_labels', fake.iter_labels)
+    monkeypatch.setattr(utils, 'github_add_labels', fake.add_labels)
+    monkeypatch.setattr(utils, 'github_remove_label', fake.remove_label)
+
+    repository = Repository.__new__(Repository)
+    repository.gh = object()
+    repository.repo_label = 'rust'
+    repository.owner = 'rust-lang'
+    repository.name = 'rust'
+    repository.label_events = label_events
+    state = PullReqState(1, 'sha', '', repository)
+    return state, fake
+
+
+def test_change_labels_fetches_labels_once(monkeypatch):
+    state, fake = new_state(monkeypatch, ['S-waiting-on-review'], {
+        'approved': {
+            'remove': ['S-waiting-on-review'],
+            'add': ['S-waiting-on-bors'],
+        },
+        'rejected': {
+            'remove': ['S-waiting-on-bors'],
+            'add': ['S-waiting-on-review'],
+        },
+    })
+
+    state.change_labels(LabelEvent.APPROVED)
+    state.change_labels(LabelEvent.REJECTED)
+
+    assert fake.calls == [
+        ('list',),
+        ('remove', 'S-waiting-on-review'),
+        ('add', ['S-waiting-on-bors']),
+        ('remove', 'S-waiting-on-bors'),
+        ('add', ['S-waiting-on-review']),
+    ]
+    assert state.labels == fake.labels == {'S-waiting-on-review'}
+
+
+def test_change_labels_noop_costs_no_requests(monkeypatch):
+    state, fake = new_state(monkeypatch, [], {
+        'approved': {
+            'remove': ['S-waiting-on-review'],
+            'add': ['S-waiting-on-bors'],
+        },
+    })
+    # Primed by a webhook or by synchronize
+    state.labels = {'S-waiting-on-bors'}
+
+    state.change_labels(LabelEvent.APPROVED)
+
+    assert fake.calls == []
+
+
+def test_change_labels_unless(monkeypatch):
+    state, fake = new_state(monkeypatch, [], {
+        'failed': {
+            'add': ['S-waiting-on-review'],
+            'unless': ['S-blocked'],
+        },
+    })
+    state.labels = {'S-blocked'}
+
+    state.change_labels(LabelEvent.FAILED)
+
+    assert fake.calls == []
+    assert state.labels == {'S-blocked'}
+
+
+def test_change_labels_keeps_changes_made_meanwhile(monkeypatch):
+    state, fake = new_state(monkeypatch, ['S-waiting-on-review'], {
+        'approved': {
+            'remove': ['S-waiting-on-review'],
+            'add': ['S-waiting-on-bors'],
+        },
+    })
+    add_labels = fake.add_labels
+
+    def add_labels_and_webhook(repo, num, labels):
+        add_labels(repo, num, labels)
+        # A `labeled` webhook handled while the labels were being sent
+        state.labels_changed(added=['T-compiler'])
+    monkeypatch.setattr(utils, 'github_add_labels', add_labels_and_webhook)
+
+    state.change_labels(LabelEvent.APPROVED)
+
+    assert state.labels == {'S-waiting-on-bors', 'T-compiler'}
+
+
+def test_label_webhooks_apply_their_label_only(monkeypatch):
+    state, fake = new_state(monkeypatch, [], {})
+    state.labels = {'S-waiting-on-bors'}
+    monkeypatch.setattr(server.g, 'states', {'rust': {1: state}},
+                        raising=False)
+
+    def webhook(action, label, labels):
+        server.handle_github_event('pull_request', {
+            'action': action,
+            'number': 1,
+            'label': {'name': label},
+            'pull_request': {
+                'head': {'sha': 'sha'},
+                'labels': [{'name': name} for name in labels],
+            },
+        }, 'rust', {}, None)
+
+    # Sent before homu replaced S-waiting-on-review, and delivered late
+    webhook('labeled', 'T-compiler', ['S-waiting-on-review', 'T-compiler'])
+    webhook('unlabeled', 'S-blocked', ['S-waiting-on-review', 'T-compiler'])
+
+    assert state.labels == {'S-waiting-on-bors', 'T-compiler'}
@@ -0,0 +1,87 @@
+import contextvars
+import io
+import json
+import logging
+import queue
+
+from homu import logs, metrics
+
+
+def test_truncate():
+    data = {
+        'body': 'x' * 300,
+        'html_url': 'https://github.com/rust-lang/rust/pull/1',
+        'commits': [{'sha': str(i), 'url': ''} for i in range(25)],
+    }
+
+    res = logs.truncate(data, max_string=10, max_items=2)
+    assert res == {
+        'body': 'x' * 10 + '... 290 more',
+        'commits': [{'sha': '0'}, {'sha': '1'}, '... 23 more'],
+    }
+
+
+def test_records_are_written_by_the_listener():
+    stream = io.StringIO()
+    logger = logging.getLogger('homu.tests.logs')
+    logger.setLevel(logging.DEBUG)
+    listener = logs.setup(logger, {'format': 'json', 'max_payload': 30},
+                          stream)
+
+    def handle():
+        logs.set_event('delivery')
+        logger.getChild('github').debug(
+            'info', extra={'payload': logs.Payload({'action': 'opened'})})
+        logger.info('big', extra={'payload': logs.Payload({'a': 'b' * 50})})
+
+    contextvars.copy_context().run(handle)
+    logger.info('no event')
+    listener.stop()
+
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert records[0]['logger'] == 'homu.tests.logs.github'
+    assert records[0]['event'] == 'delivery'
+    assert records[0]['payload'] == {'action': 'opened'}
+    assert records[1]['payload'].endswith('... 29 more')
+    assert 'event' not in records[2]
+
+
+def test_payload_sampling_and_full_queue():
+    stream = io.StringIO()
+    logger = logging.getLogger('homu.tests.logs.sampled')
+    listener = logs.setup(logger, {'payload_sample': 0}, stream)
+    logger.warning('info', extra={'payload': logs.Payload({'a': 1})})
+    listener.stop()
+    assert stream.getvalue() == 'info\n'
+
+    before = metrics.log_records_dropped._values.get((), 0)
+    handler = logs.Handler(queue.Queue(1))
+    logger = logging.getLogger('homu.tests.logs.full')
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.warning('kept')
+    logger.warning('dropped')
+    assert metrics.log_records_dropped._values[()] == before + 1
+
+
+def test_messages_are_built_when_logged():
+    stream = io.StringIO()
+    logger = logging.getLogger('homu.tests.logs.prepared')
+    listener = logs.setup(logger, {'format': 'json'}, stream)
+
+    builders = ['linux']
+    data = {'builders': builders}
+    logger.warning('builders: %s', builders,
+                   extra={'payload': logs.Payload(data)})
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        logger.exception('failed')
+    builders.append('windows')
+    data['later'] = True
+    listener.stop()
+
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert records[0]['message'] == "builders: ['linux']"
+    assert 'later' not in records[0]['payload']
+    assert records[1]['exc_info'].endswith('ValueError: boom')
@@ -0,0 +1,47 @@
+import sqlite3
+
+from homu import memory
+from homu.db import migrate
+from homu.main import BodyCache, PullReqState, Repository
+
+
+def test_report():
+    db = sqlite3.connect(':memory:', isolation_level=None).cursor()
+    migrate(db)
+    repo = Repository(None, 'rust', db)
+    states = {}
+    for num in range(1, 4):
+        state = PullReqState(num, 'sha', '', repo)
+        state.title = 'x' * 1000
+        states[num] = state
+    states[1].init_build_res(['linux', 'windows'], use_db=False)
+    bodies = BodyCache()
+    bodies.put('rust', 1, 'body')
+
+    res = memory.report({'rust': states}, {'rust': repo},
+                        caches={'body_cache': bodies},
+                        queues={'mergeable': 0},
+                        types=True)
+
+    assert res['rss'] > 0
+    assert res['repos']['rust']['states'] == 3
+    assert res['repos']['rust']['builders'] == 2
+    assert res['repos']['rust']['bytes'] > 3000
+    assert res['caches']['body_cache'] == {'entries': 1, 'bytes': 4}
+    assert 0 < len(res['types']) <= memory.DEFAULT_TOP
+
+
+def test_tracemalloc_command():
+    assert 'error' in memory.tracemalloc_command({'action': 'top'})
+
+    memory.tracemalloc_command({'action': 'start', 'frames': 1})
+    try:
+        memory.tracemalloc_command({'action': 'snapshot'})
+        data = [bytearray(1000) for _ in range(100)]
+        res = memory.tracemalloc_command({'action': 'top', 'top': 5})
+        assert any('test_memory.py' in line
+                   for site in res['sites'] for line in site['site'])
+        assert res['sites'][0]['bytes_diff'] > 0
+        del data
+    finally:
+        memory.tracemalloc_command({'action': 'stop'})
@@ -0,0 +1,130 @@
+import logging
+import pytest
+import threading
+from types import SimpleNamespace
+
+from homu.metrics import (
+    Counter,
+    Histogram,
+    Usage,
+    _registry,
+    current_operation,
+    git_command,
+    github_endpoint,
+    operation,
+    usage_report,
+)
+from homu import main
+from homu.scheduler import Scheduler
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    saved = list(_registry)
+    yield
+    _registry[:] = saved
+
+
+def test_histogram_render():
+    histogram = Histogram('test_seconds', 'Test', ['event'], buckets=(1, 5))
+    histogram.observe(0.5, event='push')
+    histogram.observe(2, event='push')
+    histogram.observe(10, event='push')
+
+    assert histogram.render().split('\n') == [
+        '# HELP test_seconds Test',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{event="push",le="1.0"} 1.0',
+        'test_seconds_bucket{event="push",le="5.0"} 2.0',
+        'test_seconds_bucket{event="push",le="+Inf"} 3.0',
+        'test_seconds_count{event="push"} 3.0',
+        'test_seconds_sum{event="push"} 12.5',
+    ]
+
+
+def test_counter_labels():
+    counter = Counter('test_total', 'Test', ['status'])
+    counter.inc(status='a"b')
+    counter.inc(2, status='a"b')
+
+    assert counter.render().endswith('test_total{status="a\\"b"} 3.0')
+    with pytest.raises(ValueError):
+        counter.inc(other=1)
+
+
+def test_github_endpoint():
+    assert github_endpoint(
+        'https://api.github.com/repos/rust-lang/rust/pulls/42'
+    ) == '/repos/{owner}/{repo}/pulls/{num}'
+    assert github_endpoint(
+        'https://api.github.com/repos/rust-lang/rust/git/refs/heads/auto'
+    ) == '/repos/{owner}/{repo}/git/refs/{ref}'
+    assert github_endpoint(
+        'https://api.github.com/repos/rust-lang/rust/git/refs'
+    ) == '/repos/{owner}/{repo}/git/refs'
+    assert github_endpoint(
+        'https://api.github.com/repos/a/b/statuses/' + 'f' * 40
+    ) == '/repos/{owner}/{repo}/statuses/{sha}'
+
+
+def test_git_command():
+    assert git_command(['git', '-C', '/cache', 'push', '-f']) == 'push'
+    assert git_command(['git', '-c', 'a=b', 'merge', 'x']) == 'merge'
+
+
+def test_github_usage_by_operation():
+    usage = Usage()
+
+    @operation('sync')
+    def sync():
+        usage.record(current_operation(), 100, 0.5)
+        with operation('verify_level'):
+            usage.record(current_operation(), 10, 0.1)
+
+    sync()
+    before = usage.snapshot()
+    sync()
+    usage.record(current_operation(), 1, 0.1)
+
+    assert [(row['operation'], row['requests'], row['bytes'])
+            for row in usage_report(usage.snapshot(), before)] == [
+        ('other', 1, 1),
+        ('sync', 1, 100),
+        ('sync/verify_level', 1, 10),
+    ]
+
+
+def test_operation_follows_scheduled_callbacks():
+    seen = []
+    done = threading.Event()
+
+    def callback():
+        seen.append(current_operation())
+        done.set()
+
+    with operation('webhook:status'):
+        Scheduler().call_later(0, callback)
+    assert done.wait(5)
+    assert seen == ['webhook:status']
+
+
+def test_process_queue_requests_are_attributed_to_the_queue(monkeypatch):
+
+    class Repo:
+        treeclosed = -1
+
+    seen = []
+
+    def start_build(*args):
+        seen.append(current_operation())
+        return True
+
+    monkeypatch.setattr(main, 'start_build_or_rebuild', start_build)
+    state = SimpleNamespace(**{field: '' for field in
+                               main.PullSnapshot.FIELDS})
+    monkeypatch.setattr(main, 'queue_candidates',
+                        lambda states, treeclosed: [('approved', state)])
+    main.process_queue({'rust': {}}, {'rust': Repo()}, {},
+                       logging.getLogger('test'), [], None, {})
+
+    assert seen == ['queue']
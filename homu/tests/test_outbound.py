@@ -0,0 +1,99 @@
+import github3
+import requests
+from threading import Event
+
+from homu.outbound import OutboundQueue
+
+
+def test_actions_for_the_same_key_run_in_order():
+    que = OutboundQueue(workers=4)
+    que.start()
+
+    sent = []
+    for i in range(50):
+        que.submit(('rust', 1), lambda i=i: sent.append(i))
+    que.join()
+
+    assert sent == list(range(50))
+
+
+def test_superseded_actions_are_coalesced():
+    que = OutboundQueue(workers=1)
+    blocker = Event()
+    sent = []
+
+    que.submit(('rust', 1), blocker.wait)
+    que.submit(('rust', 1), lambda: sent.append('pending'),
+               coalesce=('rust', 'sha', 'homu'))
+    que.submit(('rust', 1), lambda: sent.append('comment'))
+    que.submit(('rust', 1), lambda: sent.append('success'),
+               coalesce=('rust', 'sha', 'homu'))
+    que.submit(('rust', 1), lambda: sent.append('other sha'),
+               coalesce=('rust', 'sha2', 'homu'))
+
+    que.start()
+    blocker.set()
+    que.join()
+
+    assert sent == ['comment', 'success', 'other sha']
+
+
+def test_failed_actions_are_retried(monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda _: None)
+    que = OutboundQueue(workers=1, retries=3)
+    que.start()
+
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise github3.models.GitHubError(FakeResponse())
+
+    que.submit(('rust', 1), flaky)
+    que.join()
+
+    assert len(attempts) == 3
+
+
+def test_only_errors_github_did_not_act_on_are_retried(monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda _: None)
+    que = OutboundQueue(workers=1, retries=3)
+    que.start()
+
+    def send(errors, idempotent):
+        attempts = []
+
+        def action():
+            attempts.append(1)
+            if errors:
+                raise errors.pop(0)
+
+        que.submit(('rust', 1), action, idempotent=idempotent)
+        que.join()
+        return len(attempts)
+
+    not_found = github3.models.GitHubError(FakeResponse(404, 'Not Found'))
+    assert send([not_found], True) == 1
+    assert send([requests.exceptions.ReadTimeout()], True) == 1
+    assert send([requests.exceptions.ConnectionError()], True) == 2
+
+    # Comments may have been posted already
+    bad_gateway = github3.models.GitHubError(FakeResponse())
+    assert send([bad_gateway], False) == 1
+    assert send([requests.exceptions.ConnectionError()], False) == 1
+    assert send([requests.exceptions.ConnectTimeout()], False) == 2
+    rate_limited = github3.models.GitHubError(FakeResponse(
+        403, 'API rate limit exceeded', {'X-RateLimit-Remaining': '0'}))
+    assert send([rate_limited], False) == 2
+
+
+class FakeResponse:
+    def __init__(self, status_code=502, message='Bad Gateway', headers=None):
+        self.status_code = status_code
+        self.message = message
+        self.headers = headers or {}
+        self.content = b''
+
+    def json(self):
+        return {'message': self.message}
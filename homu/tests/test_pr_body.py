@@ -1,4 +1,10 @@
+import sqlite3
+
+from homu.db import migrate
 from homu.main import (
+    BodyCache,
+    PullReqState,
+    Repository,
     suppress_ignore_block,
     suppress_pings,
     IGNORE_BLOCK_START,
@@ -35,3 +41,53 @@ def test_suppress_ignore_block_in_PR_body():
     expect = "Rollup merge\n"
 
     assert suppress_ignore_block(body) == expect
+
+
+def new_db():
+    db = sqlite3.connect(':memory:', isolation_level=None).cursor()
+    migrate(db)
+    return db
+
+
+def new_state(db, num):
+    repository = Repository(None, 'rust', db)
+    return PullReqState(num, 'sha', '', repository)
+
+
+def test_body_is_loaded_lazily(monkeypatch):
+    monkeypatch.setattr('homu.main.body_cache', BodyCache(size=1))
+    db = new_db()
+
+    state = new_state(db, 1)
+    state.body = 'First body'
+    state.save()
+    other = new_state(db, 2)
+    other.body = 'Second body'
+    other.save()
+
+    # Saved bodies aren't kept on the state anymore
+    assert state._body is None
+    assert other._body is None
+
+    # The first body was evicted from the cache by the second one
+    assert state.body == 'First body'
+    assert other.body == 'Second body'
+
+
+def test_save_keeps_stored_body(monkeypatch):
+    monkeypatch.setattr('homu.main.body_cache', BodyCache())
+    db = new_db()
+
+    state = new_state(db, 1)
+    state.body = 'Body'
+    state.save()
+
+    # A state loaded from the database doesn't know its body
+    state = new_state(db, 1)
+    state._body = None
+    state.title = 'New title'
+    state.save()
+
+    db.execute('SELECT title, body FROM pull WHERE repo = ? AND num = ?',
+               ['rust', 1])
+    assert db.fetchone() == ('New title', 'Body')
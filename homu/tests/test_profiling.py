@@ -0,0 +1,72 @@
+import pstats
+import threading
+import time
+
+from homu import core, profiling
+
+
+def test_sample_collapses_the_stacks_of_other_threads():
+    stop = threading.Event()
+
+    def busy_waiting():
+        while not stop.is_set():
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=busy_waiting, name='worker-3')
+    thread.start()
+    try:
+        stacks, samples = profiling.sample(0.1, 0.005)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert samples > 0
+    worker = [stack for stack in stacks if stack.startswith('worker;')]
+    assert worker
+    assert all('busy_waiting (tests/test_profiling.py:' in stack
+               for stack in worker)
+
+
+def test_handler_profiles():
+    profiles = profiling.HandlerProfiles()
+
+    def handler():
+        sum(range(1000))
+
+    profiles.start(['webhook:push'])
+    with profiles.profile('webhook:push'):
+        handler()
+    with profiles.profile('webhook:status'):
+        handler()
+    runs = profiles.stop()
+
+    assert len(runs) == 1
+    assert 'handler' in profiling.stats_report(runs)
+
+
+def test_handler_profiles_leave_out_the_other_handlers(monkeypatch):
+    the_core = core.Core(workers=2)
+    the_core.start()
+    monkeypatch.setattr(core, '_core', the_core)
+    profiles = profiling.HandlerProfiles()
+    released = threading.Event()
+
+    def handler():
+        with profiles.profile('webhook:push'):
+            with the_core.released():
+                released.set()
+                time.sleep(0.01)
+
+    def other_handler():
+        released.wait()
+        time.sleep(0.3)
+
+    profiles.start(['webhook:push'])
+    handled = the_core.submit(handler)
+    the_core.submit(other_handler).result()
+    handled.result()
+    runs = profiles.stop()
+
+    # The handler waited for the other one to give the core back
+    assert len(runs) == 1
+    assert pstats.Stats(runs[0]).total_tt < 0.2
@@ -0,0 +1,50 @@
+import logging
+import sqlite3
+from types import SimpleNamespace
+
+from homu import main
+from homu.db import migrate
+from homu.main import PullReqState, Repository, process_queue
+
+
+class FakeRepo:
+    def __init__(self):
+        self.merges = []
+
+    def pull_request(self, num):
+        return SimpleNamespace(head=SimpleNamespace(sha='sha'),
+                               base=SimpleNamespace(ref='master'))
+
+    def ref(self, name):
+        return SimpleNamespace(object=SimpleNamespace(sha='base'))
+
+    def issue(self, num):
+        return SimpleNamespace(title='Title', body='')
+
+    def merge(self, branch, head_sha, message):
+        self.merges.append(head_sha)
+
+
+def test_builds_are_not_started_once_unapproved(monkeypatch):
+    db = sqlite3.connect(':memory:', isolation_level=None).cursor()
+    migrate(db)
+    repo = Repository(None, 'rust', db,
+                      repo_cfg={'owner': 'rust-lang', 'name': 'rust'})
+    repo.gh = FakeRepo()
+    state = PullReqState(1, 'sha', '', repo)
+    state.base_ref = 'master'
+    state.head_ref = 'user:branch'
+    state.approved_by = 'alice'
+    states = {'rust': {1: state}}
+
+    def sleep(seconds):
+        # r- while create_merge has given the core back
+        state.approved_by = ''
+    monkeypatch.setattr(main.core, 'sleep', sleep)
+
+    process_queue(states, {'rust': repo},
+                  {'rust': {'status': {'ci': {'context': 'ci'}}}},
+                  logging.getLogger('test'), [''], db, {'local_git': False})
+
+    assert repo.gh.merges == []
+    assert state.status == '' and state.merge_sha == ''
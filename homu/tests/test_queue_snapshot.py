@@ -0,0 +1,77 @@
+import gzip
+import time
+
+from bottle import request, response
+
+from homu.server import QueueSnapshots
+
+
+def bind(**headers):
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/queue/rust'}
+    for name, value in headers.items():
+        environ['HTTP_' + name.upper()] = value
+    request.bind(environ)
+    response.bind()
+
+
+def test_snapshots_are_rendered_once_per_version():
+    snapshots = QueueSnapshots()
+    renders = []
+
+    def render():
+        renders.append(1)
+        return 'queue {}'.format(len(renders))
+
+    first = snapshots.get('rust', (('rust', 1, 1000),), render)
+    again = snapshots.get('rust', (('rust', 1, 1000),), render)
+    changed = snapshots.get('rust', (('rust', 2, 1010),), render)
+
+    assert first is again
+    assert changed is not first
+    assert len(renders) == 2
+    assert changed.last_modified == 1010
+
+
+def test_snapshot_response_revalidation_and_compression():
+    snapshot = QueueSnapshots().get('rust', (('rust', 1, 1000),),
+                                    lambda: 'queue')
+
+    bind(accept_encoding='gzip, deflate')
+    body = snapshot.response()
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(body) == b'queue'
+    etag = response.headers['ETag']
+
+    bind(if_none_match=etag)
+    assert snapshot.response() == b''
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+    bind(if_modified_since='Thu, 01 Jan 1970 00:16:40 GMT')
+    snapshot.response()
+    assert response.status_code == 304
+
+    bind(accept_encoding='gzip;q=0')
+    assert snapshot.response() == b'queue'
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_no_dates_until_their_second_is_over(monkeypatch):
+    monkeypatch.setattr(time, 'time', lambda: 1000.5)
+    first = QueueSnapshots().get('rust', (('rust', 1, 1000.2),), lambda: 'a')
+    bind()
+    first.response()
+    assert 'Last-Modified' not in response.headers
+
+    # A change within the same second keeps the date, but not the ETag
+    changed = QueueSnapshots().get('rust', (('rust', 2, 1000.4),),
+                                   lambda: 'b')
+    bind(if_modified_since='Thu, 01 Jan 1970 00:16:40 GMT')
+    assert changed.response() == b'b'
+    assert response.status_code == 200
+
+    monkeypatch.setattr(time, 'time', lambda: 1001.0)
+    bind(if_modified_since='Thu, 01 Jan 1970 00:16:40 GMT')
+    assert changed.response() == b''
+    assert response.status_code == 304
@@ -0,0 +1,87 @@
+import concurrent.futures.thread
+import requests
+import time
+from threading import Event
+
+from homu import scheduler, utils
+from homu.scheduler import Scheduler
+
+
+def test_callbacks_run_in_deadline_order():
+    sched = Scheduler()
+    fired = []
+    done = Event()
+
+    sched.call_later(0.03, lambda: (fired.append('c'), done.set()))
+    sched.call_later(0.01, fired.append, 'a')
+    sched.call_later(0.02, fired.append, 'b')
+
+    assert done.wait(5)
+    assert fired == ['a', 'b', 'c']
+
+
+def test_cancelled_callbacks_dont_run():
+    sched = Scheduler()
+    fired = []
+    done = Event()
+
+    handle = sched.call_later(0.01, fired.append, 'cancelled')
+    sched.call_later(0.02, done.set)
+    handle.cancel()
+
+    assert sched.pending() == 1
+    assert done.wait(5)
+    assert fired == []
+
+
+def test_past_deadlines_run_immediately():
+    # This is what happens to builds that timed out while homu was down
+    sched = Scheduler()
+    done = Event()
+
+    sched.call_at(time.time() - 3600, done.set)
+
+    assert done.wait(5)
+
+
+def test_slow_callbacks_dont_delay_others():
+    sched = Scheduler(workers=2)
+    blocker = Event()
+    done = Event()
+
+    sched.call_later(0, blocker.wait)
+    sched.call_later(0.01, done.set)
+
+    assert done.wait(5)
+    blocker.set()
+
+
+def test_callbacks_run_after_the_main_thread_is_done(monkeypatch):
+    monkeypatch.setattr(concurrent.futures.thread, '_shutdown', True)
+    sched = Scheduler()
+    done = Event()
+
+    sched.call_later(0, done.set)
+
+    assert done.wait(5)
+
+
+def test_retry_later_schedules_the_retries(monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(scheduler, 'call_later',
+                        lambda delay, callback: scheduled.append(callback))
+
+    attempts = []
+    failures = []
+
+    def inner():
+        attempts.append(1)
+        raise requests.exceptions.ConnectionError('down')
+
+    utils.retry_later(inner, failures.append, 'state', tries=3)
+    assert len(attempts) == 1
+    while scheduled:
+        scheduled.pop()()
+
+    assert len(attempts) == 3
+    assert len(failures) == 1
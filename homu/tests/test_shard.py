@@ -0,0 +1,67 @@
+import argparse
+import subprocess
+
+from homu.shard import merge_queues, shard_of, worker_command, worker_config
+
+
+def new_cfg():
+    return {
+        'shards': {'count': 2},
+        'web': {'port': 54856},
+        'db': {'file': 'data/main.db'},
+        'repo': {
+            'rust': {'owner': 'rust-lang', 'name': 'rust'},
+            'cargo': {'owner': 'rust-lang', 'name': 'cargo', 'shard': 1},
+            'book': {'owner': 'rust-lang', 'name': 'book', 'shard': 0},
+        },
+    }
+
+
+def test_shard_of_is_stable_and_configurable():
+    assert shard_of('rust', {}, 16) == shard_of('rust', {}, 16)
+    assert shard_of('rust', {'shard': 3}, 16) == 3
+    assert shard_of('rust', {'shard': 3}, 2) == 1
+
+
+def test_worker_config():
+    cfg = new_cfg()
+    workers = [worker_config(cfg, index) for index in range(2)]
+
+    assert workers[0]['db']['file'] == 'data/main.shard0.db'
+    assert workers[1]['web'] == {'port': 54858, 'host': '127.0.0.1'}
+    assert 'cargo' in workers[1]['repo']
+    assert 'book' in workers[0]['repo']
+    assert sorted(label for worker in workers for label in worker['repo']) \
+        == ['book', 'cargo', 'rust']
+    # The front process keeps the full configuration
+    assert len(cfg['repo']) == 3
+
+
+def test_merge_queues():
+    def row(num, sort_key):
+        return {'num': num, 'sort_key': sort_key}
+
+    merged = merge_queues([
+        {'rows': [row(1, [0, 1]), row(3, [2, 0])],
+         'approved': 1, 'rolled_up': 0, 'failed': 1},
+        {'rows': [row(2, [1, 0])],
+         'approved': 1, 'rolled_up': 1, 'failed': 0},
+    ], {'2'})
+
+    assert [state['num'] for state in merged['states']] == [1, 2, 3]
+    assert [state['prechecked'] for state in merged['states']] == \
+        [False, True, False]
+    assert (merged['total'], merged['approved'], merged['rolled_up'],
+            merged['failed']) == (3, 2, 1, 1)
+
+
+def test_worker_command():
+    args = argparse.Namespace(config='cfg.toml', verbose=True)
+    cmd = worker_command(1, args)
+
+    # homu.main has to be imported as itself, not run as __main__
+    assert '-m' not in cmd
+    assert cmd[1:3] == ['-c', 'from homu.main import main; main()']
+    assert cmd[3:] == ['--config', 'cfg.toml', '--shard', '1', '--verbose']
+    assert subprocess.run(cmd[:3] + ['--help'],
+                          stdout=subprocess.DEVNULL).returncode == 0
@@ -0,0 +1,98 @@
+from homu.simulator import Build, Policy, load_history, simulate
+
+
+def span(name, num, start, duration=0, **attrs):
+    return dict({'repo_label': 'rust'}, name=name, num=num, start=start,
+                duration=duration, **attrs)
+
+
+def approval(num, start, priority=0, rollup=0):
+    return span('approval', num, start, priority=priority, rollup=rollup)
+
+
+def ci(num, start, duration, success=True, builder='linux'):
+    return span('ci:' + builder, num, start, duration, success=success,
+                try_build=False)
+
+
+def test_load_history():
+    history = load_history([
+        approval(1, 0),
+        ci(1, 100, 300, builder='linux'),
+        ci(1, 100, 500, builder='windows'),
+        ci(1, 1000, 200, success=False, builder='linux'),
+        ci(1, 1000, 50, success=False, builder='windows'),
+        span('ci:linux', 2, 100, 10, success=True, try_build=True),
+        span('create_merge', 1, 50, 61, try_build=False),
+        span('approval', 3, 0, repo_label='other'),
+    ], 'rust')
+
+    assert history.builds == {1: [Build(500, True), Build(50, False)]}
+    assert history.create_merge_seconds() == 61
+    assert [event[2] for event in history.events] == [1]
+
+
+def test_queue_order_and_rollups():
+    spans = [
+        approval(1, 0),
+        approval(2, 1, priority=10),
+        approval(3, 2, rollup=1),
+        approval(4, 3, rollup=1),
+        approval(5, 4),
+    ] + [ci(num, 5, 1000) for num in range(1, 6)]
+    history = load_history(spans, 'rust')
+
+    res = simulate(history, Policy(merge_delay=0))
+    assert res['merged'] == 5 and res['builds'] == 5
+    # #2 goes first, then #1 and #5 before the rollups
+    assert res['time_to_merge']['max'] == 5000 - 3
+
+    res = simulate(history, Policy(merge_delay=0, rollup_batch=10))
+    assert res['merged'] == 5 and res['builds'] == 4
+    assert res['time_to_merge']['max'] == 4000 - 2
+
+
+def test_failed_rollup_requeues_the_others():
+    history = load_history([
+        approval(1, 0, rollup=1),
+        approval(2, 0, rollup=1),
+        ci(1, 5, 100, success=False),
+        ci(2, 5, 1000),
+    ], 'rust')
+
+    res = simulate(history, Policy(merge_delay=0, rollup_batch=2))
+    assert res['merged'] == 1 and res['failed_builds'] == 1
+    # #2 keeps its recorded build
+    assert res['time_to_merge']['max'] == 1100
+    assert res['left_approved'] == 1
+
+
+def test_treeclosed():
+    spans = [
+        span('treeclosed', 1, 0, priority=5),
+        approval(1, 1),
+        approval(2, 2, priority=5),
+        span('treeclosed', 1, 5000, priority=-1),
+    ]
+    history = load_history(spans, 'rust')
+
+    res = simulate(history, Policy(merge_delay=0))
+    assert res['merged'] == 2
+    assert res['queue_wait']['max'] == 5000 - 1
+
+    res = simulate(history, Policy(merge_delay=0, ignore_treeclosed=True))
+    assert res['queue_wait']['max'] < 5000 - 1
+
+
+def test_unapproval_cancels_the_build():
+    history = load_history([
+        approval(1, 0),
+        ci(1, 5, 1000),
+        span('unapproval', 1, 500),
+        approval(2, 600),
+    ], 'rust')
+
+    res = simulate(history, Policy(merge_delay=0))
+    assert res['merged'] == 1
+    # #2 didn't wait for the cancelled build
+    assert res['queue_wait']['max'] == 0
@@ -0,0 +1,81 @@
+import sqlite3
+from queue import Queue
+from types import SimpleNamespace
+
+from homu import main
+from homu.db import migrate
+from homu.main import PullReqState, Repository, replace_states
+
+
+def pull(number, status):
+    return SimpleNamespace(number=number, head_sha='sha', status=status,
+                           title='', body='', head_ref='user:branch',
+                           base_ref='master', assignee='', labels=[],
+                           review_comments=[], issue_comments=[])
+
+
+def test_running_builds_keep_their_timeout():
+    db = sqlite3.connect(':memory:', isolation_level=None).cursor()
+    migrate(db)
+    repo = Repository(None, 'rust', db)
+    old = PullReqState(1, 'sha', '', repo)
+    old.start_testing(100)
+    old.test_started -= 30
+    old_timer = old.timeout_timer
+    states = {'rust': {1: old}}
+
+    try:
+        replace_states('rust', {'timeout': 100}, None,
+                       [pull(1, 'pending'), pull(2, '')], None, states,
+                       {}, db, Queue(), 'bors')
+
+        state = states['rust'][1]
+        assert old_timer.cancelled
+        assert state.test_started == old.test_started
+        assert state.timeout_timer.when == old.test_started + 100
+        assert states['rust'][2].timeout_timer is None
+    finally:
+        for state in states['rust'].values():
+            if state.timeout_timer:
+                state.timeout_timer.cancel()
+
+
+def test_failed_synchronizations_are_retried(monkeypatch):
+    results = [Exception('GitHub is down'), Exception('Still down'), None]
+    synchronized = []
+    delays = []
+    later = []
+
+    def synchronize(*args):
+        result = results.pop(0)
+        if result:
+            raise result
+        synchronized.append(args[0])
+
+    def call_later(delay, callback, *args):
+        delays.append(delay)
+        later.append(lambda: callback(*args))
+
+    class InlineThread:
+        def __init__(self, target, args, kwargs):
+            self.start = lambda: target(*args, **kwargs)
+
+    monkeypatch.setattr(main, 'synchronize', synchronize)
+    monkeypatch.setattr(main, 'Thread', InlineThread)
+    monkeypatch.setattr(main.scheduler, 'call_later', call_later)
+
+    repos = {'rust': None}
+    args = ['rust', {}, None, None, {}, repos, None, None, 'bors', {}]
+    main.synchronize_or_retry(*args)
+    while later:
+        later.pop(0)()
+
+    assert synchronized == ['rust']
+    assert delays == [main.SYNC_RETRY_DELAY, main.SYNC_RETRY_DELAY * 2]
+
+    # Repositories removed in the meantime aren't retried
+    results.append(Exception('GitHub is down'))
+    main.synchronize_or_retry(*args)
+    del repos['rust']
+    later.pop(0)()
+    assert synchronized == ['rust'] and not later
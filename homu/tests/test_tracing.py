@@ -0,0 +1,73 @@
+from homu import tracing
+
+
+class State:
+    repo_label = 'rust'
+
+    def __init__(self, num):
+        self.num = num
+
+
+def test_spans_and_summary(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, '_tracer', None)
+    tracing.record('queue_wait', State(1), 0)
+    tracing.start(str(tmp_path / 'traces.jsonl'))
+
+    for num, duration in enumerate([10, 20, 30, 40], 1):
+        tracing.record('queue_wait', State(num), 100, 100 + duration)
+    with tracing.span('fast_forward', State(1), attempt=0) as attrs:
+        attrs['success'] = True
+
+    spans = tracing.spans('rust', 1)
+    assert [span['name'] for span in spans] == ['queue_wait', 'fast_forward']
+    assert spans[1]['attempt'] == 0 and spans[1]['success'] is True
+
+    stages = tracing.summary()
+    assert stages['queue_wait'] == {
+        'count': 4, 'p50': 20, 'p90': 40, 'p99': 40, 'max': 40, 'total': 100,
+    }
+    assert list(tracing.summary(since=101)) == ['fast_forward']
+
+
+def test_record_since_consumes_the_mark(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, '_tracer', None)
+    tracing.start(str(tmp_path / 'traces.jsonl'))
+    state = State(1)
+
+    tracing.mark(state, 'queued')
+    tracing.record_since('queue_wait', state, 'queued')
+    tracing.record_since('queue_wait', state, 'queued')
+
+    assert len(tracing.spans()) == 1
+
+
+def test_rotation(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, '_tracer', None)
+    path = str(tmp_path / 'traces.jsonl')
+    tracing.start(path, max_bytes=200, backups=2)
+
+    for num in range(1, 11):
+        tracing.record('queue_wait', State(num), num, num + 1)
+
+    assert tracing.files(path) == [path + '.2', path + '.1', path]
+    nums = [span['num'] for span in tracing.read(path)]
+    assert nums == list(range(nums[0], 11)) and nums[0] > 1
+    assert tracing.command({'cmd': 'trace', 'repo_label': 'rust',
+                            'num': 10})['spans'][0]['duration'] == 1
+
+    # Files last written before `since` aren't read
+    monkeypatch.setattr(tracing.os.path, 'getmtime', lambda name: 0)
+    assert list(tracing.read(path, since=1)) == []
+
+
+def test_marks_are_forgotten(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, '_tracer', None)
+    tracing.start(str(tmp_path / 'traces.jsonl'))
+    state = State(1)
+
+    tracing.mark(state, 'queued')
+    tracing.mark(state, 'approved')
+    tracing.forget(state, 'approved')
+    assert list(tracing._tracer._marks) == [('rust', 1, 'queued')]
+    tracing.forget(state)
+    assert tracing._tracer._marks == {}
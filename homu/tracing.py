@@ -0,0 +1,217 @@
+"""Traces of the way pull requests take from approval to the base branch.
+
+Each stage is recorded as a span: its name, the pull request, when it
+started, how long it took and a few attributes. The stages are the approval,
+the wait in the queue, the creation of the merge commit (and its sleep,
+fetch and push), the CI run of each builder, every fast-forward attempt and
+the whole merge from approval to fast-forward. Spans are appended to a JSON
+lines file, which the `trace` and `trace_summary` admin commands query.
+
+The file is rotated like a log once it reaches `max_bytes`: it becomes
+`<file>.1`, the previous `<file>.1` becomes `<file>.2` and so on, keeping
+`backups` of them. Queries of the recent spans skip the files last written
+before the period they ask for.
+"""
+
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+PERCENTILES = [50, 90, 99]
+
+# The marks spans start from
+MARKS = ['queued', 'approved']
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_BACKUPS = 3
+
+
+class Tracer:
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES,
+                 backups=DEFAULT_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._size = self._file.tell()
+        # When something happened to a pull request, for the spans starting
+        # then: (repo_label, num, mark) -> timestamp
+        self._marks = {}
+
+    def write(self, span):
+        line = json.dumps(span, sort_keys=True) + '\n'
+        with self._lock:
+            if self._size and self._size + len(line) > self.max_bytes:
+                self._rotate()
+            self._file.write(line)
+            self._file.flush()
+            self._size += len(line)
+
+    def _rotate(self):
+        self._file.close()
+        if self.backups:
+            for index in range(self.backups - 1, 0, -1):
+                rotated = '{}.{}'.format(self.path, index)
+                if os.path.exists(rotated):
+                    os.replace(rotated, '{}.{}'.format(self.path, index + 1))
+            os.replace(self.path, self.path + '.1')
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._size = 0
+
+    def read(self, since=None):
+        with self._lock:
+            self._file.flush()
+        return read(self.path, since)
+
+    def mark(self, key):
+        with self._lock:
+            self._marks[key] = time.time()
+
+    def unmark(self, key):
+        with self._lock:
+            return self._marks.pop(key, None)
+
+
+def files(path):
+    """The tracing file and its rotated copies, oldest first."""
+    rotated = []
+    index = 1
+    while os.path.exists('{}.{}'.format(path, index)):
+        rotated.append('{}.{}'.format(path, index))
+        index += 1
+    return rotated[::-1] + [path]
+
+
+def read(path, since=None):
+    """The spans of a tracing file and of its rotated copies, or only those
+    starting at `since` or later."""
+    for name in files(path):
+        try:
+            # Spans are written once they end, after they start
+            if since is not None and os.path.getmtime(name) < since:
+                continue
+            fp = open(name, encoding='utf-8')
+        except FileNotFoundError:
+            # Rotated meanwhile
+            continue
+        with fp:
+            for line in fp:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    # Cut short by a crash
+                    continue
+                if since is None or span['start'] >= since:
+                    yield span
+
+
+_tracer = None
+
+
+def start(path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+    global _tracer
+    _tracer = Tracer(path, max_bytes, backups)
+
+
+# Without a started tracer nothing is recorded
+
+def record(name, state, start, end=None, **attrs):
+    if _tracer is None or start is None:
+        return
+
+    if end is None:
+        end = time.time()
+    _tracer.write(dict(
+        attrs,
+        name=name,
+        repo_label=state.repo_label,
+        num=state.num,
+        start=start,
+        duration=end - start,
+    ))
+
+
+@contextmanager
+def span(name, state, **attrs):
+    """Record the time spent in this block. Attributes can be added to the
+    yielded dict."""
+    start = time.time()
+    try:
+        yield attrs
+    finally:
+        record(name, state, start, **attrs)
+
+
+def mark(state, name):
+    """Remember that `name` happened to the pull request now."""
+    if _tracer is not None:
+        _tracer.mark((state.repo_label, state.num, name))
+
+
+def record_since(span_name, state, mark_name, **attrs):
+    """Record a span lasting from the mark `mark_name` until now, if there
+    is one. The mark is consumed."""
+    if _tracer is not None:
+        start = _tracer.unmark((state.repo_label, state.num, mark_name))
+        record(span_name, state, start, **attrs)
+
+
+def forget(state, *mark_names):
+    """Drop marks of the pull request that no span will consume, all of them
+    by default."""
+    if _tracer is not None:
+        for mark_name in mark_names or MARKS:
+            _tracer.unmark((state.repo_label, state.num, mark_name))
+
+
+def spans(repo_label=None, num=None, since=None):
+    if _tracer is None:
+        return []
+
+    return [
+        span for span in _tracer.read(since)
+        if (repo_label is None or span['repo_label'] == repo_label) and
+        (num is None or span['num'] == num)
+    ]
+
+
+def percentile(values, p):
+    """The nearest-rank percentile of sorted values."""
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def summary(repo_label=None, since=None):
+    """Percentiles of the duration of each stage."""
+    durations = {}
+    for span in spans(repo_label, since=since):
+        durations.setdefault(span['name'], []).append(span['duration'])
+
+    stages = {}
+    for name, values in durations.items():
+        values.sort()
+        stages[name] = dict(
+            {'p{}'.format(p): percentile(values, p) for p in PERCENTILES},
+            count=len(values),
+            max=values[-1],
+            total=sum(values),
+        )
+    return stages
+
+
+def command(cmd):
+    """Answer the tracing admin command `cmd`. It reads the tracing file, so
+    it doesn't run on the core."""
+    if cmd['cmd'] == 'trace':
+        return {'spans': spans(cmd['repo_label'], cmd['num'])}
+
+    since = None
+    if 'hours' in cmd:
+        since = time.time() - cmd['hours'] * 3600
+    return {'stages': summary(cmd.get('repo_label'), since)}
+
+
+COMMANDS = {'trace', 'trace_summary'}
@@ -1,3 +1,4 @@
+import functools
 import json
 import github3
 import logging
@@ -6,9 +7,12 @@ import sys
 import traceback
 import requests
 import time
+import urllib.parse
+from . import metrics
+from . import scheduler
 
 
-def github_set_ref(repo, ref, sha, *, force=False, auto_create=True, retry=1):
+def github_set_ref(repo, ref, sha, *, force=False, auto_create=True):
     url = repo._build_url('git', 'refs', ref, base_url=repo._api)
     data = {'sha': sha, 'force': force}
 
@@ -20,14 +24,6 @@ def github_set_ref(repo, ref, sha, *, force=False, auto_create=True, retry=1):
                 return repo.create_ref('refs/' + ref, sha)
             except github3.models.GitHubError:
                 raise e
-        elif e.code == 422 and retry > 0:
-            time.sleep(5)
-            return github_set_ref(repo,
-                                  ref,
-                                  sha,
-                                  force=force,
-                                  auto_create=auto_create,
-                                  retry=retry - 1)
         else:
             raise
 
@@ -55,15 +51,30 @@ def github_create_status(repo, sha, state, target_url='', description='', *,
     return Status(js) if js else None
 
 
-def remove_url_keys_from_json(json):
-    if isinstance(json, dict):
-        return {key: remove_url_keys_from_json(value)
-                for key, value in json.items()
-                if not key.endswith('url')}
-    elif isinstance(json, list):
-        return [remove_url_keys_from_json(value) for value in json]
-    else:
-        return json
+def github_create_comment(repo, num, body):
+    url = repo._build_url('issues', str(num), 'comments', base_url=repo._api)
+    js = repo._json(repo._post(url, data={'body': body}), 201)
+    return github3.issues.comment.IssueComment(js, repo) if js else None
+
+
+def github_iter_labels(repo, num):
+    url = repo._build_url('issues', str(num), 'labels', base_url=repo._api)
+    return repo._iter(-1, url, github3.issues.label.Label)
+
+
+def github_add_labels(repo, num, labels):
+    url = repo._build_url('issues', str(num), 'labels', base_url=repo._api)
+    repo._json(repo._post(url, data={'labels': list(labels)}), 200)
+
+
+def github_remove_label(repo, num, label):
+    url = repo._build_url('issues', str(num), 'labels',
+                          urllib.parse.quote(label, safe=''),
+                          base_url=repo._api)
+    res = repo._delete(url)
+    # 404 means the label was already gone, which is what we wanted anyway.
+    if res.status_code not in (200, 204, 404):
+        raise github3.models.GitHubError(res)
 
 
 def lazy_debug(logger, f):
@@ -73,18 +84,21 @@ def lazy_debug(logger, f):
 
 def logged_call(args):
     try:
-        subprocess.check_call(args, stdout=subprocess.DEVNULL, stderr=None)
+        with metrics.git_seconds.time(command=metrics.git_command(args)):
+            subprocess.check_call(args, stdout=subprocess.DEVNULL,
+                                  stderr=None)
     except subprocess.CalledProcessError:
         print('* Failed to execute command: {}'.format(args))
         raise
 
 
 def silent_call(args):
-    return subprocess.call(
-        args,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
+    with metrics.git_seconds.time(command=metrics.git_command(args)):
+        return subprocess.call(
+            args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
 
 
 def retry_until(inner, fail, state):
@@ -111,3 +125,23 @@ def retry_until(inner, fail, state):
         traceback.print_exception(*exc_info)
 
         fail(err)
+
+
+def retry_later(inner, fail, state, *, tries=3, delay=1):
+    """Like retry_until, but the retries are scheduled instead of blocking
+    the caller. Use it when nothing after the call depends on its result."""
+    try:
+        inner()
+    except (github3.models.GitHubError, requests.exceptions.RequestException) as e:  # noqa
+        print('* Intermittent GitHub error: {}'.format(e), file=sys.stderr)
+
+        if tries > 1:
+            scheduler.call_later(delay, functools.partial(
+                retry_later, inner, fail, state,
+                tries=tries - 1, delay=delay,
+            ))
+        else:
+            print('* GitHub failure in {}'.format(state), file=sys.stderr)
+            traceback.print_exc()
+
+            fail(e)
@@ -17,7 +17,6 @@ setup(
         'requests',
         'bottle',
         'waitress',
-        'retrying',
     ],
     setup_requires=[
         'pytest-runner<8',